@@ -7,12 +7,14 @@ from lnbits.helpers import template_renderer
 from lnbits.tasks import create_permanent_unique_task
 from loguru import logger
 
+from .metrics import TimedRoute
+
 logger.debug("This logged message is from merchantpill/__init__.py, you can debug in your extension using 'import logger from loguru' and 'logger.debug(<thing-to-log>)'.")
 
 db = Database("ext_merchantpill")
 
 merchantpill_ext: APIRouter = APIRouter(
-    prefix="/merchantpill", tags=["MerchantPill"]
+    prefix="/merchantpill", tags=["MerchantPill"], route_class=TimedRoute
 )
 
 merchantpill_static_files = [
@@ -28,7 +30,14 @@ def merchantpill_renderer():
 
 
 from .lnurl import *
-from .tasks import wait_for_paid_invoices
+from .fiat_rates import refresh_fiat_rates_periodically
+from .invoice_pool import refill_invoice_pools_periodically
+from .payouts import resume_payout_jobs_periodically
+from .tasks import (
+    archive_transactions_periodically,
+    prune_changelog_periodically,
+    wait_for_paid_invoices,
+)
 from .views import *
 from .views_api import *
 
@@ -43,4 +52,24 @@ def merchantpill_stop():
 
 def merchantpill_start():
     task = create_permanent_unique_task("ext_merchantpill", wait_for_paid_invoices)
-    scheduled_tasks.append(task)
\ No newline at end of file
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_merchantpill_changelog", prune_changelog_periodically
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_merchantpill_invoice_pool", refill_invoice_pools_periodically
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_merchantpill_fiat_rates", refresh_fiat_rates_periodically
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_merchantpill_payouts", resume_payout_jobs_periodically
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_merchantpill_archive", archive_transactions_periodically
+    )
+    scheduled_tasks.append(task)
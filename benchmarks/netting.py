@@ -0,0 +1,120 @@
+"""
+Time the debt netting engine on a synthetic debt graph: loading it, planning the
+settlement transfers, and keeping the plan current as payments arrive against
+reloading every debt and planning from scratch for each payment.
+
+    python benchmarks/netting.py --edges 100000 --payments 1000
+
+Pure Python, netting.py is loaded on its own so lnbits isn't needed.
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_netting():
+    spec = importlib.util.spec_from_file_location(
+        "netting", os.path.join(ROOT, "netting.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def debt_graph(edges, creditors, seed=1):
+    """(debtor, creditor, outstanding), every debtor owes one of a smaller set."""
+    rng = random.Random(seed)
+    return [
+        (f"d{n}", f"c{rng.randrange(creditors)}", rng.randrange(1, 100_000))
+        for n in range(edges)
+    ]
+
+
+def check(engine, transfers):
+    """The transfers bring every position to zero."""
+    net = {}
+    for payer, receiver, amount in transfers:
+        assert amount > 0
+        net[payer] = net.get(payer, 0) - amount
+        net[receiver] = net.get(receiver, 0) + amount
+    assert net == engine.positions
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--edges", type=int, default=100_000)
+    parser.add_argument("--creditors", type=int, default=5_000)
+    parser.add_argument("--payments", type=int, default=1_000)
+    parser.add_argument(
+        "--full-payments", type=int, default=20, help="payments for the reload run"
+    )
+    args = parser.parse_args()
+    netting = load_netting()
+
+    edges = debt_graph(args.edges, args.creditors)
+
+    def load():
+        engine = netting.NettingEngine()
+        for debtor, creditor, amount in edges:
+            engine.set_edge(debtor, creditor, amount)
+        return engine
+
+    engine, load_ms = timed(load)
+    transfers, plan_ms = timed(engine.plan)
+    print(f"{args.edges} debts, {len(engine.positions)} users with a position")
+    print(f"  load               {load_ms:10.1f}ms")
+    print(f"  plan               {plan_ms:10.1f}ms  {len(transfers)} transfers")
+
+    check(engine, transfers)
+    # a fresh plan settles at least one position per transfer
+    assert len(transfers) < max(len(engine.positions), 1)
+
+    rng = random.Random(2)
+    payments = [rng.randrange(args.edges) for _ in range(args.payments)]
+
+    def incremental():
+        # the plan is kept in step by set_edge, plan() only lists it
+        for n in payments:
+            debtor, creditor, amount = edges[n]
+            amount = amount // 2
+            edges[n] = (debtor, creditor, amount)
+            engine.set_edge(debtor, creditor, amount)
+
+    _, incremental_ms = timed(incremental)
+    per_payment = incremental_ms / len(payments)
+    transfers, list_ms = timed(engine.plan)
+    fresh = netting.settle(engine.positions)
+    check(engine, transfers)
+    assert load().positions == engine.positions
+    print(f"  payment            {per_payment:10.3f}ms  plan kept in step")
+    print(
+        f"  plan               {list_ms:10.1f}ms  {len(transfers)} transfers"
+        f" ({len(fresh)} planned from scratch, {engine.replans - 1} replans)"
+    )
+
+    def reload():
+        for n in payments[: args.full_payments]:
+            debtor, creditor, amount = edges[n]
+            edges[n] = (debtor, creditor, amount // 2)
+            load().plan()
+
+    _, reload_ms = timed(reload)
+    per_reload = reload_ms / min(args.full_payments, len(payments))
+    print(f"  payment            {per_reload:10.3f}ms  reloading every debt")
+    print(f"  speedup            {per_reload / per_payment:10.1f}x")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
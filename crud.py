@@ -1,57 +1,193 @@
-from typing import List, Optional, Union
+import base64
+import json
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Iterator, List, Optional, Set, Tuple, Union
 
+from lnbits.core.db import db as core_db
+from lnbits.core.models import Payment
+from lnbits.db import Connection
 from lnbits.helpers import urlsafe_short_hash
 from lnbits.lnurl import encode as lnurl_encode
 from . import db
-from .models import CreateMerchantPillData, MerchantPill
+from .cache import LRUCache
+from .metrics import instrument_crud
+from .netting import NettingEngine
+from .models import (
+    Balance,
+    CreateDebt,
+    CreateMerchantPillData,
+    CreateTransaction,
+    CreateUser,
+    CursorPage,
+    Debt,
+    MerchantPill,
+    PayoutItem,
+    PayoutJob,
+    ReferralTotals,
+    ReferralUser,
+    ReportBucket,
+    SettlementPlan,
+    SettlementTransfer,
+    Transaction,
+    User,
+    trusted_models,
+)
 from loguru import logger
 from fastapi import Request
 from lnurl import encode as lnurl_encode
 import shortuuid
 
 
+## Writes hand back the row they wrote with RETURNING, in the same round trip.
+## Updates take a fixed set of columns and run one statement per table: each
+## column comes with a flag and is only written when its flag is set, so the
+## statement text doesn't depend on which fields a caller passes. RETURNING needs
+## SQLite 3.35 or later.
+
+USER_FIELDS = (
+    "wallet",
+    "name",
+    "total",
+    "lnurlpayamount",
+    "lnurlwithdrawamount",
+    "lnurlwithdraw",
+    "lnurlpay",
+    "ticker",
+    "invited_by",
+    "debt_id",
+    "invoice_pool",
+)
+DEBT_FIELDS = (
+    "inviter_id",
+    "inviterWallet",
+    "debtPaid",
+    "debtOutstanding",
+    "debtCurrency",
+)
+TRANSACTION_FIELDS = (
+    "from_user_id",
+    "to_user_id",
+    "amount",
+    "currency",
+    "fiat_amount",
+    "timestamp",
+)
+
+
+def _update_statement(table: str, fields: Tuple[str, ...]) -> str:
+    columns = ", ".join(f"{field} = CASE WHEN ? THEN ? ELSE {field} END" for field in fields)
+    return f"UPDATE merchantpill.{table} SET {columns} WHERE id = ? RETURNING *"
+
+
+def _update_values(fields: Tuple[str, ...], row_id: str, kwargs: dict) -> tuple:
+    unknown = set(kwargs) - set(fields)
+    if unknown:
+        raise ValueError(f"Can't update {', '.join(sorted(unknown))}.")
+    values: list = []
+    for field in fields:
+        values += [field in kwargs, kwargs.get(field)]
+    return (*values, row_id)
+
+
+UPDATE_USER = _update_statement("maintable", USER_FIELDS)
+UPDATE_DEBT = _update_statement("debt", DEBT_FIELDS)
+
+
+def _rewrite_rows(conn: Connection, rows: List[tuple]) -> List[tuple]:
+    """
+    lnbits strips markup from (and converts datetimes in) the values of a single
+    row, a list of rows goes to executemany as is. Batch writes pass theirs
+    through here to be stored the same.
+    """
+    return [conn.rewrite_values(row) for row in rows]
+
+
 async def create_merchantpill(
     wallet_id: str, data: CreateMerchantPillData, req: Request
 ) -> MerchantPill:
     merchantpill_id = urlsafe_short_hash()
-    await db.execute(
-        """
-        INSERT INTO merchantpill.maintable (id, wallet, name, lnurlpayamount, lnurlwithdrawamount)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (
-            merchantpill_id,
-            wallet_id,
-            data.name,
-            data.lnurlpayamount,
-            data.lnurlwithdrawamount,
-        ),
-    )
-    merchantpill = await get_merchantpill(merchantpill_id, req)
-    assert merchantpill, "Newly created table couldn't be retrieved"
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            """
+            INSERT INTO merchantpill.maintable
+            (id, wallet, name, lnurlpayamount, lnurlwithdrawamount, invoice_pool, public_modified)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING *
+            """,
+            (
+                merchantpill_id,
+                wallet_id,
+                data.name,
+                data.lnurlpayamount,
+                data.lnurlwithdrawamount,
+                data.invoice_pool or 0,
+                int(time.time()),
+            ),
+        )
+        await add_referral_paths([(merchantpill_id, None)], conn)
+        await log_changes([("user", merchantpill_id, merchantpill_id)], conn)
+    assert row, "Newly created table couldn't be retrieved"
+    merchantpill = MerchantPill(**row)
+    set_lnurls(merchantpill, req)
     return merchantpill
 
 
-async def get_merchantpill(
-    merchantpill_id: str, req: Optional[Request] = None
-) -> Optional[MerchantPill]:
-    row = await db.fetchone(
-        "SELECT * FROM merchantpill.maintable WHERE id = ?", (merchantpill_id,)
-    )
-    if not row:
-        return None
-    rowAmended = MerchantPill(**row)
-    if req:
-        rowAmended.lnurlpay = lnurl_encode(
+# Encoded LNURLs, keyed by base url and id (plus the ticker for withdraws, so a
+# spent withdraw link simply stops being hit and ages out).
+lnurl_cache = LRUCache(maxsize=10000, ttl=3600)
+
+
+def set_lnurls(
+    row: Union[MerchantPill, User], req: Request, withdraw: bool = True
+) -> None:
+    base_url = str(req.base_url)
+    row.lnurlpay = lnurl_cache.get(("pay", base_url, row.id))
+    if not row.lnurlpay:
+        row.lnurlpay = lnurl_encode(
             req.url_for("merchantpill.api_lnurl_pay", merchantpill_id=row.id)._url
         )
-        rowAmended.lnurlwithdraw = lnurl_encode(
+        lnurl_cache.set(("pay", base_url, row.id), row.lnurlpay)
+    if not withdraw:
+        return
+    row.lnurlwithdraw = lnurl_cache.get(("withdraw", base_url, row.id, row.ticker))
+    if not row.lnurlwithdraw:
+        row.lnurlwithdraw = lnurl_encode(
             req.url_for(
                 "merchantpill.api_lnurl_withdraw",
                 merchantpill_id=row.id,
-                tickerhash=shortuuid.uuid(name=rowAmended.id + str(rowAmended.ticker)),
+                tickerhash=shortuuid.uuid(name=row.id + str(row.ticker)),
             )._url
         )
+        lnurl_cache.set(("withdraw", base_url, row.id, row.ticker), row.lnurlwithdraw)
+
+
+# MerchantPill rows for the LNURL and public page lookups. Anything that writes
+# to maintable pops the entry, and callers that need the current ticker
+# (withdraws) read with use_cache=False.
+merchantpill_cache = LRUCache(maxsize=1024, ttl=30)
+
+
+async def get_merchantpill(
+    merchantpill_id: str,
+    req: Optional[Request] = None,
+    use_cache: bool = True,
+    withdraw: bool = True,
+) -> Optional[MerchantPill]:
+    rowAmended = merchantpill_cache.get(merchantpill_id) if use_cache else None
+    if not rowAmended:
+        token = merchantpill_cache.token()
+        row = await db.fetchone(
+            "SELECT * FROM merchantpill.maintable WHERE id = ?", (merchantpill_id,)
+        )
+        if not row:
+            return None
+        rowAmended = MerchantPill(**row)
+        merchantpill_cache.set(merchantpill_id, rowAmended, token)
+    # the cached instance is shared, hand out a copy
+    rowAmended = rowAmended.copy()
+    if req:
+        set_lnurls(rowAmended, req, withdraw)
     return rowAmended
 
 
@@ -61,40 +197,1663 @@ async def get_merchantpills(
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
 
-    q = ",".join(["?"] * len(wallet_ids))
-    rows = await db.fetchall(
-        f"SELECT * FROM merchantpill.maintable WHERE wallet IN ({q})", (*wallet_ids,)
+    rows = await _fetch_by_wallet(
+        "SELECT * FROM merchantpill.maintable WHERE wallet IN ({wallets})", wallet_ids
     )
-    tempRows = [MerchantPill(**row) for row in rows]
+    tempRows = trusted_models(MerchantPill, rows)
     if req:
         for row in tempRows:
-            row.lnurlpay = lnurl_encode(
-                req.url_for("merchantpill.api_lnurl_pay", merchantpill_id=row.id)._url
-            )
-            row.lnurlwithdraw = lnurl_encode(
-                req.url_for(
-                    "merchantpill.api_lnurl_withdraw",
-                    merchantpill_id=row.id,
-                    tickerhash=shortuuid.uuid(name=row.id + str(row.ticker)),
-                )._url
-            )
+            set_lnurls(row, req)
     return tempRows
 
 
 async def update_merchantpill(
     merchantpill_id: str, req: Optional[Request] = None, **kwargs
 ) -> MerchantPill:
-    q = ", ".join([f"{field[0]} = ?" for field in kwargs.items()])
-    await db.execute(
-        f"UPDATE merchantpill.maintable SET {q} WHERE id = ?",
-        (*kwargs.values(), merchantpill_id),
-    )
-    merchantpill = await get_merchantpill(merchantpill_id, req)
-    assert merchantpill, "Newly updated merchantpill couldn't be retrieved"
+    values = _update_values(USER_FIELDS, merchantpill_id, kwargs)
+    async with db.connect() as conn:
+        row = await conn.fetchone(UPDATE_USER, values)
+        await log_changes([("user", merchantpill_id, merchantpill_id)], conn)
+        if PUBLIC_FIELDS & kwargs.keys():
+            await _stamp_public_change(merchantpill_id, conn)
+    merchantpill_cache.pop(merchantpill_id)
+    assert row, "Newly updated merchantpill couldn't be retrieved"
+    merchantpill = MerchantPill(**row)
+    if req:
+        set_lnurls(merchantpill, req)
     return merchantpill
 
 
+# The fields the public page, manifest and LNURL-pay request are rendered from.
+# A change to one of them moves the pill's public_version to the change version
+# of the write, the validators of its cached responses (see http_cache.py).
+PUBLIC_FIELDS = {"wallet", "name", "lnurlpayamount"}
+
+
+async def _stamp_public_change(merchantpill_id: str, conn: Connection) -> None:
+    """Call after log_changes, it takes the version that logged the change."""
+    await conn.execute(
+        """
+        UPDATE merchantpill.maintable SET public_modified = ?,
+        public_version = (SELECT version FROM merchantpill.changelog_version)
+        WHERE id = ?
+        """,
+        (int(time.time()), merchantpill_id),
+    )
+
+
+async def get_public_version(merchantpill_id: str) -> Optional[Tuple[int, int]]:
+    """(public_version, public_modified) of a pill, without loading the row."""
+    row = await db.fetchone(
+        """
+        SELECT public_version, public_modified FROM merchantpill.maintable
+        WHERE id = ?
+        """,
+        (merchantpill_id,),
+    )
+    return (row.public_version, row.public_modified) if row else None
+
+
+async def stamp_render_fingerprint(fingerprint: str) -> int:
+    """
+    When the public responses' rendering inputs (see http_cache.py) last changed:
+    the time `fingerprint` was first recorded, now if it is new.
+    """
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            "SELECT fingerprint, modified FROM merchantpill.render_fingerprint"
+        )
+        if row and row.fingerprint == fingerprint:
+            return row.modified
+        modified = int(time.time())
+        await conn.execute("DELETE FROM merchantpill.render_fingerprint")
+        await conn.execute(
+            """
+            INSERT INTO merchantpill.render_fingerprint (fingerprint, modified)
+            VALUES (?, ?)
+            """,
+            (fingerprint, modified),
+        )
+    return modified
+
+
 async def delete_merchantpill(merchantpill_id: str) -> None:
+    # same row as a user, so the same cleanup applies
+    await delete_user(merchantpill_id)
+
+
+async def get_pooled_merchantpills() -> List[MerchantPill]:
+    """Merchantpills that keep a pool of pre-created LNURL-pay invoices."""
+    rows = await db.fetchall(
+        "SELECT * FROM merchantpill.maintable WHERE invoice_pool > 0"
+    )
+    return [MerchantPill(**row) for row in rows]
+
+
+## LNURL withdraw redemptions. A callback claims the withdraw by moving the
+## ticker on only if it still holds the value its k1 was made from, so of any
+## number of concurrent callbacks exactly one wins. The claim is recorded as a
+## pending redemption and settled once the payout is known.
+
+
+async def claim_redemption(
+    merchantpill_id: str, ticker: int
+) -> Optional[Tuple[MerchantPill, str]]:
+    """Returns the merchantpill and redemption id, or None if already claimed."""
+    redemption_id = urlsafe_short_hash()
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            """
+            UPDATE merchantpill.maintable SET ticker = ticker + 1
+            WHERE id = ? AND ticker = ? RETURNING *
+            """,
+            (merchantpill_id, ticker),
+        )
+        if not row:
+            return None
+        merchantpill = MerchantPill(**row)
+        await conn.execute(
+            """
+            INSERT INTO merchantpill.redemption (id, merchantpill_id, ticker, amount)
+            VALUES (?, ?, ?, ?)
+            """,
+            (redemption_id, merchantpill_id, ticker, merchantpill.lnurlwithdrawamount),
+        )
+        await log_changes([("user", merchantpill_id, merchantpill_id)], conn)
+    merchantpill_cache.pop(merchantpill_id)
+    return merchantpill, redemption_id
+
+
+async def complete_redemption(redemption_id: str, payment_hash: str) -> None:
+    await db.execute(
+        """
+        UPDATE merchantpill.redemption SET status = 'paid', payment_hash = ?
+        WHERE id = ?
+        """,
+        (payment_hash, redemption_id),
+    )
+
+
+async def fail_redemption(redemption_id: str) -> None:
+    """Marks the payout failed and hands the ticker back, so the k1 works again."""
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            """
+            UPDATE merchantpill.redemption SET status = 'failed'
+            WHERE id = ? AND status = 'pending' RETURNING merchantpill_id, ticker
+            """,
+            (redemption_id,),
+        )
+        if not row:
+            return
+        # only if no later withdraw moved the ticker on in the meantime
+        await conn.execute(
+            """
+            UPDATE merchantpill.maintable SET ticker = ?
+            WHERE id = ? AND ticker = ?
+            """,
+            (row.ticker, row.merchantpill_id, row.ticker + 1),
+        )
+        await log_changes([("user", row.merchantpill_id, row.merchantpill_id)], conn)
+    merchantpill_cache.pop(row.merchantpill_id)
+
+
+
+## Keyset pagination: listings are ordered by a unique key and a page starts
+## strictly after the last key of the previous one, so deep pages cost the same
+## as the first.
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(*key: Any) -> str:
+    raw = json.dumps(key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor.")
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError("Invalid cursor.")
+    return key
+
+
+def _page(rows: list, limit: int, key: Callable[[Any], tuple]) -> Optional[str]:
+    """Trims the look-ahead row fetched past `limit` and returns the next cursor."""
+    if len(rows) <= limit:
+        return None
+    del rows[limit:]
+    return encode_cursor(*key(rows[-1]))
+
+
+## Listings scoped to many wallets (all_wallets) bind the wallet ids in IN lists
+## of a few fixed sizes padded with NULL, so every account reuses the same
+## handful of statements and none gets near the driver's parameter limit.
+## Accounts with more wallets than the largest list are read chunk by chunk.
+
+WALLET_CHUNK_SIZES = (1, 8, 64, 512)
+
+
+async def get_account_wallet_ids(user_id: str) -> List[str]:
+    """Wallet ids of an lnbits account, without loading the account and balances."""
+    rows = await core_db.fetchall(
+        'SELECT id FROM wallets WHERE "user" = ? AND deleted = false ORDER BY id',
+        (user_id,),
+    )
+    return [row.id for row in rows]
+
+
+def _wallet_chunks(wallet_ids: List[str]) -> Iterator[Tuple[str, list]]:
+    step = WALLET_CHUNK_SIZES[-1]
+    for start in range(0, len(wallet_ids), step):
+        chunk = list(wallet_ids[start : start + step])
+        size = next(size for size in WALLET_CHUNK_SIZES if size >= len(chunk))
+        yield ", ".join(["?"] * size), chunk + [None] * (size - len(chunk))
+
+
+async def _fetch_by_wallet(
+    query: str,
+    wallet_ids: List[str],
+    values: tuple = (),
+    limit: Optional[int] = None,
+    key: Optional[Callable[[Any], tuple]] = None,
+    reverse: bool = False,
+) -> list:
+    """
+    Runs `query`, whose `{wallets}` is the first placeholder, once per chunk of
+    wallet ids. Rows of several chunks are merged back into `key` order and cut
+    to `limit`, which keeps keyset pagination correct across chunks.
+    """
+    rows: list = []
+    chunks = 0
+    for placeholders, chunk in _wallet_chunks(wallet_ids):
+        chunks += 1
+        rows += await db.fetchall(
+            query.format(wallets=placeholders), (*chunk, *values)
+        )
+    if chunks > 1 and key:
+        rows.sort(key=key, reverse=reverse)
+    if chunks > 1 and limit is not None:
+        del rows[limit:]
+    return rows
+
+
+## Users
+
+
+INSERT_USER = """
+    INSERT INTO merchantpill.maintable
+    (id, wallet, name, total, lnurlpayamount, lnurlwithdrawamount, invited_by, debt_id,
+    invoice_pool, public_modified)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _user_values(user_id: str, wallet_id: str, data: CreateUser) -> tuple:
+    return (
+        user_id,
+        wallet_id,
+        data.name,
+        data.total or 0,
+        data.lnurlpayamount or 0,
+        data.lnurlwithdrawamount or 0,
+        data.invited_by,
+        data.debt_id,
+        data.invoice_pool or 0,
+        int(time.time()),
+    )
+
+
+async def create_user(
+    wallet_id: str, data: CreateUser, req: Optional[Request] = None
+) -> User:
+    user_id = urlsafe_short_hash()
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            f"{INSERT_USER} RETURNING *", _user_values(user_id, wallet_id, data)
+        )
+        await add_referral_paths([(user_id, data.invited_by)], conn)
+        await _add_balances([user_id], conn)
+        await log_changes([("user", user_id, user_id)], conn)
+    if data.debt_id:
+        netting_engines.pop(wallet_id)
+    assert row, "Newly created user couldn't be retrieved"
+    user = User.from_row(row)
+    if req:
+        set_lnurls(user, req)
+    return user
+
+
+async def create_users(wallet_id: str, users: List[CreateUser]) -> List[str]:
+    """Inserts a batch of users with one executemany in a single transaction."""
+    user_ids = [urlsafe_short_hash() for _ in users]
+    async with db.connect() as conn:
+        await conn.execute(
+            INSERT_USER,
+            _rewrite_rows(
+                conn,
+                [
+                    _user_values(user_id, wallet_id, data)
+                    for user_id, data in zip(user_ids, users)
+                ],
+            ),
+        )
+        await add_referral_paths(
+            [(user_id, data.invited_by) for user_id, data in zip(user_ids, users)],
+            conn,
+        )
+        await _add_balances(user_ids, conn)
+        await log_changes([("user", user_id, user_id) for user_id in user_ids], conn)
+    if any(data.debt_id for data in users):
+        netting_engines.pop(wallet_id)
+    return user_ids
+
+
+async def get_user(user_id: str, req: Optional[Request] = None) -> Optional[User]:
+    row = await db.fetchone(
+        "SELECT * FROM merchantpill.maintable WHERE id = ?", (user_id,)
+    )
+    if not row:
+        return None
+    user = User.from_row(row)
+    if req:
+        set_lnurls(user, req)
+    return user
+
+
+async def get_users(
+    wallet_ids: Union[str, List[str]],
+    req: Optional[Request] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> CursorPage:
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return CursorPage(data=[], next_cursor=None)
+
+    where, values = "wallet IN ({wallets})", []
+    if cursor:
+        where += " AND id > ?"
+        values += decode_cursor(cursor, 1)
+    rows = await _fetch_by_wallet(
+        f"""
+        SELECT * FROM merchantpill.maintable WHERE {where}
+        ORDER BY id LIMIT ?
+        """,
+        wallet_ids,
+        (*values, limit + 1),
+        limit=limit + 1,
+        key=lambda row: (row.id,),
+    )
+    users = trusted_models(User, rows)
+    next_cursor = _page(users, limit, lambda user: (user.id,))
+    if req:
+        for user in users:
+            set_lnurls(user, req)
+    return CursorPage(data=users, next_cursor=next_cursor)
+
+
+async def update_user(user_id: str, req: Optional[Request] = None, **kwargs) -> User:
+    values = _update_values(USER_FIELDS, user_id, kwargs)
+    async with db.connect() as conn:
+        if "invited_by" in kwargs:
+            await move_referral(user_id, kwargs["invited_by"], conn)
+        if "wallet" in kwargs:
+            # let clients of the old wallet drop it
+            await log_changes([("user", user_id, user_id)], conn)
+        row = await conn.fetchone(UPDATE_USER, values)
+        if "wallet" in kwargs:
+            await _move_transactions(user_id, kwargs["wallet"], conn)
+        if "wallet" in kwargs or "debt_id" in kwargs:
+            await refresh_balances([user_id], conn=conn)
+        await log_changes([("user", user_id, user_id)], conn)
+        if PUBLIC_FIELDS & kwargs.keys():
+            await _stamp_public_change(user_id, conn)
+    merchantpill_cache.pop(user_id)
+    if "wallet" in kwargs or "debt_id" in kwargs:
+        netting_engines.clear()
+    assert row, "Newly updated user couldn't be retrieved"
+    user = User.from_row(row)
+    if req:
+        set_lnurls(user, req)
+    return user
+
+
+async def delete_user(user_id: str) -> None:
+    async with db.connect() as conn:
+        await log_changes([("user", user_id, user_id)], conn)
+        await remove_referral(user_id, conn)
+        # the people they invited become roots, as in the referral tree
+        invited = await conn.fetchall(
+            "SELECT id FROM merchantpill.maintable WHERE invited_by = ?", (user_id,)
+        )
+        if invited:
+            await conn.execute(
+                """
+                UPDATE merchantpill.maintable SET invited_by = NULL
+                WHERE invited_by = ?
+                """,
+                (user_id,),
+            )
+            await log_changes([("user", row.id, row.id) for row in invited], conn)
+        await conn.execute(
+            "DELETE FROM merchantpill.maintable WHERE id = ?", (user_id,)
+        )
+        # out of the wallet's listing, as their rows no longer join a user
+        await _move_transactions(user_id, None, conn)
+        await conn.execute(
+            "DELETE FROM merchantpill.balance WHERE user_id = ?", (user_id,)
+        )
+    merchantpill_cache.pop(user_id)
+    for row in invited:
+        merchantpill_cache.pop(row.id)
+    netting_engines.clear()
+
+
+async def _move_transactions(
+    user_id: str, wallet_id: Optional[str], conn: Connection
+) -> None:
+    """Moves the transactions the user paid to the wallet listing of `wallet_id`."""
+    for table in TRANSACTION_TABLES:
+        await conn.execute(
+            f"UPDATE merchantpill.{table} SET wallet = ? WHERE from_user_id = ?",
+            (wallet_id, user_id),
+        )
+
+
+## Debts
+
+
+async def create_debt(data: CreateDebt) -> Debt:
+    debt_id = urlsafe_short_hash()
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            """
+            INSERT INTO merchantpill.debt
+            (id, inviter_id, inviterWallet, debtPaid, debtOutstanding, debtCurrency)
+            VALUES (?, ?, ?, ?, ?, ?)
+            RETURNING *
+            """,
+            (
+                debt_id,
+                data.inviter_id,
+                data.inviterWallet,
+                data.debtPaid or 0,
+                data.debtOutstanding or 0,
+                data.debtCurrency,
+            ),
+        )
+    assert row, "Newly created debt couldn't be retrieved"
+    return Debt.from_row(row)
+
+
+async def get_debt(debt_id: str) -> Optional[Debt]:
+    row = await db.fetchone("SELECT * FROM merchantpill.debt WHERE id = ?", (debt_id,))
+    return Debt.from_row(row) if row else None
+
+
+async def get_debts(
+    wallet_ids: Union[str, List[str]],
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> CursorPage:
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return CursorPage(data=[], next_cursor=None)
+
+    where, values = "inviterWallet IN ({wallets})", []
+    if cursor:
+        where += " AND id > ?"
+        values += decode_cursor(cursor, 1)
+    rows = await _fetch_by_wallet(
+        f"SELECT * FROM merchantpill.debt WHERE {where} ORDER BY id LIMIT ?",
+        wallet_ids,
+        (*values, limit + 1),
+        limit=limit + 1,
+        key=lambda row: (row.id,),
+    )
+    debts = trusted_models(Debt, rows)
+    next_cursor = _page(debts, limit, lambda debt: (debt.id,))
+    return CursorPage(data=debts, next_cursor=next_cursor)
+
+
+async def update_debt(debt_id: str, **kwargs) -> Debt:
+    values = _update_values(DEBT_FIELDS, debt_id, kwargs)
+    async with db.connect() as conn:
+        row = await conn.fetchone(UPDATE_DEBT, values)
+        if "debtPaid" in kwargs or "debtOutstanding" in kwargs:
+            await refresh_balances(await _debtor_ids(debt_id, conn), conn=conn)
+    if "debtPaid" in kwargs or "debtOutstanding" in kwargs or "inviter_id" in kwargs:
+        netting_engines.clear()
+    assert row, "Newly updated debt couldn't be retrieved"
+    return Debt.from_row(row)
+
+
+async def delete_debt(debt_id: str) -> None:
+    async with db.connect() as conn:
+        await conn.execute("DELETE FROM merchantpill.debt WHERE id = ?", (debt_id,))
+        await refresh_balances(await _debtor_ids(debt_id, conn), conn=conn)
+    netting_engines.clear()
+
+
+async def _debtor_ids(debt_id: str, conn: Connection) -> List[str]:
+    rows = await conn.fetchall(
+        "SELECT id FROM merchantpill.maintable WHERE debt_id = ?", (debt_id,)
+    )
+    return [row.id for row in rows]
+
+
+## Debt netting, one engine per wallet over the debts of its users (see
+## netting.py). Payments update a loaded engine in place, any other write that
+## touches debts or who holds them drops the engines and they reload on use.
+
+netting_engines = LRUCache(maxsize=256, ttl=3600)
+
+
+async def get_netting_engine(wallet_id: str) -> NettingEngine:
+    engine = netting_engines.get(wallet_id)
+    if engine:
+        return engine
+    token = netting_engines.token()
+    rows = await db.fetchall(
+        """
+        SELECT u.id, d.inviter_id, d.debtOutstanding - d.debtPaid AS outstanding
+        FROM merchantpill.maintable u
+        JOIN merchantpill.debt d ON d.id = u.debt_id
+        WHERE u.wallet = ?
+        """,
+        (wallet_id,),
+    )
+    engine = NettingEngine()
+    for row in rows:
+        engine.set_edge(row.id, row.inviter_id, row.outstanding)
+    netting_engines.set(wallet_id, engine, token)
+    return engine
+
+
+async def get_settlement_plan(wallet_id: str) -> SettlementPlan:
+    engine = await get_netting_engine(wallet_id)
+    return SettlementPlan(
+        wallet=wallet_id,
+        debts=len(engine.edges),
+        outstanding=engine.outstanding(),
+        transfers=[
+            SettlementTransfer(from_user_id=debtor, to_user_id=creditor, amount=amount)
+            for debtor, creditor, amount in engine.plan()
+        ],
+    )
+
+
+## Transactions. Those older than the archive horizon are moved to
+## transaction_archive in small batches (archive_transactions), reads by id and
+## over a user's whole history go through both tables.
+
+# wallet is the payer's, kept in step with maintable for the listings
+TRANSACTION_COLUMNS = (
+    "id, from_user_id, to_user_id, amount, currency, fiat_amount, timestamp, wallet"
+)
+TRANSACTION_TABLES = ('"transaction"', "transaction_archive")
+UPDATE_TRANSACTION = {
+    table: _update_statement(table, TRANSACTION_FIELDS) for table in TRANSACTION_TABLES
+}
+ALL_TRANSACTIONS = f"""(
+    SELECT {TRANSACTION_COLUMNS} FROM merchantpill."transaction"
+    UNION ALL
+    SELECT {TRANSACTION_COLUMNS} FROM merchantpill.transaction_archive
+)"""
+
+
+def _timestamp_key(column: str) -> str:
+    """
+    SQL for a timestamp column as text that compares equal to the stored value.
+    Transaction listings page on it, lnbits hands postgres timestamps back as
+    whole-second epochs, so the cursor carries this text instead.
+    """
+    if db.type == "SQLITE":
+        # stored as 'YYYY-MM-DD HH:MM:SS' text already
+        return column
+    return f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS.US')"
+
+
+def _timestamp_value(value: Any) -> Any:
+    """
+    A datetime as the text SQLite's CURRENT_TIMESTAMP writes. lnbits would bind
+    it as an epoch, which neither sorts nor groups with the text timestamps.
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc)
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+async def create_transaction(data: CreateTransaction) -> Transaction:
+    transaction_id = urlsafe_short_hash()
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            """
+            INSERT INTO merchantpill."transaction"
+            (id, from_user_id, wallet, to_user_id, amount, currency, fiat_amount)
+            VALUES (?, ?, (SELECT wallet FROM merchantpill.maintable WHERE id = ?), ?, ?, ?, ?)
+            RETURNING *
+            """,
+            (
+                transaction_id,
+                data.from_user_id,
+                data.from_user_id,
+                data.to_user_id,
+                data.amount or 0,
+                data.currency,
+                data.fiat_amount,
+            ),
+        )
+        await roll_up_transactions([transaction_id], 1, conn)
+        await log_changes([("transaction", transaction_id, data.from_user_id)], conn)
+        await _roll_up_transfer(
+            conn, data.from_user_id, data.to_user_id, data.amount or 0
+        )
+    assert row, "Newly created transaction couldn't be retrieved"
+    return Transaction.from_row(row)
+
+
+async def get_transaction(transaction_id: str) -> Optional[Transaction]:
+    row = await db.fetchone(
+        f"SELECT * FROM {ALL_TRANSACTIONS} t WHERE id = ?", (transaction_id,)
+    )
+    return Transaction.from_row(row) if row else None
+
+
+async def get_transactions(
+    wallet_ids: Union[str, List[str]],
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> CursorPage:
+    """
+    Transactions paid by users of the given wallets, newest first. A timestamp
+    can be updated after archiving, so archived transactions aren't necessarily
+    older than live ones: a page is read from both tables and merged.
+    """
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return CursorPage(data=[], next_cursor=None)
+
+    where, values = "t.wallet IN ({wallets})", []
+    if cursor:
+        # the leading bound is what lets the index range start at the cursor
+        where += " AND t.timestamp <= ? AND (t.timestamp < ? OR t.id < ?)"
+        timestamp, id = decode_cursor(cursor, 2)
+        values += [timestamp, timestamp, id]
+    rows: list = []
+    for table in TRANSACTION_TABLES:
+        rows += await _fetch_by_wallet(
+            f"""
+            SELECT t.*, {_timestamp_key("t.timestamp")} AS sort_key
+            FROM merchantpill.{table} t WHERE {where}
+            ORDER BY t.timestamp DESC, t.id DESC LIMIT ?
+            """,
+            wallet_ids,
+            (*values, limit + 1),
+            limit=limit + 1,
+            key=lambda row: (row.sort_key, row.id),
+            reverse=True,
+        )
+    rows.sort(key=lambda row: (row.sort_key, row.id), reverse=True)
+    next_cursor = _page(rows, limit, lambda row: (row.sort_key, row.id))
+    return CursorPage(
+        data=[Transaction.from_row(row) for row in rows], next_cursor=next_cursor
+    )
+
+
+async def _transaction_user_ids(transaction_id: str, conn: Connection) -> Set[str]:
+    row = await conn.fetchone(
+        f"SELECT from_user_id, to_user_id FROM {ALL_TRANSACTIONS} t WHERE id = ?",
+        (transaction_id,),
+    )
+    return {row.from_user_id, row.to_user_id} if row else set()
+
+
+async def update_transaction(transaction_id: str, **kwargs) -> Transaction:
+    if "timestamp" in kwargs:
+        kwargs["timestamp"] = _timestamp_value(kwargs["timestamp"])
+    values = _update_values(TRANSACTION_FIELDS, transaction_id, kwargs)
+    async with db.connect() as conn:
+        user_ids = await _transaction_user_ids(transaction_id, conn)
+        await roll_up_transactions([transaction_id], -1, conn)
+        # the live table first, archived transactions are the rare case
+        for table in TRANSACTION_TABLES:
+            row = await conn.fetchone(UPDATE_TRANSACTION[table], values)
+            if row:
+                break
+        if row and "from_user_id" in kwargs:
+            await conn.execute(
+                f"""
+                UPDATE merchantpill.{table} SET wallet = (
+                    SELECT wallet FROM merchantpill.maintable WHERE id = ?
+                ) WHERE id = ?
+                """,
+                (row.from_user_id, transaction_id),
+            )
+        await roll_up_transactions([transaction_id], 1, conn)
+        if row:
+            user_ids |= {row.from_user_id, row.to_user_id}
+        user_ids.discard(None)
+        await refresh_balances(list(user_ids), conn=conn)
+        await _log_transaction_change(transaction_id, conn)
+    assert row, "Newly updated transaction couldn't be retrieved"
+    return Transaction.from_row(row)
+
+
+async def delete_transaction(transaction_id: str) -> None:
+    async with db.connect() as conn:
+        # logged while the row is still there to find the wallet
+        await _log_transaction_change(transaction_id, conn)
+        await roll_up_transactions([transaction_id], -1, conn)
+        user_ids = await _transaction_user_ids(transaction_id, conn)
+        for table in TRANSACTION_TABLES:
+            await conn.execute(
+                f"DELETE FROM merchantpill.{table} WHERE id = ?", (transaction_id,)
+            )
+        user_ids.discard(None)
+        await refresh_balances(list(user_ids), conn=conn)
+
+
+async def archive_transactions(before: datetime, limit: int) -> int:
+    """
+    Moves up to `limit` of the oldest transactions from before `before` to the
+    archive, returns how many. Each call is one short write transaction, so
+    callers work through a backlog a batch at a time.
+    """
+    async with db.connect() as conn:
+        rows = await conn.fetchall(
+            """
+            SELECT id FROM merchantpill."transaction"
+            WHERE timestamp < ? ORDER BY timestamp LIMIT ?
+            """,
+            (before.strftime("%Y-%m-%d %H:%M:%S"), limit),
+        )
+        if not rows:
+            return 0
+        ids = [row.id for row in rows]
+        q = ",".join(["?"] * len(ids))
+        await conn.execute(
+            f"""
+            INSERT INTO merchantpill.transaction_archive ({TRANSACTION_COLUMNS})
+            SELECT {TRANSACTION_COLUMNS} FROM merchantpill."transaction"
+            WHERE id IN ({q})
+            """,
+            ids,
+        )
+        await conn.execute(
+            f'DELETE FROM merchantpill."transaction" WHERE id IN ({q})', ids
+        )
+    return len(ids)
+
+
+async def apply_ledger_payment(
+    user_id: str,
+    amount: int,
+    withdraw: bool = False,
+    currency: Optional[str] = None,
+    checking_id: Optional[str] = None,
+    payment_hash: Optional[str] = None,
+    fiat_amount: Optional[int] = None,
+) -> Optional[User]:
+    """
+    Credit (or debit, for withdraws) a paid invoice to a user, bump the debt it
+    pays off, record the transaction and roll it into the balance table. The
+    increments are done in SQL inside a single DB transaction, so concurrent
+    payments to the same user can't lose updates. With a `checking_id` the
+    payment is recorded as processed in the same transaction, and one that was
+    already applied returns None like an unknown user does. `fiat_amount` is
+    the payment's value in `currency`, converted by the caller.
+    """
+    delta = -amount if withdraw else amount
+    transaction_id = urlsafe_short_hash()
+    async with db.connect() as conn:
+        if checking_id:
+            claimed = await conn.fetchone(
+                """
+                INSERT INTO merchantpill.processed_payment (checking_id, payment_hash, user_id)
+                VALUES (?, ?, ?) ON CONFLICT (checking_id) DO NOTHING
+                RETURNING checking_id
+                """,
+                (checking_id, payment_hash, user_id),
+            )
+            if not claimed:
+                return None
+        row = await conn.fetchone(
+            """
+            UPDATE merchantpill.maintable SET total = total + ?
+            WHERE id = ? RETURNING *
+            """,
+            (delta, user_id),
+        )
+        if not row:
+            return None
+        user = User.from_row(row)
+        debt = None
+        if user.debt_id:
+            debt = await conn.fetchone(
+                """
+                UPDATE merchantpill.debt SET debtPaid = debtPaid + ? WHERE id = ?
+                RETURNING inviter_id, debtOutstanding - debtPaid AS outstanding
+                """,
+                (amount, user.debt_id),
+            )
+        debt_outstanding = debt.outstanding if debt else None
+        await conn.execute(
+            """
+            INSERT INTO merchantpill."transaction"
+            (id, from_user_id, wallet, to_user_id, amount, currency, fiat_amount)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                transaction_id,
+                user_id,
+                user.wallet,
+                user.invited_by,
+                amount,
+                currency,
+                fiat_amount,
+            ),
+        )
+        await roll_up_transactions([transaction_id], 1, conn)
+        await _roll_up_transfer(
+            conn, user_id, user.invited_by, amount, debt_outstanding
+        )
+        await log_changes(
+            [("user", user_id, user_id), ("transaction", transaction_id, user_id)],
+            conn,
+        )
+    merchantpill_cache.pop(user_id)
+    if debt:
+        engine = netting_engines.get(user.wallet)
+        if engine:
+            engine.set_edge(user_id, debt.inviter_id, debt.outstanding)
+        else:
+            # a load of this wallet's engine in flight read the old debt
+            netting_engines.pop(user.wallet)
+    return user
+
+
+## Paid invoices missed while the invoice listener was down, read from the
+## lnbits payments. Already applied ones are filtered out by processed_payment.
+
+
+def _core_epoch(column: str) -> str:
+    # lnbits stores apipayments times as epoch integers on SQLite
+    if core_db.type == "SQLITE":
+        return column
+    return f"CAST(FLOOR(EXTRACT(EPOCH FROM {column})) AS BIGINT)"
+
+
+async def get_settled_payments(
+    since: int, after: Optional[Tuple[int, str]], limit: int
+) -> Tuple[List[Payment], Optional[Tuple[int, str]]]:
+    """
+    Settled incoming MerchantPill payments after `since` (epoch), oldest first,
+    keyset on (time, checking_id) from `after`. Returns the key to continue from.
+    """
+    epoch = _core_epoch("time")
+    where = ""
+    values: tuple = ("%MerchantPill%", since)
+    if after:
+        where = f"AND ({epoch} > ? OR ({epoch} = ? AND checking_id > ?))"
+        values += (after[0], after[0], after[1])
+    rows = await core_db.fetchall(
+        f"""
+        SELECT *, {epoch} AS sort_time FROM apipayments
+        WHERE amount > 0 AND pending = false AND extra LIKE ?
+        AND {epoch} > ? {where}
+        ORDER BY sort_time, checking_id LIMIT ?
+        """,
+        (*values, limit),
+    )
+    if not rows:
+        return [], after
+    last = rows[-1]
+    return [Payment.from_row(row) for row in rows], (
+        int(last.sort_time),
+        last.checking_id,
+    )
+
+
+async def get_payment_watermark(margin: int) -> Optional[int]:
+    """
+    Epoch from which payments may not have been applied yet: `margin` seconds
+    before the newest processed payment, but never before idempotent payment
+    processing was installed (m019), nothing recorded what was applied earlier.
+    """
+    if db.type == "SQLITE":
+        newest = "CAST(strftime('%s', MAX(timestamp)) AS INTEGER)"
+    else:
+        newest = "CAST(FLOOR(EXTRACT(EPOCH FROM MAX(timestamp))) AS BIGINT)"
+    row = await db.fetchone(
+        f"""
+        SELECT {newest} AS newest,
+        (SELECT since FROM merchantpill.backfill_floor) AS floor
+        FROM merchantpill.processed_payment
+        """
+    )
+    marks = [row.floor, row.newest - margin if row.newest is not None else None]
+    return max((mark for mark in marks if mark is not None), default=None)
+
+
+async def get_processed_payments(checking_ids: List[str]) -> Set[str]:
+    if not checking_ids:
+        return set()
+    q = ",".join(["?"] * len(checking_ids))
+    rows = await db.fetchall(
+        f"""
+        SELECT checking_id FROM merchantpill.processed_payment
+        WHERE checking_id IN ({q})
+        """,
+        (*checking_ids,),
+    )
+    return {row.checking_id for row in rows}
+
+
+## Balance rollup, one row per user, kept in step by the ledger writes in their
+## own transaction
+
+# (total_in, total_out, debt_outstanding, user_id, debt_outstanding), a NULL
+# debt_outstanding leaves the stored value alone
+UPSERT_BALANCE = """
+    INSERT INTO merchantpill.balance AS b
+    (user_id, wallet, total_in, total_out, debt_outstanding, last_activity)
+    SELECT id, wallet, ?, ?, COALESCE(?, 0), CURRENT_TIMESTAMP
+    FROM merchantpill.maintable WHERE id = ?
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_in = b.total_in + excluded.total_in,
+        total_out = b.total_out + excluded.total_out,
+        debt_outstanding = COALESCE(?, b.debt_outstanding),
+        last_activity = excluded.last_activity
+"""
+
+# (payee_id, amount, payer_id, amount, payer_id, debt_outstanding, payer_id,
+# payee_id, payer_id, debt_outstanding), UPSERT_BALANCE for both ends of a
+# transaction in one statement, see _roll_up_transfer
+UPSERT_TRANSFER_BALANCES = """
+    INSERT INTO merchantpill.balance AS b
+    (user_id, wallet, total_in, total_out, debt_outstanding, last_activity)
+    SELECT id, wallet,
+        CASE WHEN id = ? THEN ? ELSE 0 END,
+        CASE WHEN id = ? THEN ? ELSE 0 END,
+        CASE WHEN id = ? THEN COALESCE(?, 0) ELSE 0 END,
+        CURRENT_TIMESTAMP
+    FROM merchantpill.maintable WHERE id IN (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_in = b.total_in + excluded.total_in,
+        total_out = b.total_out + excluded.total_out,
+        debt_outstanding = CASE WHEN excluded.user_id = ?
+            THEN COALESCE(?, b.debt_outstanding) ELSE b.debt_outstanding END,
+        last_activity = excluded.last_activity
+"""
+
+
+async def _roll_up_transfer(
+    conn: Connection,
+    payer_id: str,
+    payee_id: Optional[str],
+    amount: int,
+    debt_outstanding: Optional[int] = None,
+) -> None:
+    """Rolls `amount` into the payer's total_out and the payee's (if any) total_in."""
+    await conn.execute(
+        UPSERT_TRANSFER_BALANCES,
+        (
+            payee_id,
+            amount,
+            payer_id,
+            amount,
+            payer_id,
+            debt_outstanding,
+            payer_id,
+            payee_id,
+            payer_id,
+            debt_outstanding,
+        ),
+    )
+
+
+async def _add_balances(user_ids: List[str], conn: Connection) -> None:
+    """Rollup rows of new users, who have no transactions to sum yet."""
+    q = ",".join(["?"] * len(user_ids))
+    await conn.execute(
+        f"""
+        INSERT INTO merchantpill.balance
+        (user_id, wallet, total_in, total_out, debt_outstanding)
+        SELECT u.id, u.wallet, 0, 0, COALESCE(
+            (SELECT d.debtOutstanding - d.debtPaid FROM merchantpill.debt d WHERE d.id = u.debt_id), 0
+        )
+        FROM merchantpill.maintable u WHERE u.id IN ({q})
+        """,
+        tuple(user_ids),
+    )
+
+
+def _per_table_sum(column: str) -> str:
+    """
+    SUM(amount) of u.id's transactions by `column`, one subquery per table.
+    SQLite doesn't push the correlated predicate into ALL_TRANSACTIONS, it
+    would scan both tables for each user.
+    """
+    return " + ".join(
+        f"COALESCE((SELECT SUM(t.amount) FROM merchantpill.{table} t WHERE t.{column} = u.id), 0)"
+        for table in TRANSACTION_TABLES
+    )
+
+
+async def refresh_balances(
+    user_ids: Optional[List[str]] = None, conn: Optional[Connection] = None
+) -> None:
+    """
+    Recomputes rollup rows from the transaction and debt tables, for every user
+    when `user_ids` is None (backfill).
+    """
+    if user_ids is not None and not user_ids:
+        return
+    delete_where, where, values = "", "", ()
+    if user_ids is not None:
+        q = ",".join(["?"] * len(user_ids))
+        delete_where, where = f"WHERE user_id IN ({q})", f"WHERE u.id IN ({q})"
+        values = tuple(user_ids)
+    last_activity = " UNION ALL ".join(
+        f"SELECT MAX(timestamp) AS timestamp FROM merchantpill.{table} WHERE {column} = u.id"
+        for table in TRANSACTION_TABLES
+        for column in ("from_user_id", "to_user_id")
+    )
+    async with (db.reuse_conn(conn) if conn else db.connect()) as conn:
+        await conn.execute(f"DELETE FROM merchantpill.balance {delete_where}", values)
+        await conn.execute(
+            f"""
+            INSERT INTO merchantpill.balance
+            (user_id, wallet, total_in, total_out, debt_outstanding, last_activity)
+            SELECT u.id, u.wallet, {_per_table_sum("to_user_id")}, {_per_table_sum("from_user_id")},
+                COALESCE((SELECT d.debtOutstanding - d.debtPaid FROM merchantpill.debt d WHERE d.id = u.debt_id), 0),
+                (SELECT MAX(last.timestamp) FROM ({last_activity}) last)
+            FROM merchantpill.maintable u {where}
+            """,
+            values,
+        )
+
+
+async def get_balances(
+    wallet_ids: Union[str, List[str]],
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> CursorPage:
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return CursorPage(data=[], next_cursor=None)
+
+    where, values = "wallet IN ({wallets})", []
+    if cursor:
+        where += " AND user_id > ?"
+        values += decode_cursor(cursor, 1)
+    rows = await _fetch_by_wallet(
+        f"SELECT * FROM merchantpill.balance WHERE {where} ORDER BY user_id LIMIT ?",
+        wallet_ids,
+        (*values, limit + 1),
+        limit=limit + 1,
+        key=lambda row: (row.user_id,),
+    )
+    balances = [Balance.from_row(row) for row in rows]
+    next_cursor = _page(balances, limit, lambda balance: (balance.user_id,))
+    return CursorPage(data=balances, next_cursor=next_cursor)
+
+
+## Daily transaction rollup, one row per user, direction ('out' paid by the
+## user, 'in' credited to them as inviter) and day, kept in step by the
+## transaction writes. Reports group the days into buckets, so a year is ~365
+## rows per user however many transactions it had.
+
+REPORT_INTERVALS = ("day", "week", "month")
+
+
+def _day(column: str) -> str:
+    """SQL for the day of a timestamp column as YYYY-MM-DD."""
+    if db.type == "SQLITE":
+        return f"date({column})"
+    return f"to_char({column}, 'YYYY-MM-DD')"
+
+
+def _report_bucket(interval: str) -> str:
+    """SQL for the first day of the bucket a rollup day falls in, weeks start on Monday."""
+    if interval == "month":
+        return "substr(day, 1, 7) || '-01'"
+    if interval == "week":
+        if db.type == "SQLITE":
+            return "date(day, '-6 days', 'weekday 1')"
+        return "to_char(date_trunc('week', CAST(day AS DATE)), 'YYYY-MM-DD')"
+    return "day"
+
+
+async def roll_up_transactions(
+    transaction_ids: List[str], sign: int, conn: Connection
+) -> None:
+    """Adds (sign 1) or takes back (sign -1) the transactions' share of the rollup."""
+    day = _day("timestamp")
+    await conn.execute(
+        f"""
+        INSERT INTO merchantpill.transaction_daily AS r
+        (user_id, direction, day, count, amount)
+        SELECT from_user_id, 'out', {day}, ?, ? * COALESCE(amount, 0)
+        FROM {ALL_TRANSACTIONS} t WHERE id = ?
+        UNION ALL
+        SELECT to_user_id, 'in', {day}, ?, ? * COALESCE(amount, 0)
+        FROM {ALL_TRANSACTIONS} t WHERE id = ? AND to_user_id IS NOT NULL
+        ON CONFLICT (user_id, direction, day) DO UPDATE SET
+            count = r.count + excluded.count,
+            amount = r.amount + excluded.amount
+        """,
+        [(sign, sign, id, sign, sign, id) for id in transaction_ids],
+    )
+
+
+async def get_transaction_report(
+    interval: str,
+    start: date,
+    end: date,
+    user_id: Optional[str] = None,
+    inviter_id: Optional[str] = None,
+    wallet_id: Optional[str] = None,
+) -> List[ReportBucket]:
+    """
+    Count and amount per bucket for days in [start, end): paid by `user_id`,
+    credited to `inviter_id`, or else paid by all users of `wallet_id`.
+    """
+    if interval not in REPORT_INTERVALS:
+        raise ValueError(f"interval is one of {', '.join(REPORT_INTERVALS)}.")
+    if user_id:
+        where, values = "user_id = ? AND direction = 'out'", [user_id]
+    elif inviter_id:
+        where, values = "user_id = ? AND direction = 'in'", [inviter_id]
+    else:
+        where = """direction = 'out' AND user_id IN (
+            SELECT id FROM merchantpill.maintable WHERE wallet = ?
+        )"""
+        values = [wallet_id]
+    bucket = _report_bucket(interval)
+    rows = await db.fetchall(
+        f"""
+        SELECT {bucket} AS bucket, SUM(count) AS count, SUM(amount) AS amount
+        FROM merchantpill.transaction_daily
+        WHERE {where} AND day >= ? AND day < ?
+        GROUP BY {bucket} HAVING SUM(count) > 0 ORDER BY bucket
+        """,
+        (*values, start.isoformat(), end.isoformat()),
+    )
+    return [ReportBucket(**dict(row)) for row in rows]
+
+
+## Referral tree, a closure table over maintable.invited_by holding a row for
+## every ancestor/descendant pair plus a depth 0 row per user, so lookups at any
+## depth are a single query. Writers keep it in step inside their transaction.
+
+
+async def add_referral_paths(
+    users: List[Tuple[str, Optional[str]]], conn: Connection
+) -> None:
+    """Adds new leaf users, given as (user_id, invited_by) pairs."""
+    await conn.execute(
+        """
+        INSERT INTO merchantpill.referral (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, ?, depth + 1 FROM merchantpill.referral WHERE descendant_id = ?
+        UNION ALL SELECT ?, ?, 0
+        """,
+        [(user_id, parent_id, user_id, user_id) for user_id, parent_id in users],
+    )
+
+
+async def move_referral(
+    user_id: str, parent_id: Optional[str], conn: Connection
+) -> None:
+    """Re-parents a user together with everyone downstream of them."""
+    if parent_id:
+        cycle = await conn.fetchone(
+            """
+            SELECT 1 FROM merchantpill.referral
+            WHERE ancestor_id = ? AND descendant_id = ?
+            """,
+            (user_id, parent_id),
+        )
+        if cycle:
+            raise ValueError("A user can't be invited by someone they invited.")
+    # cut the subtree loose from its current ancestors
+    await conn.execute(
+        """
+        DELETE FROM merchantpill.referral
+        WHERE descendant_id IN (
+            SELECT descendant_id FROM merchantpill.referral WHERE ancestor_id = ?
+        )
+        AND ancestor_id NOT IN (
+            SELECT descendant_id FROM merchantpill.referral WHERE ancestor_id = ?
+        )
+        """,
+        (user_id, user_id),
+    )
+    if parent_id:
+        await conn.execute(
+            """
+            INSERT INTO merchantpill.referral (ancestor_id, descendant_id, depth)
+            SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+            FROM merchantpill.referral a, merchantpill.referral d
+            WHERE a.descendant_id = ? AND d.ancestor_id = ?
+            """,
+            (parent_id, user_id),
+        )
+
+
+async def remove_referral(user_id: str, conn: Connection) -> None:
+    """Drops a user from the tree, the people they invited become roots."""
+    await conn.execute(
+        """
+        DELETE FROM merchantpill.referral
+        WHERE descendant_id IN (
+            SELECT descendant_id FROM merchantpill.referral WHERE ancestor_id = ?
+        )
+        AND ancestor_id IN (
+            SELECT ancestor_id FROM merchantpill.referral WHERE descendant_id = ?
+        )
+        """,
+        (user_id, user_id),
+    )
+
+
+async def get_referral_descendants(
+    user_id: str, limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None
+) -> CursorPage:
+    where, values = "r.ancestor_id = ? AND r.depth > 0", [user_id]
+    if cursor:
+        where += " AND (r.depth, u.id) > (?, ?)"
+        values += decode_cursor(cursor, 2)
+    rows = await db.fetchall(
+        f"""
+        SELECT u.*, r.depth FROM merchantpill.referral r
+        JOIN merchantpill.maintable u ON u.id = r.descendant_id
+        WHERE {where}
+        ORDER BY r.depth, u.id LIMIT ?
+        """,
+        (*values, limit + 1),
+    )
+    users = [ReferralUser(**dict(row)) for row in rows]
+    next_cursor = _page(users, limit, lambda user: (user.depth, user.id))
+    return CursorPage(data=users, next_cursor=next_cursor)
+
+
+async def get_referral_ancestors(user_id: str) -> List[ReferralUser]:
+    """The invite chain up to the root, nearest inviter first."""
+    rows = await db.fetchall(
+        """
+        SELECT u.*, r.depth FROM merchantpill.referral r
+        JOIN merchantpill.maintable u ON u.id = r.ancestor_id
+        WHERE r.descendant_id = ? AND r.depth > 0
+        ORDER BY r.depth
+        """,
+        (user_id,),
+    )
+    return [ReferralUser(**dict(row)) for row in rows]
+
+
+async def get_referral_totals(user_id: str) -> ReferralTotals:
+    """Aggregates over everyone downstream of a user."""
+    row = await db.fetchone(
+        """
+        SELECT COUNT(*) AS users,
+            COALESCE(SUM(u.total), 0) AS total,
+            COALESCE(SUM(b.total_out), 0) AS paid,
+            COALESCE(SUM(b.debt_outstanding), 0) AS debt_outstanding,
+            COALESCE(MAX(r.depth), 0) AS depth
+        FROM merchantpill.referral r
+        JOIN merchantpill.maintable u ON u.id = r.descendant_id
+        LEFT JOIN merchantpill.balance b ON b.user_id = r.descendant_id
+        WHERE r.ancestor_id = ? AND r.depth > 0
+        """,
+        (user_id,),
+    )
+    return ReferralTotals(user_id=user_id, **dict(row))
+
+
+## Change log, every write to maintable and transaction appends (entity, id,
+## wallet) with an increasing version. Clients pass the last version they saw
+## and get back only what changed since; rows that no longer exist were deleted.
+## Versions come from the single changelog_version row, which a writer holds
+## locked until it commits. A later writer can only take the next versions once
+## the earlier one committed, so every version up to the counter is visible and
+## a client never skips over one committed late. The bump is part of the
+## change log insert: on postgres in the same statement, on SQLite (one writer at
+## a time) by a trigger on changelog.
+
+CHANGES_MAX = 1000
+CHANGELOG_MAX_AGE_DAYS = 7
+
+
+async def log_changes(
+    changes: List[Tuple[str, str, Optional[str]]], conn: Connection
+) -> None:
+    """Logs (entity, entity_id, owner user id) changes, the wallet is looked up."""
+    if not changes:
+        return
+    if db.type == "SQLITE":
+        # each row takes the next version, the changelog_version_bump trigger
+        # moves the counter to it
+        await conn.execute(
+            """
+            INSERT INTO merchantpill.changelog (version, entity, entity_id, wallet)
+            VALUES (
+                (SELECT version + 1 FROM merchantpill.changelog_version), ?, ?,
+                (SELECT wallet FROM merchantpill.maintable WHERE id = ?)
+            )
+            """,
+            list(changes),
+        )
+        return
+    rows = ", ".join(["(?, ?, ?, ?)"] * len(changes))
+    await conn.execute(
+        f"""
+        WITH bumped AS (
+            UPDATE merchantpill.changelog_version SET version = version + ?
+            RETURNING version
+        )
+        INSERT INTO merchantpill.changelog (version, entity, entity_id, wallet)
+        SELECT bumped.version - ? + c.n, c.entity, c.entity_id,
+            (SELECT wallet FROM merchantpill.maintable WHERE id = c.owner)
+        FROM bumped, (VALUES {rows}) AS c (n, entity, entity_id, owner)
+        """,
+        (
+            len(changes),
+            len(changes),
+            *(value for n, change in enumerate(changes, 1) for value in (n, *change)),
+        ),
+    )
+
+
+async def _log_transaction_change(transaction_id: str, conn: Connection) -> None:
+    """Logs a change to a live or archived transaction, owned by its payer."""
+    if db.type == "SQLITE":
+        # the changelog_version_bump trigger moves the counter to it
+        bumped = "SELECT version + 1 AS version FROM merchantpill.changelog_version"
+    else:
+        bumped = """
+            UPDATE merchantpill.changelog_version SET version = version + 1
+            RETURNING version
+        """
+    await conn.execute(
+        f"""
+        WITH bumped AS ({bumped})
+        INSERT INTO merchantpill.changelog (version, entity, entity_id, wallet)
+        SELECT bumped.version, 'transaction', t.id, t.wallet
+        FROM bumped, {ALL_TRANSACTIONS} t WHERE t.id = ?
+        """,
+        (transaction_id,),
+    )
+
+
+async def get_change_version() -> int:
+    """The newest version whose changes are all committed."""
+    row = await db.fetchone("SELECT version FROM merchantpill.changelog_version")
+    return row.version if row else 0
+
+
+async def get_changes(wallet_ids: List[str], since: int) -> dict:
+    """
+    Users and transactions of the wallets changed after version `since`. When
+    the client is too far behind (pruned log or too many changes) `reset` is set
+    and it should reload everything.
+    """
+    version = await get_change_version()
+    changes = {
+        "version": version,
+        "reset": False,
+        "users": [],
+        "deleted_users": [],
+        "transactions": [],
+        "deleted_transactions": [],
+    }
+    if not wallet_ids or since >= version:
+        return changes
+
+    oldest = await db.fetchone("SELECT MIN(version) FROM merchantpill.changelog")
+    rows = await _fetch_by_wallet(
+        """
+        SELECT DISTINCT entity, entity_id FROM merchantpill.changelog
+        WHERE wallet IN ({wallets}) AND version > ? AND version <= ?
+        LIMIT ?
+        """,
+        wallet_ids,
+        (since, version, CHANGES_MAX + 1),
+    )
+    # an entity that moved between two chunks' wallets shows up in both
+    rows = list({(row.entity, row.entity_id): row for row in rows}.values())
+    if since < (oldest[0] or 0) - 1 or len(rows) > CHANGES_MAX:
+        changes["reset"] = True
+        return changes
+
+    user_ids = [row.entity_id for row in rows if row.entity == "user"]
+    if user_ids:
+        q_ids = ",".join(["?"] * len(user_ids))
+        users = [
+            User.from_row(row)
+            for row in await db.fetchall(
+                f"SELECT * FROM merchantpill.maintable WHERE id IN ({q_ids})",
+                (*user_ids,),
+            )
+        ]
+        # moved to a wallet the client isn't looking at counts as deleted
+        wallets = set(wallet_ids)
+        changes["users"] = [user for user in users if user.wallet in wallets]
+        kept = {user.id for user in changes["users"]}
+        changes["deleted_users"] = [id for id in user_ids if id not in kept]
+
+    transaction_ids = [row.entity_id for row in rows if row.entity == "transaction"]
+    if transaction_ids:
+        q_ids = ",".join(["?"] * len(transaction_ids))
+        changes["transactions"] = [
+            Transaction.from_row(row)
+            for row in await db.fetchall(
+                f"SELECT * FROM {ALL_TRANSACTIONS} t WHERE id IN ({q_ids})",
+                (*transaction_ids,),
+            )
+        ]
+        kept = {transaction.id for transaction in changes["transactions"]}
+        changes["deleted_transactions"] = [
+            id for id in transaction_ids if id not in kept
+        ]
+    return changes
+
+
+async def prune_changelog(max_age_days: int = CHANGELOG_MAX_AGE_DAYS) -> None:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    # the newest entry always stays, it anchors the version for clients
     await db.execute(
-        "DELETE FROM merchantpill.maintable WHERE id = ?", (merchantpill_id,)
+        """
+        DELETE FROM merchantpill.changelog WHERE timestamp < ?
+        AND version < (SELECT MAX(version) FROM merchantpill.changelog)
+        """,
+        (cutoff.strftime("%Y-%m-%d %H:%M:%S"),),
     )
+
+
+## Bulk payouts. Items are claimed in batches (pending -> paying) before they are
+## paid, and settled in batches: the statuses and the users' totals are written
+## in one transaction. Items a crash left in paying are checked against lnbits by
+## the next run, see payouts.py.
+
+PAYOUT_USER_CHUNK = 500
+
+
+async def get_wallet_user_ids(wallet_id: str, user_ids: List[str]) -> Set[str]:
+    """Those of `user_ids` that are users of the wallet."""
+    found: Set[str] = set()
+    unique = sorted(set(user_ids))
+    for start in range(0, len(unique), PAYOUT_USER_CHUNK):
+        chunk = unique[start : start + PAYOUT_USER_CHUNK]
+        q = ",".join(["?"] * len(chunk))
+        rows = await db.fetchall(
+            f"SELECT id FROM merchantpill.maintable WHERE wallet = ? AND id IN ({q})",
+            (wallet_id, *chunk),
+        )
+        found.update(row.id for row in rows)
+    return found
+
+
+async def create_payout_job(
+    wallet_id: str, items: List[Tuple[str, int, str, str]]
+) -> PayoutJob:
+    """Items are (user_id, amount in sat, invoice, payment_hash)."""
+    job_id = urlsafe_short_hash()
+    async with db.connect() as conn:
+        await conn.execute(
+            "INSERT INTO merchantpill.payout_job (id, wallet) VALUES (?, ?)",
+            (job_id, wallet_id),
+        )
+        await conn.execute(
+            """
+            INSERT INTO merchantpill.payout_item
+            (id, job_id, user_id, amount, invoice, payment_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            _rewrite_rows(
+                conn, [(urlsafe_short_hash(), job_id, *item) for item in items]
+            ),
+        )
+    job = await get_payout_job(job_id)
+    assert job, "Newly created payout job couldn't be retrieved"
+    return job
+
+
+async def get_payout_job(job_id: str) -> Optional[PayoutJob]:
+    row = await db.fetchone(
+        "SELECT * FROM merchantpill.payout_job WHERE id = ?", (job_id,)
+    )
+    if not row:
+        return None
+    job = PayoutJob.from_row(row)
+    rows = await db.fetchall(
+        """
+        SELECT status, COUNT(*) AS count FROM merchantpill.payout_item
+        WHERE job_id = ? GROUP BY status
+        """,
+        (job_id,),
+    )
+    job.items = {row.status: row.count for row in rows}
+    return job
+
+
+async def get_running_payout_jobs() -> List[PayoutJob]:
+    rows = await db.fetchall(
+        "SELECT * FROM merchantpill.payout_job WHERE status = 'running'"
+    )
+    return [PayoutJob.from_row(row) for row in rows]
+
+
+async def get_payout_items(
+    job_id: str,
+    status: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+) -> CursorPage:
+    where, values = "job_id = ?", [job_id]
+    if status:
+        where += " AND status = ?"
+        values.append(status)
+    if cursor:
+        where += " AND id > ?"
+        values += decode_cursor(cursor, 1)
+    rows = await db.fetchall(
+        f"""
+        SELECT * FROM merchantpill.payout_item WHERE {where}
+        ORDER BY id LIMIT ?
+        """,
+        (*values, limit + 1),
+    )
+    items = [PayoutItem.from_row(row) for row in rows]
+    next_cursor = _page(items, limit, lambda item: (item.id,))
+    return CursorPage(data=items, next_cursor=next_cursor)
+
+
+async def claim_payout_items(job_id: str, limit: int) -> List[PayoutItem]:
+    """Moves up to `limit` pending items to paying and returns them."""
+    rows = await db.fetchall(
+        """
+        UPDATE merchantpill.payout_item SET status = 'paying'
+        WHERE status = 'pending' AND id IN (
+            SELECT id FROM merchantpill.payout_item
+            WHERE job_id = ? AND status = 'pending' ORDER BY id LIMIT ?
+        )
+        RETURNING *
+        """,
+        (job_id, limit),
+    )
+    return [PayoutItem.from_row(row) for row in rows]
+
+
+async def settle_payout_items(paid: List[str], failed: List[Tuple[str, str]]) -> None:
+    """
+    Marks the `paid` items paid and takes their amounts off the users' totals
+    (msat, like the rest of the ledger), and the (item_id, error) ones failed.
+    Only items still in paying are settled, so a batch applied twice debits once.
+    Each paid item is recorded as a transaction and rolled into the balances.
+    """
+    if not paid and not failed:
+        return
+    totals: dict = {}
+    async with db.connect() as conn:
+        transactions = []
+        if paid:
+            q = ",".join(["?"] * len(paid))
+            rows = await conn.fetchall(
+                f"""
+                UPDATE merchantpill.payout_item SET status = 'paid', error = NULL
+                WHERE id IN ({q}) AND status = 'paying' RETURNING user_id, amount
+                """,
+                tuple(paid),
+            )
+            for row in rows:
+                totals[row.user_id] = totals.get(row.user_id, 0) + row.amount * 1000
+                transactions.append(
+                    (urlsafe_short_hash(), row.user_id, row.amount * 1000)
+                )
+        if totals:
+            await conn.execute(
+                "UPDATE merchantpill.maintable SET total = total - ? WHERE id = ?",
+                [(amount, user_id) for user_id, amount in totals.items()],
+            )
+            await conn.execute(
+                """
+                INSERT INTO merchantpill."transaction" (id, from_user_id, wallet, amount)
+                VALUES (?, ?, (SELECT wallet FROM merchantpill.maintable WHERE id = ?), ?)
+                """,
+                [
+                    (transaction_id, user_id, user_id, amount)
+                    for transaction_id, user_id, amount in transactions
+                ],
+            )
+            await roll_up_transactions([row[0] for row in transactions], 1, conn)
+            await conn.execute(
+                UPSERT_BALANCE,
+                [
+                    (0, amount, None, user_id, None)
+                    for user_id, amount in totals.items()
+                ],
+            )
+            await log_changes(
+                [("user", user_id, user_id) for user_id in totals]
+                + [
+                    ("transaction", transaction_id, user_id)
+                    for transaction_id, user_id, _ in transactions
+                ],
+                conn,
+            )
+        if failed:
+            await conn.execute(
+                """
+                UPDATE merchantpill.payout_item SET status = 'failed', error = ?
+                WHERE id = ? AND status = 'paying'
+                """,
+                _rewrite_rows(conn, [(error, item_id) for item_id, error in failed]),
+            )
+    for user_id in totals:
+        merchantpill_cache.pop(user_id)
+
+
+async def release_payout_items(item_ids: List[str]) -> None:
+    """Puts paying items that never reached lnbits back to pending."""
+    if not item_ids:
+        return
+    await db.execute(
+        """
+        UPDATE merchantpill.payout_item SET status = 'pending'
+        WHERE id = ? AND status = 'paying'
+        """,
+        [(item_id,) for item_id in item_ids],
+    )
+
+
+async def finish_payout_job(job_id: str) -> bool:
+    """Marks the job done unless items are still pending or paying."""
+    row = await db.fetchone(
+        """
+        UPDATE merchantpill.payout_job SET status = 'done'
+        WHERE id = ? AND NOT EXISTS (
+            SELECT 1 FROM merchantpill.payout_item
+            WHERE job_id = ? AND status IN ('pending', 'paying')
+        )
+        RETURNING id
+        """,
+        (job_id, job_id),
+    )
+    return bool(row)
+
+
+instrument_crud(globals())
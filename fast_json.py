@@ -0,0 +1,43 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # not an lnbits dependency, used when it is installed
+    orjson = None
+
+# List endpoints hand their content to FastJSONResponse, which encodes it in one
+# pass straight to bytes instead of FastAPI's jsonable_encoder walk followed by
+# json.dumps. The models in list responses are flat, so vars(model) already is
+# their JSON object and they go in without a .dict() copy.
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(
+        content,
+        default=_default,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+from lnbits.utils.exchange_rates import allowed_currencies, btc_price
+
+# Rates are sats per unit of fiat, kept per currency and refreshed in the
+# background. Paid invoices only ever read the cached rate, they never wait on
+# an exchange. Reports refetch a rate older than the TTL on use, but not within
+# FIAT_RATE_RETRY of a failed fetch. When the source is down the last rate is
+# still used until FIAT_RATE_MAX_AGE, after that amounts are left unconverted
+# (NULL) rather than converted at a made up rate.
+#
+# MERCHANTPILL_FIAT_RATE_SOURCE is "lnbits" (the exchanges lnbits averages) or
+# "file:<path>" pointing at a JSON object like {"EUR": 1650.5}, for tests and
+# setups without outbound access.
+#
+# Only the currencies lnbits offers (narrowed by its allowed currencies setting)
+# are looked up, the caches are keyed by the code and callers pass it in from
+# the query string.
+
+FIAT_CURRENCY = os.getenv("MERCHANTPILL_FIAT_CURRENCY", "EUR").upper()
+FIAT_RATE_SOURCE = os.getenv("MERCHANTPILL_FIAT_RATE_SOURCE", "lnbits")
+FIAT_RATE_TTL = int(os.getenv("MERCHANTPILL_FIAT_RATE_TTL", "300"))
+FIAT_RATE_MAX_AGE = int(os.getenv("MERCHANTPILL_FIAT_RATE_MAX_AGE", "3600"))
+FIAT_RATE_RETRY = int(os.getenv("MERCHANTPILL_FIAT_RATE_RETRY", "30"))
+
+
+class RateSource(ABC):
+    @abstractmethod
+    async def fetch(self, currency: str) -> float:
+        """Sats per unit of `currency`, raises when it can't be had."""
+
+
+class LnbitsRateSource(RateSource):
+    async def fetch(self, currency: str) -> float:
+        price = await btc_price(currency)
+        # btc_price's answer when every provider failed
+        if price >= 9999999999:
+            raise ValueError(f"no exchange rate for {currency}")
+        return 100_000_000 / price
+
+
+class FileRateSource(RateSource):
+    def __init__(self, path: str):
+        self.path = path
+
+    async def fetch(self, currency: str) -> float:
+        with open(self.path) as f:
+            rates = json.load(f)
+        if currency not in rates:
+            raise ValueError(f"no exchange rate for {currency} in {self.path}")
+        return float(rates[currency])
+
+
+def supported_currency(currency: str) -> str:
+    """The upper cased code, raises ValueError when lnbits doesn't offer it."""
+    code = currency.upper()
+    if code not in {item.upper() for item in allowed_currencies()}:
+        raise ValueError(f"Currency {currency} is not supported.")
+    return code
+
+
+def rate_source(setting: str) -> RateSource:
+    if setting.startswith("file:"):
+        return FileRateSource(setting[len("file:") :])
+    if setting != "lnbits":
+        logger.warning(
+            f"merchantpill: unknown MERCHANTPILL_FIAT_RATE_SOURCE {setting}, using lnbits"
+        )
+    return LnbitsRateSource()
+
+
+class FiatRates:
+    def __init__(self, source: RateSource, ttl: int, max_age: int, retry: int = 0):
+        self.source = source
+        self.ttl = ttl
+        self.max_age = max_age
+        self.retry = retry
+        # currency -> (sats per unit, fetched at)
+        self.rates: Dict[str, Tuple[float, float]] = {}
+        # currency -> time of the last failed fetch
+        self.failures: Dict[str, float] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def _fresh(self, currency: str) -> bool:
+        cached = self.rates.get(currency)
+        if cached and time.time() - cached[1] < self.ttl:
+            return True
+        failed_at = self.failures.get(currency)
+        return failed_at is not None and time.time() - failed_at < self.retry
+
+    def cached(self, currency: str) -> Optional[float]:
+        """The last rate while it is younger than max_age, never fetches."""
+        cached = self.rates.get(currency.upper())
+        if cached and time.time() - cached[1] < self.max_age:
+            return cached[0]
+        return None
+
+    async def get(self, currency: str) -> Optional[float]:
+        currency = supported_currency(currency)
+        if self._fresh(currency):
+            return self.cached(currency)
+        # concurrent misses for a currency share one fetch
+        lock = self.locks.setdefault(currency, asyncio.Lock())
+        async with lock:
+            if self._fresh(currency):
+                return self.cached(currency)
+            return await self.refresh(currency)
+
+    async def refresh(self, currency: str) -> Optional[float]:
+        try:
+            rate = await self.source.fetch(currency)
+            self.rates[currency] = (rate, time.time())
+            self.failures.pop(currency, None)
+            return rate
+        except Exception as exc:
+            self.failures[currency] = time.time()
+            logger.warning(f"merchantpill: fetching the {currency} rate failed: {exc}")
+        return self.cached(currency)
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            currency: {"rate": rate, "age": round(now - fetched_at)}
+            for currency, (rate, fetched_at) in self.rates.items()
+        }
+
+
+fiat_rates = FiatRates(
+    rate_source(FIAT_RATE_SOURCE), FIAT_RATE_TTL, FIAT_RATE_MAX_AGE, FIAT_RATE_RETRY
+)
+
+
+def to_fiat(amount: Optional[int], rate: Optional[float]) -> Optional[int]:
+    """msat at `rate` sats per unit, in hundredths of the fiat unit."""
+    if amount is None or not rate:
+        return None
+    return round(amount / 1000 / rate * 100)
+
+
+async def refresh_fiat_rates_periodically():
+    while True:
+        # the configured currency plus whatever reports asked for since
+        for currency in {FIAT_CURRENCY, *fiat_rates.rates}:
+            await fiat_rates.refresh(currency)
+        await asyncio.sleep(max(FIAT_RATE_TTL / 2, 1))
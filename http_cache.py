@@ -0,0 +1,124 @@
+import glob
+import hashlib
+import json
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from lnbits.settings import ThemesSettings, settings
+
+from .cache import LRUCache
+from .crud import get_public_version, stamp_render_fingerprint
+
+# Public responses (page, manifest, LNURL-pay request) only depend on a few of
+# the pill's fields. Writes to those move its public_version and
+# public_modified columns (see crud.PUBLIC_FIELDS), which make up the ETag and
+# Last-Modified. A matching If-None-Match (or a recent enough If-Modified-Since)
+# gets a 304 after reading just those two columns. A rendered response is kept
+# per (kind, id, base url, version, fingerprint), so it is reused until one of
+# them changes.
+#
+# The rest of what they are rendered from, the lnbits site settings and the
+# templates and code of lnbits and this extension, is folded into a fingerprint
+# that goes into the ETag too. The time it was first seen, kept in the database
+# so it survives restarts, is the other candidate for Last-Modified.
+response_cache = LRUCache(maxsize=2048, ttl=3600)
+# fingerprint -> when it was first recorded
+render_modified = LRUCache(maxsize=16, ttl=3600)
+
+
+def _source_digest() -> str:
+    """Stands in for the extension's version, which config.json doesn't carry."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for pattern in ("*.py", "templates/merchantpill/*.html"):
+        for path in sorted(glob.glob(os.path.join(root, pattern))):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+SOURCE_DIGEST = _source_digest()
+
+
+def _render_fingerprint() -> str:
+    site = {name: getattr(settings, name) for name in ThemesSettings.__fields__}
+    raw = json.dumps([SOURCE_DIGEST, settings.version, site], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+async def _render_inputs() -> Tuple[str, int]:
+    """(fingerprint, modified) of what the public responses are rendered from."""
+    fingerprint = _render_fingerprint()
+    modified = render_modified.get(fingerprint)
+    if modified is None:
+        modified = await stamp_render_fingerprint(fingerprint)
+        render_modified.set(fingerprint, modified)
+    return fingerprint, modified
+
+
+def _etag(
+    kind: str, merchantpill_id: str, base_url: str, version: int, fingerprint: str
+) -> str:
+    raw = json.dumps([kind, merchantpill_id, base_url, version, fingerprint])
+    return f'"{hashlib.sha256(raw.encode()).hexdigest()[:32]}"'
+
+
+def _not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(
+                last_modified
+            )
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def cached_response(
+    request: Request,
+    kind: str,
+    merchantpill_id: str,
+    render: Callable[[], Awaitable[Optional[Response]]],
+    max_age: int,
+) -> Optional[Response]:
+    """
+    The response `render` builds, or a 304. `render` loads the pill itself,
+    bypassing the row cache so the body is at least as new as the version, and
+    returns None when it doesn't exist, which is passed on to the caller.
+    """
+    version = await get_public_version(merchantpill_id)
+    if not version:
+        return None
+    public_version, public_modified = version
+    fingerprint, render_modified_at = await _render_inputs()
+    base_url = str(request.base_url)
+    etag = _etag(kind, merchantpill_id, base_url, public_version, fingerprint)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(
+            max(public_modified or 0, render_modified_at), usegmt=True
+        ),
+        "Cache-Control": f"public, max-age={max_age}",
+    }
+    if _not_modified(request, etag, headers["Last-Modified"]):
+        return Response(status_code=304, headers=headers)
+
+    key = (kind, merchantpill_id, base_url, public_version, fingerprint)
+    entry = response_cache.get(key)
+    if not entry:
+        response = await render()
+        if not response:
+            return None
+        entry = (response.body, response.media_type)
+        response_cache.set(key, entry)
+    body, media_type = entry
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from loguru import logger
+
+from lnbits.core.services import create_invoice
+
+from .crud import get_pooled_merchantpills
+from .models import MerchantPill
+
+# Merchantpills with invoice_pool > 0 get that many LNURL-pay invoices for their
+# fixed amount created ahead of time, so the pay callback hands one out instead
+# of waiting on the funding source. The pool lives in memory: after a restart
+# the unused invoices simply expire, and a change to the amount, name or wallet
+# throws the pool away since its invoices no longer match the pay request.
+
+INVOICE_POOL_EXPIRY = int(os.getenv("MERCHANTPILL_INVOICE_POOL_EXPIRY", "3600"))
+# invoices closer than this to expiry aren't handed out any more
+INVOICE_POOL_MIN_TTL = int(os.getenv("MERCHANTPILL_INVOICE_POOL_MIN_TTL", "600"))
+INVOICE_POOL_MAX = int(os.getenv("MERCHANTPILL_INVOICE_POOL_MAX", "50"))
+INVOICE_POOL_INTERVAL = 60
+
+
+class InvoicePool:
+    def __init__(self, key: tuple):
+        self.key = key
+        # (expires_at, payment_hash, payment_request), oldest first
+        self.invoices: Deque[Tuple[float, str, str]] = deque()
+
+
+invoice_pools: Dict[str, InvoicePool] = {}
+invoice_pool_wanted = asyncio.Event()
+
+
+def pool_key(merchantpill: MerchantPill) -> tuple:
+    return (merchantpill.wallet, merchantpill.name, merchantpill.lnurlpayamount)
+
+
+async def create_lnurlpay_invoice(
+    merchantpill: MerchantPill, amount: int, expiry: Optional[int] = None
+) -> Tuple[str, str]:
+    """Invoice for `amount` msat matching the metadata of the pay request."""
+    return await create_invoice(
+        wallet_id=merchantpill.wallet,
+        amount=int(amount / 1000),
+        memo=merchantpill.name,
+        unhashed_description=f'[["text/plain", "{merchantpill.name}"]]'.encode(),
+        expiry=expiry,
+        extra={
+            "tag": "MerchantPill",
+            "merchantpillId": merchantpill.id,
+            "extra": str(amount),
+        },
+    )
+
+
+def pop_pooled_invoice(
+    merchantpill: MerchantPill, amount: int
+) -> Optional[Tuple[str, str]]:
+    """A pre-created (payment_hash, payment_request) for `amount` msat, if any."""
+    pool = invoice_pools.get(merchantpill.id)
+    if not pool or amount != merchantpill.lnurlpayamount * 1000:
+        return None
+    invoice_pool_wanted.set()
+    if pool.key != pool_key(merchantpill):
+        pool.invoices.clear()
+        return None
+    cutoff = time.time() + INVOICE_POOL_MIN_TTL
+    while pool.invoices:
+        expires_at, payment_hash, payment_request = pool.invoices.popleft()
+        if expires_at > cutoff:
+            return payment_hash, payment_request
+    return None
+
+
+async def refill_invoice_pools() -> None:
+    merchantpills = await get_pooled_merchantpills()
+    wanted = {merchantpill.id for merchantpill in merchantpills}
+    for merchantpill_id in list(invoice_pools):
+        if merchantpill_id not in wanted:
+            del invoice_pools[merchantpill_id]
+
+    for merchantpill in merchantpills:
+        try:
+            await refill_invoice_pool(merchantpill)
+        except Exception as exc:
+            logger.warning(
+                f"merchantpill: refilling the invoice pool of {merchantpill.id} failed: {exc}"
+            )
+
+
+async def refill_invoice_pool(merchantpill: MerchantPill) -> None:
+    key = pool_key(merchantpill)
+    pool = invoice_pools.get(merchantpill.id)
+    if not pool or pool.key != key:
+        pool = invoice_pools[merchantpill.id] = InvoicePool(key)
+    cutoff = time.time() + INVOICE_POOL_MIN_TTL
+    while pool.invoices and pool.invoices[0][0] <= cutoff:
+        pool.invoices.popleft()
+    size = min(merchantpill.invoice_pool or 0, INVOICE_POOL_MAX)
+    while len(pool.invoices) < size and merchantpill.lnurlpayamount > 0:
+        expires_at = time.time() + INVOICE_POOL_EXPIRY
+        payment_hash, payment_request = await create_lnurlpay_invoice(
+            merchantpill, merchantpill.lnurlpayamount * 1000, INVOICE_POOL_EXPIRY
+        )
+        pool.invoices.append((expires_at, payment_hash, payment_request))
+
+
+async def refill_invoice_pools_periodically():
+    while True:
+        try:
+            await refill_invoice_pools()
+        except Exception as exc:
+            logger.warning(f"merchantpill: refilling the invoice pools failed: {exc}")
+        # woken early when the pay callback takes an invoice
+        try:
+            await asyncio.wait_for(invoice_pool_wanted.wait(), INVOICE_POOL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        invoice_pool_wanted.clear()
@@ -4,12 +4,16 @@
 
 from http import HTTPStatus
 from fastapi import Depends, Query, Request
+from starlette.responses import JSONResponse
 from . import merchantpill_ext
 from .crud import get_merchantpill
-from lnbits.core.services import create_invoice, pay_invoice
+from lnbits.core.services import InvoiceError, PaymentError, pay_invoice
 from loguru import logger
 from typing import Optional
-from .crud import update_merchantpill
+from .crud import claim_redemption, complete_redemption, fail_redemption
+from .http_cache import cached_response
+from .invoice_pool import create_lnurlpay_invoice, pop_pooled_invoice
+from .metrics import metrics
 from .models import MerchantPill
 import shortuuid
 
@@ -29,20 +33,31 @@ async def api_lnurl_pay(
     request: Request,
     merchantpill_id: str,
 ):
-    merchantpill = await get_merchantpill(merchantpill_id)
-    if not merchantpill:
+    async def render():
+        merchantpill = await get_merchantpill(merchantpill_id, use_cache=False)
+        if not merchantpill:
+            return None
+        return JSONResponse(
+            {
+                "callback": str(
+                    request.url_for(
+                        "merchantpill.api_lnurl_pay_callback",
+                        merchantpill_id=merchantpill_id,
+                    )
+                ),
+                "maxSendable": merchantpill.lnurlpayamount * 1000,
+                "minSendable": merchantpill.lnurlpayamount * 1000,
+                "metadata": '[["text/plain", "' + merchantpill.name + '"]]',
+                "tag": "payRequest",
+            }
+        )
+
+    response = await cached_response(
+        request, "lnurlpay", merchantpill_id, render, max_age=60
+    )
+    if not response:
         return {"status": "ERROR", "reason": "No merchantpill found"}
-    return {
-        "callback": str(
-            request.url_for(
-                "merchantpill.api_lnurl_pay_callback", merchantpill_id=merchantpill_id
-            )
-        ),
-        "maxSendable": merchantpill.lnurlpayamount * 1000,
-        "minSendable": merchantpill.lnurlpayamount * 1000,
-        "metadata": '[["text/plain", "' + merchantpill.name + '"]]',
-        "tag": "payRequest",
-    }
+    return response
 
 
 @merchantpill_ext.get(
@@ -60,17 +75,12 @@ async def api_lnurl_pay_cb(
     if not merchantpill:
         return {"status": "ERROR", "reason": "No merchantpill found"}
 
-    payment_hash, payment_request = await create_invoice(
-        wallet_id=merchantpill.wallet,
-        amount=int(amount / 1000),
-        memo=merchantpill.name,
-        unhashed_description=f'[["text/plain", "{merchantpill.name}"]]'.encode(),
-        extra={
-            "tag": "MerchantPill",
-            "merchantpillId": merchantpill_id,
-            "extra": request.query_params.get("amount"),
-        },
-    )
+    invoice = pop_pooled_invoice(merchantpill, amount)
+    if invoice:
+        metrics.inc("merchantpill_invoice_pool_hits_total")
+    else:
+        invoice = await create_lnurlpay_invoice(merchantpill, amount)
+    payment_hash, payment_request = invoice
     return {
         "pr": payment_request,
         "routes": [],
@@ -97,7 +107,8 @@ async def api_lnurl_withdraw(
     merchantpill_id: str,
     tickerhash: str,
 ):
-    merchantpill = await get_merchantpill(merchantpill_id)
+    # never serve the ticker from cache, k1 must match the current one
+    merchantpill = await get_merchantpill(merchantpill_id, use_cache=False)
     if not merchantpill:
         return {"status": "ERROR", "reason": "No merchantpill found"}
     k1 = shortuuid.uuid(name=merchantpill.id + str(merchantpill.ticker))
@@ -106,11 +117,13 @@ async def api_lnurl_withdraw(
 
     return {
         "tag": "withdrawRequest",
+        # the ticker k1 was made from, so the callback can claim it without a read
         "callback": str(
             request.url_for(
                 "merchantpill.api_lnurl_withdraw_callback", merchantpill_id=merchantpill_id
             )
-        ),
+        )
+        + f"?ticker={merchantpill.ticker}",
         "k1": k1,
         "defaultDescription": merchantpill.name,
         "maxWithdrawable": merchantpill.lnurlwithdrawamount * 1000,
@@ -128,28 +141,44 @@ async def api_lnurl_withdraw_cb(
     merchantpill_id: str,
     pr: Optional[str] = None,
     k1: Optional[str] = None,
+    ticker: Optional[int] = None,
 ):
     assert k1, "k1 is required"
     assert pr, "pr is required"
-    merchantpill = await get_merchantpill(merchantpill_id)
-    if not merchantpill:
-        return {"status": "ERROR", "reason": "No merchantpill found"}
-
-    k1Check = shortuuid.uuid(name=merchantpill.id + str(merchantpill.ticker))
+    if ticker is None:
+        # callback urls handed out before they carried the ticker
+        merchantpill = await get_merchantpill(merchantpill_id, use_cache=False)
+        if not merchantpill:
+            return {"status": "ERROR", "reason": "No merchantpill found"}
+        ticker = merchantpill.ticker
+
+    k1Check = shortuuid.uuid(name=merchantpill_id + str(ticker))
     if k1Check != k1:
         return {"status": "ERROR", "reason": "Wrong k1 check provided"}
 
-    await update_merchantpill(
-        merchantpill_id=merchantpill_id, ticker=merchantpill.ticker + 1
-    )
-    await pay_invoice(
-        wallet_id=merchantpill.wallet,
-        payment_request=pr,
-        max_sat=int(merchantpill.lnurlwithdrawamount * 1000),
-        extra={
-            "tag": "MerchantPill",
-            "merchantpillId": merchantpill_id,
-            "lnurlwithdraw": True,
-        },
-    )
+    # only one of any concurrent callbacks for this k1 gets past here
+    claim = await claim_redemption(merchantpill_id, ticker)
+    if not claim:
+        return {"status": "ERROR", "reason": "LNURLw already used"}
+    merchantpill, redemption_id = claim
+
+    try:
+        payment_hash = await pay_invoice(
+            wallet_id=merchantpill.wallet,
+            payment_request=pr,
+            max_sat=int(merchantpill.lnurlwithdrawamount * 1000),
+            extra={
+                "tag": "MerchantPill",
+                "merchantpillId": merchantpill_id,
+                "lnurlwithdraw": True,
+            },
+        )
+    except (InvoiceError, PaymentError, PermissionError) as exc:
+        # nothing was paid out, give the ticker back so the wallet can retry.
+        # Anything else leaves the redemption pending rather than risk paying twice
+        await fail_redemption(redemption_id)
+        metrics.inc("merchantpill_failures_total", "withdraw")
+        return {"status": "ERROR", "reason": str(exc)}
+    await complete_redemption(redemption_id, payment_hash)
+    metrics.inc("merchantpill_withdraws_redeemed_total")
     return {"status": "OK"}
@@ -0,0 +1,155 @@
+import functools
+import inspect
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+from fastapi.routing import APIRoute
+
+# Recording is a perf_counter() pair and a bisect into a fixed bucket list, the
+# text format is only built when /api/v1/metrics is scraped.
+METRICS_ENABLED = os.getenv("MERCHANTPILL_METRICS", "true").lower() != "false"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Latency histogram with Prometheus style cumulative `le` buckets."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self) -> List[Tuple[str, float]]:
+        samples, total = [], 0
+        for le, count in zip((*self.buckets, "+Inf"), self.counts):
+            total += count
+            samples.append((str(le), total))
+        return samples
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.help: Dict[str, str] = {}
+
+    def observe(self, name: str, label: str, value: str, seconds: float) -> None:
+        histogram = self.histograms.get((name, label, value))
+        if histogram is None:
+            histogram = self.histograms[(name, label, value)] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name: str, reason: str = "", amount: int = 1) -> None:
+        self.counters[(name, reason)] = self.counters.get((name, reason), 0) + amount
+
+    def counter(self, name: str, help: str) -> None:
+        """Registers a counter, so it is scraped as 0 before the first inc()."""
+        self.counters.setdefault((name, ""), 0)
+        self.help[name] = help
+
+    def gauge(self, name: str, read: Callable[[], float], help: str = "") -> None:
+        """`read` is only called on scrape."""
+        self.gauges[name] = read
+        self.help[name] = help
+
+    def describe(self, name: str, help: str) -> None:
+        self.help[name] = help
+
+    def render(self) -> str:
+        lines: List[str] = []
+        seen = set()
+
+        def header(name: str, kind: str) -> None:
+            if name in seen:
+                return
+            seen.add(name)
+            if self.help.get(name):
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, label, value), histogram in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for le, count in histogram.samples():
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {sum(histogram.counts)}')
+        for (name, reason), count in sorted(self.counters.items()):
+            header(name, "counter")
+            labels = f'{{reason="{reason}"}}' if reason else ""
+            lines.append(f"{name}{labels} {count}")
+        for name, read in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("merchantpill_crud_duration_seconds", "Latency of crud.py calls")
+metrics.describe(
+    "merchantpill_request_duration_seconds", "Latency of the extension's handlers"
+)
+metrics.counter(
+    "merchantpill_payments_processed_total", "Paid invoices applied to the ledger"
+)
+metrics.counter(
+    "merchantpill_payments_skipped_total",
+    "Paid invoices not applied, already processed or for an unknown user",
+)
+metrics.counter("merchantpill_withdraws_redeemed_total", "LNURL withdraws paid out")
+metrics.counter(
+    "merchantpill_invoice_pool_hits_total",
+    "LNURL-pay callbacks answered from the pre-created invoice pool",
+)
+metrics.describe(
+    "merchantpill_failures_total", "Failed payment handling and withdraws, by reason"
+)
+
+
+def timed(name: str, label: str, value: str) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe(name, label, value, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_crud(namespace: dict) -> None:
+    """Times every public coroutine function defined in the crud module."""
+    if not METRICS_ENABLED:
+        return
+    for attr, func in list(namespace.items()):
+        if (
+            not attr.startswith("_")
+            and inspect.iscoroutinefunction(func)
+            and func.__module__ == namespace["__name__"]
+        ):
+            namespace[attr] = timed(
+                "merchantpill_crud_duration_seconds", "function", attr
+            )(func)
+
+
+class TimedRoute(APIRoute):
+    """Route class for merchantpill_ext, times each handler by its function name."""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        if not METRICS_ENABLED:
+            return handler
+        return timed(
+            "merchantpill_request_duration_seconds", "handler", self.endpoint.__name__
+        )(handler)
@@ -1,6 +1,25 @@
+import time
+
+from loguru import logger
+
 # the migration file is where you build your database tables
 # If you create a new release for your extension , remember the migration file is like a blockchain, never edit only add!
 
+
+async def _baseline_statement(db, query: str) -> None:
+    """
+    Runs a statement of m003-m005 as they were released. Some of them fail on
+    some databases, those are rolled back and m006 creates what is missing.
+    """
+    await db.execute("SAVEPOINT baseline_statement")
+    try:
+        await db.execute(query)
+    except Exception as exc:
+        logger.info(f"merchantpill: {str(exc).splitlines()[0]}, left to m006")
+        await db.execute("ROLLBACK TO SAVEPOINT baseline_statement")
+    await db.execute("RELEASE SAVEPOINT baseline_statement")
+
+
 async def m001_initial(db):
     """
     Initial templates table.
@@ -36,7 +55,8 @@ async def m003_add_debt_table(db):
     """
     Add debt table
     """
-    await db.execute(
+    await _baseline_statement(
+        db,
         """
         CREATE TABLE merchantpill.debt (
             id TEXT PRIMARY KEY,
@@ -54,7 +74,8 @@ async def m004_add_transaction_table(db):
     """
     Add transaction table
     """
-    await db.execute(
+    await _baseline_statement(
+        db,
         """
         CREATE TABLE merchantpill.transaction (
             id TEXT PRIMARY KEY,
@@ -73,9 +94,429 @@ async def m005_add_fields_to_user_table(db):
     """
     Add invited_by and debt_id fields to user table
     """
-    await db.execute(
+    await _baseline_statement(
+        db,
         """
         ALTER TABLE merchantpill.maintable ADD invited_by TEXT;
         ALTER TABLE merchantpill.maintable ADD debt_id TEXT;
         """
     )
+
+async def m006_repair_debt_and_transaction_tables(db):
+    """
+    Create what m003-m005 couldn't: sqlite rejects a schema in REFERENCES, the
+    unquoted transaction table and two statements in one execute, postgres the
+    DATETIME type
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS merchantpill.debt (
+            id TEXT PRIMARY KEY,
+            inviter_id TEXT,
+            inviterWallet TEXT,
+            debtPaid INTEGER DEFAULT 0,
+            debtOutstanding INTEGER DEFAULT 0,
+            debtCurrency TEXT,
+            FOREIGN KEY(inviter_id) REFERENCES {db.references_schema}maintable(id)
+        );
+        """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS merchantpill."transaction" (
+            id TEXT PRIMARY KEY,
+            from_user_id TEXT,
+            to_user_id TEXT,
+            amount INTEGER DEFAULT 0,
+            currency TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(from_user_id) REFERENCES {db.references_schema}maintable(id),
+            FOREIGN KEY(to_user_id) REFERENCES {db.references_schema}maintable(id)
+        );
+        """
+    )
+    if db.type == "SQLITE":
+        rows = await db.fetchall("PRAGMA merchantpill.table_info(maintable)")
+        columns = {row.name for row in rows}
+    else:
+        rows = await db.fetchall(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'merchantpill' AND table_name = 'maintable'
+            """
+        )
+        columns = {row.column_name for row in rows}
+    for column in ("invited_by", "debt_id"):
+        if column not in columns:
+            await db.execute(f"ALTER TABLE merchantpill.maintable ADD {column} TEXT;")
+
+async def m007_add_indexes(db):
+    """
+    Add indexes for the wallet, inviter and transaction lookups
+    """
+    indexes = [
+        ("maintable_wallet_idx", "maintable", "wallet, id"),
+        ("debt_inviter_idx", "debt", "inviter_id, id"),
+        ("transaction_from_user_idx", '"transaction"', "from_user_id, timestamp"),
+        ("transaction_to_user_idx", '"transaction"', "to_user_id, timestamp"),
+        ("transaction_timestamp_idx", '"transaction"', "timestamp"),
+    ]
+    for name, table, columns in indexes:
+        # sqlite wants the schema on the index name, postgres on the table
+        if db.type == "SQLITE":
+            query = f"CREATE INDEX IF NOT EXISTS merchantpill.{name} ON {table} ({columns})"
+        else:
+            query = f"CREATE INDEX IF NOT EXISTS {name} ON merchantpill.{table} ({columns})"
+        await db.execute(query)
+
+async def m008_add_balance_rollup(db):
+    """
+    Add per user balance rollup, kept up to date by the ledger writes
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.balance (
+            user_id TEXT PRIMARY KEY,
+            wallet TEXT,
+            total_in INTEGER DEFAULT 0,
+            total_out INTEGER DEFAULT 0,
+            debt_outstanding INTEGER DEFAULT 0,
+            last_activity TIMESTAMP
+        );
+        """
+    )
+    if db.type == "SQLITE":
+        query = "CREATE INDEX IF NOT EXISTS merchantpill.balance_wallet_idx ON balance (wallet, user_id)"
+    else:
+        query = "CREATE INDEX IF NOT EXISTS balance_wallet_idx ON merchantpill.balance (wallet, user_id)"
+    await db.execute(query)
+    # backfill from the existing ledger
+    await db.execute(
+        """
+        INSERT INTO merchantpill.balance
+        (user_id, wallet, total_in, total_out, debt_outstanding, last_activity)
+        SELECT u.id, u.wallet,
+            COALESCE((SELECT SUM(t.amount) FROM merchantpill."transaction" t WHERE t.to_user_id = u.id), 0),
+            COALESCE((SELECT SUM(t.amount) FROM merchantpill."transaction" t WHERE t.from_user_id = u.id), 0),
+            COALESCE((SELECT d.debtOutstanding - d.debtPaid FROM merchantpill.debt d WHERE d.id = u.debt_id), 0),
+            (SELECT MAX(t.timestamp) FROM merchantpill."transaction" t WHERE t.from_user_id = u.id OR t.to_user_id = u.id)
+        FROM merchantpill.maintable u
+        """
+    )
+
+async def m009_add_referral_closure(db):
+    """
+    Add closure table over maintable.invited_by, one row per ancestor/descendant pair
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.referral (
+            ancestor_id TEXT NOT NULL,
+            descendant_id TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        );
+        """
+    )
+    if db.type == "SQLITE":
+        query = "CREATE INDEX IF NOT EXISTS merchantpill.referral_descendant_idx ON referral (descendant_id, depth)"
+    else:
+        query = "CREATE INDEX IF NOT EXISTS referral_descendant_idx ON merchantpill.referral (descendant_id, depth)"
+    await db.execute(query)
+    # backfill, the depth cap stops on invite cycles in existing data
+    await db.execute(
+        """
+        INSERT INTO merchantpill.referral (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM merchantpill.maintable
+            UNION ALL
+            SELECT tree.ancestor_id, u.id, tree.depth + 1
+            FROM tree JOIN merchantpill.maintable u ON u.invited_by = tree.descendant_id
+            WHERE tree.depth < 1000 AND u.id != tree.ancestor_id
+        )
+        SELECT ancestor_id, descendant_id, MIN(depth) FROM tree
+        GROUP BY ancestor_id, descendant_id
+        """
+    )
+
+async def m010_add_changelog(db):
+    """
+    Add change log of maintable and transaction writes, for delta syncing clients
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE merchantpill.changelog (
+            version {db.serial_primary_key},
+            entity TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            wallet TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    if db.type == "SQLITE":
+        query = "CREATE INDEX IF NOT EXISTS merchantpill.changelog_wallet_idx ON changelog (wallet, version)"
+    else:
+        query = "CREATE INDEX IF NOT EXISTS changelog_wallet_idx ON merchantpill.changelog (wallet, version)"
+    await db.execute(query)
+
+async def m011_add_redemptions(db):
+    """
+    Add LNURL withdraw redemptions, one row per claimed ticker with its payout status
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.redemption (
+            id TEXT PRIMARY KEY,
+            merchantpill_id TEXT NOT NULL,
+            ticker INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            payment_hash TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    if db.type == "SQLITE":
+        query = "CREATE INDEX IF NOT EXISTS merchantpill.redemption_merchantpill_idx ON redemption (merchantpill_id, ticker)"
+    else:
+        query = "CREATE INDEX IF NOT EXISTS redemption_merchantpill_idx ON merchantpill.redemption (merchantpill_id, ticker)"
+    await db.execute(query)
+
+async def m012_add_processed_payments(db):
+    """
+    Add processed payments, so a paid invoice is only ever applied once
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.processed_payment (
+            checking_id TEXT PRIMARY KEY,
+            payment_hash TEXT,
+            user_id TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+
+async def m013_add_invoice_pool(db):
+    """
+    Add per merchantpill size of the pre-created LNURL-pay invoice pool, 0 is off
+    """
+    await db.execute(
+        "ALTER TABLE merchantpill.maintable ADD invoice_pool INTEGER DEFAULT 0;"
+    )
+    if db.type == "SQLITE":
+        query = "CREATE INDEX IF NOT EXISTS merchantpill.maintable_invoice_pool_idx ON maintable (id) WHERE invoice_pool > 0"
+    else:
+        query = "CREATE INDEX IF NOT EXISTS maintable_invoice_pool_idx ON merchantpill.maintable (id) WHERE invoice_pool > 0"
+    await db.execute(query)
+
+async def m014_add_transaction_fiat_amount(db):
+    """
+    Add the fiat value of a transaction at the time it was written, in hundredths of its currency
+    """
+    await db.execute(
+        'ALTER TABLE merchantpill."transaction" ADD fiat_amount INTEGER;'
+    )
+
+async def m015_add_payouts(db):
+    """
+    Add bulk payout jobs and their items, with per item status so a job resumes after a restart
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.payout_job (
+            id TEXT PRIMARY KEY,
+            wallet TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.payout_item (
+            id TEXT PRIMARY KEY,
+            job_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            invoice TEXT NOT NULL,
+            payment_hash TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    indexes = [
+        ("payout_job_status_idx", "payout_job", "status"),
+        ("payout_item_job_idx", "payout_item", "job_id, status, id"),
+    ]
+    for name, table, columns in indexes:
+        if db.type == "SQLITE":
+            query = f"CREATE INDEX IF NOT EXISTS merchantpill.{name} ON {table} ({columns})"
+        else:
+            query = f"CREATE INDEX IF NOT EXISTS {name} ON merchantpill.{table} ({columns})"
+        await db.execute(query)
+
+async def m016_add_transaction_daily(db):
+    """
+    Add daily transaction rollup per user, 'out' for what they paid and 'in' for what they were credited as inviter
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.transaction_daily (
+            user_id TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, direction, day)
+        );
+        """
+    )
+    # backfill from the existing ledger
+    day = "date(timestamp)" if db.type == "SQLITE" else "to_char(timestamp, 'YYYY-MM-DD')"
+    await db.execute(
+        f"""
+        INSERT INTO merchantpill.transaction_daily (user_id, direction, day, count, amount)
+        SELECT from_user_id, 'out', {day}, COUNT(*), COALESCE(SUM(amount), 0)
+        FROM merchantpill."transaction" GROUP BY from_user_id, {day}
+        UNION ALL
+        SELECT to_user_id, 'in', {day}, COUNT(*), COALESCE(SUM(amount), 0)
+        FROM merchantpill."transaction" WHERE to_user_id IS NOT NULL
+        GROUP BY to_user_id, {day}
+        """
+    )
+
+async def m017_add_transaction_archive(db):
+    """
+    Add transaction archive, transactions older than the archive horizon are moved here in batches
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.transaction_archive (
+            id TEXT PRIMARY KEY,
+            from_user_id TEXT,
+            to_user_id TEXT,
+            amount INTEGER DEFAULT 0,
+            currency TEXT,
+            fiat_amount INTEGER,
+            timestamp TIMESTAMP
+        );
+        """
+    )
+    indexes = [
+        ("transaction_archive_from_user_idx", "transaction_archive", "from_user_id, timestamp"),
+        ("transaction_archive_to_user_idx", "transaction_archive", "to_user_id"),
+    ]
+    for name, table, columns in indexes:
+        if db.type == "SQLITE":
+            query = f"CREATE INDEX IF NOT EXISTS merchantpill.{name} ON {table} ({columns})"
+        else:
+            query = f"CREATE INDEX IF NOT EXISTS {name} ON merchantpill.{table} ({columns})"
+        await db.execute(query)
+
+async def m018_add_changelog_version(db):
+    """
+    Add single row change log version counter, bumped under its row lock so versions commit in order
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.changelog_version (
+            version INTEGER NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO merchantpill.changelog_version (version)
+        SELECT COALESCE(MAX(version), 0) FROM merchantpill.changelog
+        """
+    )
+
+async def m019_add_backfill_floor(db):
+    """
+    Record when payment processing became idempotent. processed_payment starts out
+    empty, so the backfill must never reapply a payment that settled before this.
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.backfill_floor (
+            since INTEGER NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        "INSERT INTO merchantpill.backfill_floor (since) VALUES (?)",
+        (int(time.time()),),
+    )
+
+async def m020_add_public_version(db):
+    """
+    Add the version and time of the last change to a pill's public fields, the
+    validators of its cached public responses
+    """
+    await db.execute(
+        "ALTER TABLE merchantpill.maintable ADD public_version INTEGER NOT NULL DEFAULT 0;"
+    )
+    await db.execute("ALTER TABLE merchantpill.maintable ADD public_modified INTEGER;")
+    await db.execute(
+        "UPDATE merchantpill.maintable SET public_modified = ?", (int(time.time()),)
+    )
+
+async def m021_add_changelog_version_trigger(db):
+    """
+    On SQLite the change log insert takes the next version itself and this trigger
+    moves the counter along, postgres bumps it in the same statement. SQLite has
+    a single writer, so nothing can take a version in between.
+    """
+    if db.type == "SQLITE":
+        await db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS merchantpill.changelog_version_bump
+            AFTER INSERT ON changelog
+            BEGIN
+                UPDATE changelog_version SET version = NEW.version;
+            END;
+            """
+        )
+
+async def m022_add_transaction_wallet(db):
+    """
+    Add the payer's wallet to the transactions, a wallet's listing walks an index
+    on (wallet, timestamp, id) instead of joining and sorting all its users' rows
+    """
+    for table in ('"transaction"', "transaction_archive"):
+        await db.execute(f"ALTER TABLE merchantpill.{table} ADD wallet TEXT;")
+        await db.execute(
+            f"""
+            UPDATE merchantpill.{table} SET wallet = (
+                SELECT u.wallet FROM merchantpill.maintable u WHERE u.id = from_user_id
+            )
+            """
+        )
+    indexes = [
+        ("transaction_wallet_idx", '"transaction"', "wallet, timestamp, id"),
+        ("transaction_archive_wallet_idx", "transaction_archive", "wallet, timestamp, id"),
+    ]
+    for name, table, columns in indexes:
+        if db.type == "SQLITE":
+            query = f"CREATE INDEX IF NOT EXISTS merchantpill.{name} ON {table} ({columns})"
+        else:
+            query = f"CREATE INDEX IF NOT EXISTS {name} ON merchantpill.{table} ({columns})"
+        await db.execute(query)
+
+async def m023_add_render_fingerprint(db):
+    """
+    Record when the lnbits settings and extension sources the public responses
+    are rendered from last changed, their Last-Modified can't go back after a restart
+    """
+    await db.execute(
+        """
+        CREATE TABLE merchantpill.render_fingerprint (
+            fingerprint TEXT NOT NULL,
+            modified INTEGER NOT NULL
+        );
+        """
+    )
@@ -1,7 +1,8 @@
 # Data models for your extension
 
+from datetime import datetime
 from sqlite3 import Row
-from typing import Optional, List
+from typing import Any, Dict, Optional, List, Type, TypeVar
 from pydantic import BaseModel
 from fastapi import Request
 
@@ -9,6 +10,44 @@ from lnbits.lnurl import encode as lnurl_encode
 from urllib.parse import urlparse
 
 
+M = TypeVar("M", bound=BaseModel)
+
+
+def trusted_models(model: Type[M], rows: List[Row]) -> List[M]:
+    """
+    Models for rows whose columns already have the field types, built without
+    validation for list responses. Only for tables without timestamps or other
+    values pydantic would have to coerce.
+    """
+    fields = list(model.__fields__)
+    models = []
+    for row in rows:
+        values = dict(row)
+        models.append(model.construct(**{name: values.get(name) for name in fields}))
+    return models
+
+
+class CreateMerchantPillData(BaseModel):
+    wallet: Optional[str]
+    name: str
+    lnurlpayamount: int
+    lnurlwithdrawamount: int
+    invoice_pool: Optional[int]
+
+
+class MerchantPill(BaseModel):
+    id: str
+    wallet: str
+    name: str
+    total: Optional[int]
+    lnurlpayamount: int
+    lnurlwithdrawamount: int
+    lnurlwithdraw: Optional[str]
+    lnurlpay: Optional[str]
+    ticker: Optional[int]
+    invoice_pool: Optional[int]
+
+
 class CreateUser(BaseModel):
     wallet: Optional[str]
     name: Optional[str]
@@ -19,6 +58,7 @@ class CreateUser(BaseModel):
     lnurlpay: Optional[str]
     invited_by: Optional[str]
     debt_id: Optional[str]
+    invoice_pool: Optional[int]
 
 
 class User(BaseModel):
@@ -32,12 +72,35 @@ class User(BaseModel):
     lnurlpay: Optional[str]
     invited_by: Optional[str]
     debt_id: Optional[str]
+    ticker: Optional[int]
+    invoice_pool: Optional[int]
 
     @classmethod
     def from_row(cls, row: Row) -> "User":
         return cls(**dict(row))
 
 
+class ReferralUser(User):
+    depth: int
+
+
+class ReferralTotals(BaseModel):
+    user_id: str
+    users: int
+    total: int
+    paid: int
+    debt_outstanding: int
+    depth: int
+
+
+class CreateDebt(BaseModel):
+    inviter_id: str
+    inviterWallet: Optional[str]
+    debtPaid: Optional[int]
+    debtOutstanding: Optional[int]
+    debtCurrency: Optional[str]
+
+
 class Debt(BaseModel):
     id: str
     inviter_id: str
@@ -51,14 +114,127 @@ class Debt(BaseModel):
         return cls(**dict(row))
 
 
+class CreateTransaction(BaseModel):
+    from_user_id: str
+    to_user_id: Optional[str]
+    amount: Optional[int]
+    currency: Optional[str]
+    fiat_amount: Optional[int]
+
+
 class Transaction(BaseModel):
+    """
+    amount is in msat, fiat_amount its value in hundredths of `currency` at the
+    time the transaction was written.
+    """
+
     id: str
     from_user_id: str
-    to_user_id: str
+    to_user_id: Optional[str]
     amount: Optional[int]
     currency: Optional[str]
-    timestamp: Optional[str]
+    fiat_amount: Optional[int]
+    timestamp: Optional[datetime]
 
     @classmethod
     def from_row(cls, row: Row) -> "Transaction":
-        return cls(**dict(row))
\ No newline at end of file
+        return cls(**dict(row))
+
+
+class Balance(BaseModel):
+    """
+    Rollup of a user's ledger. total_out is what the user paid, total_in what
+    was credited to them as inviter, debt_outstanding is debtOutstanding minus
+    debtPaid of their debt.
+    """
+
+    user_id: str
+    wallet: Optional[str]
+    total_in: int
+    total_out: int
+    debt_outstanding: int
+    last_activity: Optional[datetime]
+    # only set when a report asks for a currency, at its current rate
+    currency: Optional[str]
+    total_in_fiat: Optional[int]
+    total_out_fiat: Optional[int]
+
+    @classmethod
+    def from_row(cls, row: Row) -> "Balance":
+        return cls(**dict(row))
+
+
+class ReportBucket(BaseModel):
+    # first day of the bucket, YYYY-MM-DD
+    bucket: str
+    count: int
+    amount: int
+
+
+class SettlementTransfer(BaseModel):
+    from_user_id: str
+    to_user_id: str
+    amount: int
+
+
+class SettlementPlan(BaseModel):
+    """
+    Transfers that settle every outstanding debt of a wallet's users once the
+    debts are netted, `debts` and `outstanding` are the edges they replace.
+    """
+
+    wallet: str
+    debts: int
+    outstanding: int
+    transfers: List[SettlementTransfer]
+
+
+class CreatePayoutItem(BaseModel):
+    user_id: str
+    amount: int
+    invoice: str
+
+
+class CreatePayout(BaseModel):
+    items: List[CreatePayoutItem]
+
+
+class PayoutItem(BaseModel):
+    """
+    One invoice of a payout job, `amount` in sat. Status goes pending, paying
+    (claimed by a runner), then paid or failed.
+    """
+
+    id: str
+    job_id: str
+    user_id: str
+    amount: int
+    invoice: str
+    payment_hash: str
+    status: str
+    error: Optional[str]
+    timestamp: Optional[datetime]
+
+    @classmethod
+    def from_row(cls, row: Row) -> "PayoutItem":
+        return cls(**dict(row))
+
+
+class PayoutJob(BaseModel):
+    id: str
+    wallet: str
+    status: str
+    timestamp: Optional[datetime]
+    # item count per status
+    items: Dict[str, int] = {}
+
+    @classmethod
+    def from_row(cls, row: Row) -> "PayoutJob":
+        return cls(**dict(row))
+
+
+class CursorPage(BaseModel):
+    """One page of a keyset-paginated listing, pass next_cursor back to continue."""
+
+    data: List[Any]
+    next_cursor: Optional[str]
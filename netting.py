@@ -0,0 +1,159 @@
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+# Debts are netted per wallet: each user's position is what they are owed minus
+# what they owe over all outstanding debts, and settling only has to move money
+# from negative to positive positions. A debt edge is keyed by its debtor (a user
+# has one debt_id) and a change moves the two positions it touches.
+#
+# The transfer plan is built once with settle() and then kept in step: a change
+# that makes A owe B x less becomes a transfer of x from B to A, which is folded
+# into the existing transfers so that everyone is again either only paying or
+# only receiving. That costs a few dict updates per payment instead of a pass
+# over the debt graph. Folding can leave a few more transfers than a fresh plan
+# would have, once that is more than REPLAN_SLACK over the last fresh plan the
+# next read replans from scratch.
+
+REPLAN_SLACK = 0.01
+
+Transfer = Tuple[str, str, int]
+
+
+class NettingEngine:
+    def __init__(self):
+        # debtor -> (creditor, outstanding)
+        self.edges: Dict[str, Tuple[str, int]] = {}
+        # user -> net position, positive is owed money, zeros are dropped
+        self.positions: Dict[str, int] = {}
+        # the plan as payer -> receiver -> amount, and receiver -> payer -> amount
+        self.pays: Dict[str, Dict[str, int]] = {}
+        self.receives: Dict[str, Dict[str, int]] = {}
+        self.transfers = 0
+        # transfers of the last fresh plan, None until the first one
+        self.planned: Optional[int] = None
+        self.replans = 0
+        self._plan: Optional[List[Transfer]] = None
+
+    def set_edge(self, debtor: str, creditor: Optional[str], amount: int) -> None:
+        """Sets what `debtor` still owes `creditor`, replacing their previous debt."""
+        previous = self.edges.pop(debtor, None)
+        if previous:
+            self._move(debtor, previous[0], -previous[1])
+        if creditor and creditor != debtor and amount > 0:
+            self.edges[debtor] = (creditor, amount)
+            self._move(debtor, creditor, amount)
+
+    def _move(self, debtor: str, creditor: str, amount: int) -> None:
+        for user, delta in ((debtor, -amount), (creditor, amount)):
+            position = self.positions.get(user, 0) + delta
+            if position:
+                self.positions[user] = position
+            else:
+                self.positions.pop(user, None)
+        if self.planned is None:
+            return
+        self._plan = None
+        if amount > 0:
+            self._add(debtor, creditor, amount)
+        else:
+            self._add(creditor, debtor, -amount)
+        self._fold(debtor)
+        self._fold(creditor)
+        if self.transfers > self.planned * (1 + REPLAN_SLACK) + 16:
+            self.planned = None
+
+    def _set(self, payer: str, receiver: str, amount: int) -> None:
+        pays = self.pays.setdefault(payer, {})
+        receives = self.receives.setdefault(receiver, {})
+        self.transfers += (amount > 0) - (receiver in pays)
+        if amount > 0:
+            pays[receiver] = receives[payer] = amount
+            return
+        pays.pop(receiver, None)
+        receives.pop(payer, None)
+        if not pays:
+            del self.pays[payer]
+        if not receives:
+            del self.receives[receiver]
+
+    def _add(self, payer: str, receiver: str, amount: int) -> None:
+        back = self.pays.get(receiver, {}).get(payer, 0)
+        if back:
+            self._set(receiver, payer, max(back - amount, 0))
+            amount -= back
+        if amount > 0:
+            current = self.pays.get(payer, {}).get(receiver, 0)
+            self._set(payer, receiver, current + amount)
+
+    def _fold(self, user: str) -> None:
+        """Routes money passing through `user` straight from payer to receiver."""
+        while self.pays.get(user) and self.receives.get(user):
+            payer, paid = next(iter(self.receives[user].items()))
+            receiver, owed = next(iter(self.pays[user].items()))
+            amount = min(paid, owed)
+            self._set(payer, user, paid - amount)
+            self._set(user, receiver, owed - amount)
+            if payer != receiver:
+                self._add(payer, receiver, amount)
+
+    def plan(self) -> List[Transfer]:
+        if self.planned is None:
+            self.pays, self.receives, self.transfers = {}, {}, 0
+            for payer, receiver, amount in settle(self.positions):
+                self._set(payer, receiver, amount)
+            self.planned = self.transfers
+            self.replans += 1
+            self._plan = None
+        if self._plan is None:
+            self._plan = [
+                (payer, receiver, amount)
+                for payer, receivers in self.pays.items()
+                for receiver, amount in receivers.items()
+            ]
+        return self._plan
+
+    def outstanding(self) -> int:
+        return sum(amount for _, amount in self.edges.values())
+
+
+def settle(positions: Dict[str, int]) -> List[Transfer]:
+    """
+    (from, to, amount) transfers that bring every position to zero. Equal and
+    opposite positions are paired first since each such pair settles with one
+    transfer, the rest goes greedily largest debtor to largest creditor, which
+    never needs more transfers than users with a position minus one.
+    """
+    transfers: List[Transfer] = []
+    creditors_by_amount: Dict[int, List[str]] = {}
+    for user in sorted(positions):
+        if positions[user] > 0:
+            creditors_by_amount.setdefault(positions[user], []).append(user)
+
+    debtors: List[Tuple[int, str]] = []
+    for user in sorted(positions):
+        amount = -positions[user]
+        if amount <= 0:
+            continue
+        matches = creditors_by_amount.get(amount)
+        if matches:
+            transfers.append((user, matches.pop(), amount))
+        else:
+            debtors.append((-amount, user))
+    creditors = [
+        (-amount, user)
+        for amount, users in creditors_by_amount.items()
+        for user in users
+    ]
+
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    while debtors and creditors:
+        owes, debtor = heapq.heappop(debtors)
+        owed, creditor = heapq.heappop(creditors)
+        amount = min(-owes, -owed)
+        transfers.append((debtor, creditor, amount))
+        if -owes > amount:
+            heapq.heappush(debtors, (owes + amount, debtor))
+        if -owed > amount:
+            heapq.heappush(creditors, (owed + amount, creditor))
+    return transfers
@@ -0,0 +1,139 @@
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from lnbits.core.crud import get_standalone_payment
+from lnbits.core.services import InvoiceError, PaymentError, pay_invoice
+
+from .crud import (
+    claim_payout_items,
+    finish_payout_job,
+    get_payout_items,
+    get_running_payout_jobs,
+    release_payout_items,
+    settle_payout_items,
+)
+from .metrics import metrics
+from .models import PayoutItem, PayoutJob
+
+# A payout job pays its items in batches: a batch is claimed (pending ->
+# paying), paid with at most PAYOUT_CONCURRENCY payments in flight per wallet
+# (shared by all jobs of that wallet), then settled in one transaction that
+# also debits the users' totals. Items found in paying when a job (re)starts
+# were claimed by a run that didn't finish, lnbits' own record of the payment
+# decides whether they were paid or go back to pending. Running jobs are picked
+# up again at startup and every PAYOUT_RESUME_INTERVAL.
+
+PAYOUT_CONCURRENCY = int(os.getenv("MERCHANTPILL_PAYOUT_CONCURRENCY", "4"))
+PAYOUT_BATCH_SIZE = int(os.getenv("MERCHANTPILL_PAYOUT_BATCH_SIZE", "50"))
+PAYOUT_MAX_ITEMS = int(os.getenv("MERCHANTPILL_PAYOUT_MAX_ITEMS", "10000"))
+PAYOUT_RESUME_INTERVAL = 60
+
+wallet_slots: Dict[str, asyncio.Semaphore] = {}
+running_jobs: Dict[str, asyncio.Task] = {}
+
+metrics.describe("merchantpill_payouts_total", "Bulk payout items settled, by outcome")
+
+
+def start_payout_job(job: PayoutJob) -> Optional[asyncio.Task]:
+    """Runs the job in the background, unless it is already running here."""
+    if job.id in running_jobs:
+        return None
+    task = asyncio.create_task(run_payout_job(job))
+    running_jobs[job.id] = task
+    task.add_done_callback(lambda _: running_jobs.pop(job.id, None))
+    return task
+
+
+async def run_payout_job(job: PayoutJob) -> None:
+    try:
+        await reconcile_payout_items(job)
+        slots = wallet_slots.setdefault(
+            job.wallet, asyncio.Semaphore(max(1, PAYOUT_CONCURRENCY))
+        )
+        while True:
+            items = await claim_payout_items(job.id, PAYOUT_BATCH_SIZE)
+            if not items:
+                break
+            results = await asyncio.gather(
+                *[pay_payout_item(job, item, slots) for item in items]
+            )
+            paid = [
+                item.id
+                for item, (status, _) in zip(items, results)
+                if status == "paid"
+            ]
+            failed = [
+                (item.id, error)
+                for item, (status, error) in zip(items, results)
+                if status == "failed"
+            ]
+            await settle_payout_items(paid, failed)
+            metrics.inc("merchantpill_payouts_total", "paid", len(paid))
+            metrics.inc("merchantpill_payouts_total", "failed", len(failed))
+        if await finish_payout_job(job.id):
+            logger.info(f"merchantpill: payout job {job.id} done")
+    except Exception as exc:
+        # the items keep their status, the next resume carries on from there
+        logger.error(f"merchantpill: payout job {job.id} stopped: {exc}")
+
+
+async def pay_payout_item(
+    job: PayoutJob, item: PayoutItem, slots: asyncio.Semaphore
+) -> Tuple[str, Optional[str]]:
+    """(status, error) of the payment, status "paying" when the outcome is unknown."""
+    async with slots:
+        try:
+            await pay_invoice(
+                wallet_id=job.wallet,
+                payment_request=item.invoice,
+                max_sat=item.amount,
+                extra={
+                    "tag": "MerchantPill",
+                    "merchantpillId": item.user_id,
+                    "payoutJob": job.id,
+                },
+            )
+        except (InvoiceError, PaymentError, PermissionError) as exc:
+            return "failed", str(exc)
+        except Exception as exc:
+            # may or may not have gone out, left for reconcile_payout_items
+            logger.warning(f"merchantpill: payout item {item.id} unresolved: {exc}")
+            return "paying", str(exc)
+    return "paid", None
+
+
+async def reconcile_payout_items(job: PayoutJob) -> None:
+    """Settles items left in paying from what lnbits knows of their payments."""
+    items: List[PayoutItem] = []
+    cursor = None
+    while True:
+        page = await get_payout_items(job.id, "paying", cursor=cursor)
+        items += page.data
+        cursor = page.next_cursor
+        if not cursor:
+            break
+    paid, released = [], []
+    for item in items:
+        payment = await get_standalone_payment(item.payment_hash, wallet_id=job.wallet)
+        if not payment:
+            # failed payments are removed by lnbits, or it never got that far
+            released.append(item.id)
+        elif not payment.pending:
+            paid.append(item.id)
+        # still pending in lnbits, looked at again on the next resume
+    for start in range(0, len(paid), PAYOUT_BATCH_SIZE):
+        await settle_payout_items(paid[start : start + PAYOUT_BATCH_SIZE], [])
+    await release_payout_items(released)
+
+
+async def resume_payout_jobs_periodically():
+    while True:
+        try:
+            for job in await get_running_payout_jobs():
+                start_payout_job(job)
+        except Exception as exc:
+            logger.warning(f"merchantpill: resuming payout jobs failed: {exc}")
+        await asyncio.sleep(PAYOUT_RESUME_INTERVAL)
@@ -1,4 +1,10 @@
 import asyncio
+import json
+import os
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
 
 from loguru import logger
 
@@ -7,22 +13,193 @@ from lnbits.core.services import create_invoice, websocket_updater
 from lnbits.helpers import get_current_extension_name
 from lnbits.tasks import register_invoice_listener
 
-from .crud import get_user, update_user, get_debt, update_debt, create_transaction
+from .crud import (
+    apply_ledger_payment,
+    archive_transactions,
+    get_payment_watermark,
+    get_processed_payments,
+    get_settled_payments,
+    prune_changelog,
+)
+from .fiat_rates import FIAT_CURRENCY, fiat_rates, to_fiat
+from .metrics import metrics
 
 
 #######################################
 ########## RUN YOUR TASKS HERE ########
 #######################################
 
-# The usual task is to listen to invoices related to this extension
+# Paid invoices are fanned out to a pool of workers. Payments are routed by
+# userId, so one user's payments are always applied in order by the same
+# worker while different users are processed in parallel. The worker queues
+# are unbounded so a user with a burst of payments never stalls the routing of
+# everyone else's, their depth is exported instead.
+
+INVOICE_WORKERS = int(os.getenv("MERCHANTPILL_INVOICE_WORKERS", "4"))
+
+invoice_queue: Optional[asyncio.Queue] = None
+worker_queues: List[asyncio.Queue] = []
+
+
+metrics.gauge(
+    "merchantpill_invoice_queue_depth",
+    lambda: invoice_queue.qsize() if invoice_queue else 0,
+    "Paid invoices waiting to be routed to a worker",
+)
+metrics.gauge(
+    "merchantpill_invoice_worker_backlog",
+    lambda: sum(queue.qsize() for queue in worker_queues),
+    "Paid invoices queued on the workers",
+)
+metrics.gauge(
+    "merchantpill_invoice_worker_backlog_max",
+    lambda: max((queue.qsize() for queue in worker_queues), default=0),
+    "Paid invoices queued on the busiest worker",
+)
+
+
+def get_invoice_queue_stats() -> dict:
+    return {
+        "workers": len(worker_queues),
+        "queue_depth": invoice_queue.qsize() if invoice_queue else 0,
+        "worker_backlog": [queue.qsize() for queue in worker_queues],
+    }
+
+
+def invoice_worker_index(payment: Payment, workers: int) -> int:
+    key = payment.extra.get("userId") or payment.payment_hash
+    return zlib.crc32(str(key).encode()) % workers
+
+
+def dispatch_payment(payment: Payment) -> None:
+    worker_queues[invoice_worker_index(payment, len(worker_queues))].put_nowait(
+        payment
+    )
+
+
+async def invoice_worker(queue: asyncio.Queue) -> None:
+    while True:
+        payment = await queue.get()
+        try:
+            await on_invoice_paid(payment)
+        except Exception as exc:
+            metrics.inc("merchantpill_failures_total", "payment")
+            logger.error(
+                f"merchantpill: failed to process payment {payment.payment_hash}: {exc}"
+            )
+        finally:
+            queue.task_done()
 
 
 async def wait_for_paid_invoices():
+    global invoice_queue
     invoice_queue = asyncio.Queue()
     register_invoice_listener(invoice_queue, get_current_extension_name())
+
+    workers = max(1, INVOICE_WORKERS)
+    worker_queues[:] = [asyncio.Queue() for _ in range(workers)]
+    worker_tasks = [
+        asyncio.create_task(invoice_worker(queue)) for queue in worker_queues
+    ]
+    # the listener is registered, so anything settled from here on arrives on
+    # invoice_queue; catch up on what settled while it wasn't
+    worker_tasks.append(asyncio.create_task(backfill_paid_invoices()))
+    try:
+        while True:
+            dispatch_payment(await invoice_queue.get())
+    finally:
+        for task in worker_tasks:
+            task.cancel()
+        worker_queues.clear()
+
+
+# Payments that settled while the listener was down (startup, or a restart of
+# wait_for_paid_invoices) are read back from lnbits in batches, oldest first
+# from the payment watermark, and handed to the workers like live ones.
+# on_invoice_paid is idempotent on checking_id, so overlap with the live
+# listener is harmless. The margin covers payments that were still queued
+# behind the newest processed one when the listener went down.
+
+BACKFILL_DAYS = int(os.getenv("MERCHANTPILL_BACKFILL_DAYS", "7"))
+BACKFILL_MARGIN = int(os.getenv("MERCHANTPILL_BACKFILL_MARGIN", "3600"))
+BACKFILL_BATCH_SIZE = int(os.getenv("MERCHANTPILL_BACKFILL_BATCH_SIZE", "200"))
+BACKFILL_MAX_PAYMENTS = int(os.getenv("MERCHANTPILL_BACKFILL_MAX_PAYMENTS", "10000"))
+
+
+async def backfill_paid_invoices() -> None:
+    since = int(time.time()) - BACKFILL_DAYS * 24 * 60 * 60
+    dispatched = 0
+    try:
+        watermark = await get_payment_watermark(BACKFILL_MARGIN)
+        if watermark is not None:
+            since = max(since, watermark)
+        after = None
+        for _ in range(0, BACKFILL_MAX_PAYMENTS, BACKFILL_BATCH_SIZE):
+            payments, after = await get_settled_payments(
+                since, after, BACKFILL_BATCH_SIZE
+            )
+            processed = await get_processed_payments(
+                [payment.checking_id for payment in payments]
+            )
+            for payment in payments:
+                if payment.checking_id not in processed:
+                    dispatch_payment(payment)
+                    dispatched += 1
+            if len(payments) < BACKFILL_BATCH_SIZE:
+                break
+            # let the live listener and requests in between batches
+            await asyncio.sleep(0.1)
+    except Exception as exc:
+        logger.error(f"merchantpill: payment backfill failed: {exc}")
+    if dispatched:
+        logger.info(
+            f"merchantpill: queued {dispatched} payments missed by the listener"
+        )
+
+
+# The change log only has to cover clients that were offline for a while
+
+
+async def prune_changelog_periodically():
     while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+        try:
+            await prune_changelog()
+        except Exception as exc:
+            logger.warning(f"merchantpill: pruning the change log failed: {exc}")
+        await asyncio.sleep(60 * 60)
+
+
+# Transactions older than MERCHANTPILL_TRANSACTION_ARCHIVE_DAYS (0 keeps them
+# all live) move to the archive table. Batches are small separate write
+# transactions with a pause in between, so payments never wait long on them.
+
+TRANSACTION_ARCHIVE_DAYS = int(os.getenv("MERCHANTPILL_TRANSACTION_ARCHIVE_DAYS", "365"))
+TRANSACTION_ARCHIVE_BATCH = int(os.getenv("MERCHANTPILL_TRANSACTION_ARCHIVE_BATCH", "500"))
+TRANSACTION_ARCHIVE_PAUSE = 0.1
+
+
+async def archive_old_transactions() -> int:
+    if TRANSACTION_ARCHIVE_DAYS <= 0:
+        return 0
+    before = datetime.now(timezone.utc) - timedelta(days=TRANSACTION_ARCHIVE_DAYS)
+    archived = 0
+    while True:
+        moved = await archive_transactions(before, TRANSACTION_ARCHIVE_BATCH)
+        archived += moved
+        if moved < TRANSACTION_ARCHIVE_BATCH:
+            return archived
+        await asyncio.sleep(TRANSACTION_ARCHIVE_PAUSE)
+
+
+async def archive_transactions_periodically():
+    while True:
+        try:
+            archived = await archive_old_transactions()
+            if archived:
+                logger.info(f"merchantpill: archived {archived} transactions")
+        except Exception as exc:
+            logger.warning(f"merchantpill: archiving transactions failed: {exc}")
+        await asyncio.sleep(60 * 60)
 
 
 # Do something when an invoice related to this extension is paid
@@ -33,40 +210,85 @@ async def on_invoice_paid(payment: Payment) -> None:
         return
 
     user_id = payment.extra.get("userId")
-    user = await get_user(user_id)
-
-    # update something in the db
-    if payment.extra.get("lnurlwithdraw"):
-        total = user.total - payment.amount
-    else:
-        total = user.total + payment.amount
-    data_to_update = {"total": total, "satoshipaid": payment.amount}
-
-    await update_user(user_id=user_id, **data_to_update)
-
-    # update debt if exists
-    if user.debt_id:
-        debt = await get_debt(user.debt_id)
-        debt_data_to_update = {"debtPaid": debt.debtPaid + payment.amount}
-        await update_debt(debt_id=user.debt_id, **debt_data_to_update)
-
-    # create a transaction
-    transaction_data = {
-        "from_user_id": user_id,
-        "to_user_id": user.invited_by,
-        "amount": payment.amount,
-        "currency": "euro",  # assuming euro as currency
-    }
-    await create_transaction(**transaction_data)
+
+    # the fiat value is fixed at the rate of the moment, from the rate cache
+    # only: refresh_fiat_rates_periodically keeps it current
+    rate = fiat_rates.cached(FIAT_CURRENCY)
+
+    # update the balance, the debt and the transaction log in one go
+    user = await apply_ledger_payment(
+        user_id,
+        payment.amount,
+        withdraw=bool(payment.extra.get("lnurlwithdraw")),
+        currency=FIAT_CURRENCY,
+        checking_id=payment.checking_id,
+        payment_hash=payment.payment_hash,
+        fiat_amount=to_fiat(payment.amount, rate),
+    )
+    if not user:
+        # an unknown user, or a payment delivered twice
+        metrics.inc("merchantpill_payments_skipped_total")
+        logger.debug(f"merchantpill: skipped payment {payment.checking_id}")
+        return
+    metrics.inc("merchantpill_payments_processed_total")
 
     # here we could send some data to a websocket on wss://<your-lnbits>/api/v1/ws/<user_id>
     # and then listen to it on the frontend, which we do with index.html connectWebocket()
 
     some_payment_data = {
-        "name": user.name,
         "amount": payment.amount,
         "fee": payment.fee,
         "checking_id": payment.checking_id,
     }
 
-    await websocket_updater(user_id, str(some_payment_data))
+    queue_notification(user_id, user.name, user.total, some_payment_data)
+
+
+# Websocket updates are coalesced per user: the first payment opens a short
+# window, later ones join the pending batch, and the batch goes out as a single
+# JSON message carrying the latest balance. Notifications are best effort, so
+# when too many users have a batch pending new ones are dropped.
+
+NOTIFY_WINDOW = float(os.getenv("MERCHANTPILL_NOTIFY_WINDOW", "0.5"))
+NOTIFY_MAX_PENDING = int(os.getenv("MERCHANTPILL_NOTIFY_MAX_PENDING", "10000"))
+NOTIFY_MAX_PAYMENTS = 50
+
+pending_notifications: Dict[str, dict] = {}
+notify_tasks: Set[asyncio.Task] = set()
+
+
+def queue_notification(
+    user_id: str, name: Optional[str], total: Optional[int], payment_data: dict
+) -> None:
+    batch = pending_notifications.get(user_id)
+    if batch is None:
+        if len(pending_notifications) >= NOTIFY_MAX_PENDING:
+            logger.warning(f"merchantpill: notification buffer full, dropping {user_id}")
+            return
+        batch = pending_notifications[user_id] = {
+            "type": "payments",
+            "user_id": user_id,
+            "count": 0,
+            "amount": 0,
+            "payments": [],
+        }
+        task = asyncio.create_task(flush_notification(user_id))
+        notify_tasks.add(task)
+        task.add_done_callback(notify_tasks.discard)
+    batch["name"] = name
+    batch["total"] = total
+    batch["count"] += 1
+    batch["amount"] += payment_data["amount"]
+    # only the most recent payments are listed, count/amount cover all of them
+    batch["payments"] = batch["payments"][-(NOTIFY_MAX_PAYMENTS - 1) :] + [payment_data]
+
+
+async def flush_notification(user_id: str) -> None:
+    await asyncio.sleep(NOTIFY_WINDOW)
+    batch = pending_notifications.pop(user_id, None)
+    if not batch:
+        return
+    try:
+        await websocket_updater(user_id, json.dumps(batch))
+    except Exception as exc:
+        logger.warning(f"merchantpill: websocket update for {user_id} failed: {exc}")
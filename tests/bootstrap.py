@@ -0,0 +1,26 @@
+"""
+Loaded by pytest before the tests are collected (see pytest.ini). lnbits reads
+its data folder when it is first imported, so the tests get a throwaway one.
+The extension is imported as a package from the parent directory, the
+extension's own directory must not shadow the `lnurl` library.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+from loguru import logger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_FOLDER = tempfile.mkdtemp(prefix="merchantpill-tests-")
+os.environ["LNBITS_DATA_FOLDER"] = DATA_FOLDER
+atexit.register(shutil.rmtree, DATA_FOLDER, ignore_errors=True)
+
+sys.path[:] = [path for path in sys.path if os.path.abspath(path or ".") != ROOT]
+
+logger.remove()
+logger.add(sys.stderr, level="WARNING")
+
+import lnbits.core  # noqa: E402, F401, the extension can't be imported first
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from httpx import AsyncClient
+
+from lnbits.core import migrations as core_migrations
+from lnbits.core.db import db as core_db
+from lnbits.core.helpers import run_migration
+from lnbits.core.models import Wallet, WalletType, WalletTypeInfo
+from lnbits.decorators import (
+    check_admin,
+    get_key_type,
+    require_admin_key,
+    require_invoice_key,
+)
+
+from .. import crud, db, merchantpill_ext, migrations, tasks
+from ..fiat_rates import RateSource, fiat_rates
+from ..http_cache import render_modified, response_cache
+from ..models import CreateUser
+
+RATE = 1650.0
+
+
+class FixedRateSource(RateSource):
+    async def fetch(self, currency: str) -> float:
+        return RATE
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+async def migrated():
+    async with core_db.connect() as conn:
+        await core_migrations.m000_create_migrations_table(conn)
+        await run_migration(conn, core_migrations, "core", 0)
+    async with db.connect() as conn:
+        await run_migration(conn, migrations, "merchantpill", 0)
+
+
+@pytest.fixture(autouse=True)
+async def clean(migrated):
+    # the change log version counter is a single row that is never deleted
+    tables = await db.fetchall(
+        "SELECT name FROM merchantpill.sqlite_master WHERE type = 'table'"
+        " AND name NOT LIKE 'sqlite_%' AND name != 'changelog_version'"
+    )
+    async with db.connect() as conn:
+        for table in tables:
+            await conn.execute(f'DELETE FROM merchantpill."{table.name}"')
+    await core_db.execute("DELETE FROM apipayments")
+    for cache in (crud.merchantpill_cache, crud.lnurl_cache, crud.netting_engines):
+        cache.clear()
+    response_cache.clear()
+    render_modified.clear()
+    fiat_rates.source = FixedRateSource()
+    fiat_rates.rates.clear()
+    fiat_rates.failures.clear()
+    tasks.pending_notifications.clear()
+    yield
+
+
+WALLET = Wallet(
+    id="w0",
+    name="tests",
+    user="tests",
+    adminkey="admin",
+    inkey="invoice",
+    balance_msat=0,
+    currency=None,
+    deleted=False,
+)
+
+
+@pytest.fixture
+async def client():
+    app = FastAPI()
+    app.include_router(merchantpill_ext)
+    key = WalletTypeInfo(WalletType.admin, WALLET)
+    for dependency in (get_key_type, require_admin_key, require_invoice_key):
+        app.dependency_overrides[dependency] = lambda: key
+    app.dependency_overrides[check_admin] = lambda: None
+    # lnurls need a host that looks like a public one
+    async with AsyncClient(app=app, base_url="https://shop.example") as client:
+        yield client
+
+
+async def create_user(wallet: str = "w0", **data):
+    return await crud.create_user(wallet, CreateUser(**data))
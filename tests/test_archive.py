@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+
+from .. import crud, db
+from .conftest import create_user
+from .test_pagination import all_pages, insert_transactions
+
+
+async def test_archiving_moves_old_transactions_in_batches():
+    user = await create_user(name="alice")
+    await insert_transactions(
+        user.id, [f"2024-01-{day:02} 10:00:00" for day in range(1, 11)]
+    )
+    before = datetime(2024, 1, 6, tzinfo=timezone.utc)
+    assert await crud.archive_transactions(before, 3) == 3
+    assert await crud.archive_transactions(before, 3) == 2
+    assert await crud.archive_transactions(before, 3) == 0
+    archived = await db.fetchall("SELECT id FROM merchantpill.transaction_archive")
+    assert sorted(row.id for row in archived) == [f"t{n:03}" for n in range(5)]
+    assert (await crud.get_transaction("t000")).amount == 100
+
+
+async def test_listing_merges_live_and_archived_transactions():
+    user = await create_user(name="alice")
+    await insert_transactions(
+        user.id, [f"2024-01-{day:02} 10:00:00" for day in range(1, 11)]
+    )
+    await crud.archive_transactions(datetime(2024, 1, 6, tzinfo=timezone.utc), 100)
+    # an archived transaction moved past the live ones
+    await crud.update_transaction("t001", timestamp="2024-02-01 10:00:00")
+
+    for limit in (1, 3, 20):
+        seen = await all_pages(
+            lambda **page: crud.get_transactions("w0", **page), limit
+        )
+        assert [row.id for row in seen] == [
+            "t001",
+            *(f"t{n:03}" for n in range(9, -1, -1) if n != 1),
+        ]
@@ -0,0 +1,86 @@
+from .. import crud, db
+from ..models import CreateDebt, CreateTransaction, CreateUser
+from .conftest import create_user
+
+
+async def balances() -> dict:
+    rows = await db.fetchall(
+        "SELECT user_id, total_in, total_out, debt_outstanding FROM merchantpill.balance"
+    )
+    return {
+        row.user_id: (row.total_in, row.total_out, row.debt_outstanding)
+        for row in rows
+    }
+
+
+async def assert_rebuild_agrees() -> dict:
+    """The incrementally kept rows match a rebuild from the ledger."""
+    kept = await balances()
+    await crud.refresh_balances()
+    assert await balances() == kept
+    return kept
+
+
+async def test_transaction_writes_keep_the_balances():
+    inviter = await create_user(name="inviter")
+    user = await create_user(name="alice", invited_by=inviter.id)
+    transaction = await crud.create_transaction(
+        CreateTransaction(from_user_id=user.id, to_user_id=inviter.id, amount=300)
+    )
+    assert (await assert_rebuild_agrees())[user.id] == (0, 300, 0)
+
+    await crud.update_transaction(transaction.id, amount=500)
+    kept = await assert_rebuild_agrees()
+    assert kept[user.id] == (0, 500, 0) and kept[inviter.id] == (500, 0, 0)
+
+    await crud.delete_transaction(transaction.id)
+    kept = await assert_rebuild_agrees()
+    assert kept[user.id] == (0, 0, 0) and kept[inviter.id] == (0, 0, 0)
+
+
+async def test_moving_a_transaction_to_another_user_refreshes_both():
+    alice = await create_user(name="alice")
+    bob = await create_user(name="bob")
+    transaction = await crud.create_transaction(
+        CreateTransaction(from_user_id=alice.id, amount=100)
+    )
+    await crud.update_transaction(transaction.id, from_user_id=bob.id)
+    kept = await assert_rebuild_agrees()
+    assert kept[alice.id] == (0, 0, 0) and kept[bob.id] == (0, 100, 0)
+
+
+async def test_debt_writes_keep_the_balances():
+    inviter = await create_user(name="inviter")
+    debt = await crud.create_debt(
+        CreateDebt(inviter_id=inviter.id, debtOutstanding=1000, debtPaid=0)
+    )
+    user = await create_user(name="alice")
+    await crud.update_user(user.id, debt_id=debt.id)
+    assert (await assert_rebuild_agrees())[user.id] == (0, 0, 1000)
+
+    await crud.update_debt(debt.id, debtPaid=400)
+    assert (await assert_rebuild_agrees())[user.id] == (0, 0, 600)
+
+    await crud.delete_debt(debt.id)
+    assert (await assert_rebuild_agrees())[user.id] == (0, 0, 0)
+
+
+async def test_new_users_start_with_their_debt_outstanding():
+    inviter = await create_user(name="inviter")
+    debt = await crud.create_debt(
+        CreateDebt(inviter_id=inviter.id, debtOutstanding=1000, debtPaid=300)
+    )
+    user = await create_user(name="alice", debt_id=debt.id)
+    [imported] = await crud.create_users("w0", [CreateUser(name="bob", debt_id=debt.id)])
+    kept = await assert_rebuild_agrees()
+    assert kept[user.id] == kept[imported] == (0, 0, 700)
+    assert kept[inviter.id] == (0, 0, 0)
+
+
+async def test_payout_debits_keep_the_balances():
+    user = await create_user(name="alice", total=10_000)
+    job = await crud.create_payout_job("w0", [(user.id, 3, "lnbc1", "hash1")])
+    [item] = await crud.claim_payout_items(job.id, 10)
+    await crud.settle_payout_items([item.id], [])
+    assert (await crud.get_user(user.id)).total == 7_000
+    assert (await assert_rebuild_agrees())[user.id] == (0, 3_000, 0)
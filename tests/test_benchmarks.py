@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+
+
+def test_hot_paths_writes_a_json_report(tmp_path):
+    output = tmp_path / "bench.json"
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(BENCHMARKS, "hot_paths.py"),
+            *("--users", "5", "--transactions", "20", "--iterations", "2"),
+            *("--payout-items", "4", "--pay-latency", "0"),
+            *("--output", str(output)),
+        ],
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    report = json.loads(output.read_text())
+    assert report["meta"]["users"] == 5
+    assert report["meta"]["database"] == "SQLITE"
+    assert {
+        "migrations_schema",
+        "get_merchantpill",
+        "get_merchantpill_lnurls",
+        "get_merchantpills",
+        "on_invoice_paid",
+        "api_users",
+    } <= set(report["results"])
+    assert report["statements"]["apply_ledger_payment"] <= 7
+    for result in report["results"].values():
+        assert result["iterations"] >= 1
+        assert 0 <= result["min_ms"] <= result["p95_ms"]
@@ -0,0 +1,52 @@
+import time
+
+from .. import crud
+from ..cache import LRUCache
+from .conftest import create_user
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_entries_expire(monkeypatch):
+    cache = LRUCache(ttl=10)
+    cache.set("a", 1)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+
+
+def test_read_before_an_invalidation_isnt_cached():
+    cache = LRUCache()
+    token = cache.token()
+    cache.pop("a")
+    cache.set("a", "stale", token)
+    assert cache.get("a") is None
+
+
+async def test_get_merchantpill_is_served_from_the_cache():
+    user = await create_user(name="alice")
+    first = await crud.get_merchantpill(user.id)
+    hits = crud.merchantpill_cache.hits
+    second = await crud.get_merchantpill(user.id)
+    assert crud.merchantpill_cache.hits == hits + 1
+    # callers get copies, not the cached instance
+    assert second == first and second is not first
+
+
+async def test_writes_invalidate_the_cached_merchantpill():
+    user = await create_user(name="alice")
+    await crud.get_merchantpill(user.id)
+    await crud.update_user(user.id, name="bob")
+    assert (await crud.get_merchantpill(user.id)).name == "bob"
+    await crud.apply_ledger_payment(user.id, 500)
+    assert (await crud.get_merchantpill(user.id)).total == 500
+    await crud.delete_user(user.id)
+    assert await crud.get_merchantpill(user.id) is None
@@ -0,0 +1,60 @@
+from .. import crud, db
+from ..models import CreateTransaction
+from .conftest import create_user
+
+
+async def test_changes_since_a_version():
+    alice = await create_user(name="alice")
+    version = await crud.get_change_version()
+    bob = await create_user(name="bob")
+    transaction = await crud.create_transaction(
+        CreateTransaction(from_user_id=bob.id, amount=10)
+    )
+    await crud.delete_user(alice.id)
+
+    changes = await crud.get_changes(["w0"], version)
+    assert changes["version"] == await crud.get_change_version() > version
+    assert [user.id for user in changes["users"]] == [bob.id]
+    assert changes["deleted_users"] == [alice.id]
+    assert [t.id for t in changes["transactions"]] == [transaction.id]
+
+    await crud.delete_transaction(transaction.id)
+    changes = await crud.get_changes(["w0"], changes["version"])
+    assert changes["deleted_transactions"] == [transaction.id]
+    assert changes["users"] == []
+
+
+async def test_versions_are_taken_from_the_counter_without_gaps():
+    start = await crud.get_change_version()
+    user = await create_user(name="alice")
+    await crud.apply_ledger_payment(user.id, 100)
+    rows = await db.fetchall(
+        "SELECT version FROM merchantpill.changelog WHERE version > ? ORDER BY version",
+        (start,),
+    )
+    versions = [row.version for row in rows]
+    assert versions == list(range(start + 1, start + 1 + len(versions)))
+    assert versions[-1] == await crud.get_change_version()
+
+
+async def test_moving_a_user_to_another_wallet_reads_as_a_delete():
+    user = await create_user(name="alice")
+    version = await crud.get_change_version()
+    await crud.update_user(user.id, wallet="w1")
+    changes = await crud.get_changes(["w0"], version)
+    assert changes["deleted_users"] == [user.id]
+
+
+async def test_user_list_answers_not_modified_until_a_write(client):
+    await create_user(name="alice")
+    response = await client.get("/merchantpill/api/v1/user")
+    etag = response.headers["etag"]
+    response = await client.get(
+        "/merchantpill/api/v1/user", headers={"if-none-match": etag}
+    )
+    assert response.status_code == 304
+    await create_user(name="bob")
+    response = await client.get(
+        "/merchantpill/api/v1/user", headers={"if-none-match": etag}
+    )
+    assert response.status_code == 200 and len(response.json()["data"]) == 2
@@ -0,0 +1,55 @@
+import json
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from .. import db, fast_json
+from ..models import User, trusted_models
+from .conftest import create_user
+
+
+def test_dumps_encodes_what_list_rows_hold(monkeypatch):
+    monkeypatch.setattr(fast_json, "orjson", None)
+    content = {
+        "at": datetime(2024, 1, 2, 3, 4, 5),
+        "sum": Decimal("12"),
+        "rate": Decimal("1.5"),
+        "name": "café",
+    }
+    assert fast_json.dumps(content) == (
+        '{"at":"2024-01-02T03:04:05","sum":12,"rate":1.5,"name":"café"}'.encode()
+    )
+    with pytest.raises(TypeError):
+        fast_json.dumps({"value": object()})
+
+
+async def test_trusted_models_match_validated_ones():
+    inviter = await create_user(name="inviter")
+    await create_user(name="alice", total=5, invited_by=inviter.id)
+    rows = await db.fetchall("SELECT * FROM merchantpill.maintable ORDER BY id")
+    trusted = trusted_models(User, rows)
+    assert [vars(user) for user in trusted] == [
+        User.from_row(row).dict() for row in rows
+    ]
+
+
+async def test_list_endpoint_matches_the_validated_response(client):
+    inviter = await create_user(name="inviter")
+    for n in range(3):
+        await create_user(name=f"user {n}", invited_by=inviter.id)
+    response = await client.get("/merchantpill/api/v1/user")
+    assert response.headers["content-type"] == "application/json"
+
+    rows = await db.fetchall("SELECT * FROM merchantpill.maintable ORDER BY id")
+    expected = [jsonable_encoder(User.from_row(row)) for row in rows]
+    data = json.loads(response.content)["data"]
+    # the lnurls depend on the request, the rest comes straight from the rows
+    for user in data:
+        assert user.pop("lnurlpay").startswith("LNURL")
+        user.pop("lnurlwithdraw")
+    for user in expected:
+        user.pop("lnurlpay")
+        user.pop("lnurlwithdraw")
+    assert data == expected
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from .. import crud, tasks
+from ..fiat_rates import (
+    FIAT_CURRENCY,
+    FiatRates,
+    LnbitsRateSource,
+    RateSource,
+    fiat_rates,
+    rate_source,
+    to_fiat,
+)
+from .conftest import RATE, create_user
+from .test_tasks import payment
+
+
+class FlakySource(RateSource):
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    async def fetch(self, currency: str) -> float:
+        self.calls += 1
+        if self.fail:
+            raise ValueError("exchange down")
+        return 2000.0
+
+
+def test_rate_source_must_implement_fetch():
+    with pytest.raises(TypeError):
+        RateSource()
+
+
+def test_unknown_rate_source_falls_back_to_lnbits():
+    assert isinstance(rate_source("nonsense"), LnbitsRateSource)
+
+
+async def test_failures_are_cached_for_the_retry_window():
+    source = FlakySource()
+    rates = FiatRates(source, ttl=0, max_age=3600, retry=60)
+    assert await rates.get("eur") == 2000.0
+    source.fail = True
+    # the stale rate is used, and a failing source isn't asked again right away
+    assert await rates.get("EUR") == 2000.0
+    assert await rates.get("EUR") == 2000.0
+    assert source.calls == 2
+
+    rates.failures["EUR"] -= 61
+    source.fail = False
+    assert await rates.get("EUR") == 2000.0
+    assert source.calls == 3
+    assert "EUR" not in rates.failures
+
+
+async def test_rates_past_max_age_are_dropped():
+    source = FlakySource()
+    rates = FiatRates(source, ttl=0, max_age=60, retry=60)
+    await rates.get("EUR")
+    rates.rates["EUR"] = (2000.0, time.time() - 61)
+    source.fail = True
+    assert await rates.get("EUR") is None
+    assert rates.cached("EUR") is None
+
+
+async def test_payments_only_read_the_cached_rate(monkeypatch):
+    user = await create_user(name="alice")
+
+    async def fetch(currency):
+        raise AssertionError("fetched a rate while applying a payment")
+
+    monkeypatch.setattr(fiat_rates.source, "fetch", fetch)
+    await tasks.on_invoice_paid(payment(user.id, "unrated"))
+    fiat_rates.rates[FIAT_CURRENCY] = (RATE, time.time() - fiat_rates.max_age / 2)
+    await tasks.on_invoice_paid(payment(user.id, "rated"))
+
+    page = await crud.get_transactions("w0")
+    assert {row.fiat_amount for row in page.data} == {to_fiat(1000, RATE), None}
+
+
+async def test_unsupported_currencies_are_rejected(client):
+    for path in ("transaction", "balance"):
+        response = await client.get(f"/merchantpill/api/v1/{path}?currency=nope")
+        assert response.status_code == 400
+        response = await client.get(f"/merchantpill/api/v1/{path}?currency=eur")
+        assert response.status_code == 200
+    with pytest.raises(ValueError):
+        await fiat_rates.get("x" * 100)
+    assert set(fiat_rates.locks) <= {"EUR"}
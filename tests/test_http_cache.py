@@ -0,0 +1,92 @@
+from email.utils import parsedate_to_datetime
+
+from lnbits.settings import settings
+
+from .. import crud, lnurl
+from ..http_cache import render_modified, response_cache
+from .conftest import create_user
+
+
+def pay_request(user) -> str:
+    return f"/merchantpill/api/v1/lnurl/pay/{user.id}"
+
+
+async def test_validators_survive_a_restart(client):
+    user = await create_user(name="shop", lnurlpayamount=100)
+    first = await client.get(pay_request(user))
+    assert first.json()["maxSendable"] == 100000
+    response_cache.clear()
+    second = await client.get(pay_request(user))
+    assert second.headers["etag"] == first.headers["etag"]
+    assert second.headers["last-modified"] == first.headers["last-modified"]
+
+
+async def test_revalidation_doesnt_load_the_row(client, monkeypatch):
+    user = await create_user(name="shop", lnurlpayamount=100)
+    response = await client.get(pay_request(user))
+
+    async def get_merchantpill(*args, **kwargs):
+        raise AssertionError("loaded the row")
+
+    monkeypatch.setattr(lnurl, "get_merchantpill", get_merchantpill)
+    response_cache.clear()
+    etag = await client.get(
+        pay_request(user), headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert etag.status_code == 304
+    modified = await client.get(
+        pay_request(user),
+        headers={"If-Modified-Since": response.headers["last-modified"]},
+    )
+    assert modified.status_code == 304
+
+
+async def test_only_public_fields_change_the_validators(client):
+    user = await create_user(name="shop", lnurlpayamount=100)
+    etag = (await client.get(pay_request(user))).headers["etag"]
+
+    await crud.update_user(user.id, total=5000)
+    response = await client.get(pay_request(user), headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    await crud.update_user(user.id, lnurlpayamount=200)
+    response = await client.get(pay_request(user), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["maxSendable"] == 200000
+
+
+async def test_missing_pill_isnt_cached(client):
+    response = await client.get("/merchantpill/api/v1/lnurl/pay/missing")
+    assert response.json()["status"] == "ERROR"
+    assert "etag" not in response.headers
+
+
+async def test_site_settings_change_the_validators(client, monkeypatch):
+    user = await create_user(name="shop", lnurlpayamount=100)
+    first = await client.get(f"/merchantpill/manifest/{user.id}.webmanifest")
+    assert first.json()["short_name"] == settings.lnbits_site_title
+
+    user_modified = (await crud.get_public_version(user.id))[1]
+    monkeypatch.setattr(settings, "lnbits_site_title", "Corner Shop")
+    # changed a minute after the pill last was
+    monkeypatch.setattr(crud.time, "time", lambda: user_modified + 60)
+    response = await client.get(
+        f"/merchantpill/manifest/{user.id}.webmanifest",
+        headers={"If-None-Match": first.headers["etag"]},
+    )
+    assert response.status_code == 200
+    assert response.json()["short_name"] == "Corner Shop"
+    assert response.headers["etag"] != first.headers["etag"]
+    assert parsedate_to_datetime(
+        response.headers["last-modified"]
+    ) > parsedate_to_datetime(first.headers["last-modified"])
+
+
+async def test_settings_modified_time_survives_a_restart(client):
+    user = await create_user(name="shop")
+    first = await client.get(pay_request(user))
+    response_cache.clear()
+    render_modified.clear()
+    second = await client.get(pay_request(user))
+    assert second.headers["last-modified"] == first.headers["last-modified"]
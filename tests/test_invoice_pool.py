@@ -0,0 +1,76 @@
+import pytest
+
+from .. import crud, db, invoice_pool
+from .conftest import create_user
+
+
+@pytest.fixture
+def invoices(monkeypatch):
+    created = []
+
+    async def create_invoice(**data):
+        created.append(data)
+        return f"hash{len(created)}", f"lnbc{len(created)}"
+
+    monkeypatch.setattr(invoice_pool, "create_invoice", create_invoice)
+    invoice_pool.invoice_pools.clear()
+    yield created
+    invoice_pool.invoice_pools.clear()
+
+
+async def pooled_user(size: int = 3):
+    user = await create_user(name="shop", lnurlpayamount=100)
+    await db.execute(
+        "UPDATE merchantpill.maintable SET invoice_pool = ? WHERE id = ?",
+        (size, user.id),
+    )
+    return await crud.get_merchantpill(user.id, use_cache=False)
+
+
+async def test_refill_creates_invoices_for_the_fixed_amount(invoices):
+    merchantpill = await pooled_user()
+    await invoice_pool.refill_invoice_pools()
+    assert len(invoices) == 3
+    assert {invoice["amount"] for invoice in invoices} == {100}
+    assert invoices[0]["expiry"] == invoice_pool.INVOICE_POOL_EXPIRY
+
+    await invoice_pool.refill_invoice_pools()
+    assert len(invoices) == 3
+    assert len(invoice_pool.invoice_pools[merchantpill.id].invoices) == 3
+
+
+async def test_callback_is_served_from_the_pool(client, invoices):
+    merchantpill = await pooled_user(size=1)
+    await invoice_pool.refill_invoice_pools()
+    url = f"/merchantpill/api/v1/lnurl/paycb/{merchantpill.id}?amount=100000"
+    assert (await client.get(url)).json()["pr"] == "lnbc1"
+    # the pool is empty until the next refill, so the callback creates one
+    assert (await client.get(url)).json()["pr"] == "lnbc2"
+    assert invoice_pool.invoice_pool_wanted.is_set()
+
+
+async def test_other_amounts_and_stale_invoices_bypass_the_pool(invoices, monkeypatch):
+    merchantpill = await pooled_user(size=2)
+    await invoice_pool.refill_invoice_pools()
+    assert invoice_pool.pop_pooled_invoice(merchantpill, 50000) is None
+
+    monkeypatch.setattr(
+        invoice_pool, "INVOICE_POOL_MIN_TTL", invoice_pool.INVOICE_POOL_EXPIRY + 60
+    )
+    assert invoice_pool.pop_pooled_invoice(merchantpill, 100000) is None
+    assert not invoice_pool.invoice_pools[merchantpill.id].invoices
+
+
+async def test_changing_the_amount_drops_the_pool(invoices):
+    merchantpill = await pooled_user(size=2)
+    await invoice_pool.refill_invoice_pools()
+    changed = merchantpill.copy(update={"lnurlpayamount": 200})
+    assert invoice_pool.pop_pooled_invoice(changed, 200000) is None
+    assert not invoice_pool.invoice_pools[merchantpill.id].invoices
+
+    await db.execute(
+        "UPDATE merchantpill.maintable SET invoice_pool = 0 WHERE id = ?",
+        (merchantpill.id,),
+    )
+    await invoice_pool.refill_invoice_pools()
+    assert merchantpill.id not in invoice_pool.invoice_pools
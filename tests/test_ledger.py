@@ -0,0 +1,42 @@
+import asyncio
+
+from .. import crud, db
+from ..models import CreateDebt
+from .conftest import create_user
+
+
+async def test_concurrent_payments_to_a_user_are_all_applied():
+    user = await create_user(name="alice")
+    await asyncio.gather(*(crud.apply_ledger_payment(user.id, 10) for _ in range(25)))
+    user = await crud.get_user(user.id)
+    assert user.total == 250
+
+
+async def test_payment_pays_off_debt_and_records_a_transaction():
+    inviter = await create_user(name="inviter")
+    debt = await crud.create_debt(
+        CreateDebt(inviter_id=inviter.id, debtOutstanding=1000, debtPaid=0)
+    )
+    user = await create_user(name="bob", invited_by=inviter.id, debt_id=debt.id)
+
+    applied = await crud.apply_ledger_payment(user.id, 300, currency="EUR")
+
+    assert applied.total == 300
+    debt = await crud.get_debt(debt.id)
+    assert debt.debtPaid == 300
+    page = await crud.get_transactions("w0")
+    assert [(t.from_user_id, t.to_user_id, t.amount) for t in page.data] == [
+        (user.id, inviter.id, 300)
+    ]
+
+
+async def test_withdraw_debits_the_user():
+    user = await create_user(name="carol", total=500)
+    applied = await crud.apply_ledger_payment(user.id, 200, withdraw=True)
+    assert applied.total == 300
+
+
+async def test_unknown_user_writes_nothing():
+    assert await crud.apply_ledger_payment("missing", 100) is None
+    row = await db.fetchone('SELECT COUNT(*) AS n FROM merchantpill."transaction"')
+    assert row.n == 0
@@ -0,0 +1,33 @@
+from .. import crud
+from .conftest import create_user
+
+
+async def test_user_list_skips_lnurls_when_asked(client):
+    await create_user(name="alice")
+    response = await client.get("/merchantpill/api/v1/user", params={"lnurls": False})
+    [user] = response.json()["data"]
+    assert user["lnurlpay"] is None and user["lnurlwithdraw"] is None
+    assert crud.lnurl_cache.stats()["size"] == 0
+
+
+async def test_encoded_lnurls_are_memoized(client):
+    await create_user(name="alice")
+    response = await client.get("/merchantpill/api/v1/user")
+    [user] = response.json()["data"]
+    assert user["lnurlpay"].startswith("LNURL")
+    assert user["lnurlwithdraw"].startswith("LNURL")
+    hits = crud.lnurl_cache.hits
+    response = await client.get("/merchantpill/api/v1/user")
+    assert response.json()["data"][0]["lnurlpay"] == user["lnurlpay"]
+    assert crud.lnurl_cache.hits == hits + 2
+
+
+async def test_withdraw_link_follows_the_ticker(client):
+    created = await create_user(name="alice")
+    response = await client.get(f"/merchantpill/api/v1/user/{created.id}")
+    before = response.json()
+    await crud.update_user(created.id, ticker=before["ticker"] + 1)
+    response = await client.get(f"/merchantpill/api/v1/user/{created.id}")
+    after = response.json()
+    assert after["lnurlpay"] == before["lnurlpay"]
+    assert after["lnurlwithdraw"] != before["lnurlwithdraw"]
@@ -0,0 +1,40 @@
+from ..metrics import Histogram, Metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    for seconds in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(seconds)
+    assert histogram.samples() == [("0.1", 1), ("1.0", 3), ("+Inf", 4)]
+    assert histogram.sum == 4.25
+
+
+def test_render_reads_gauges_on_scrape():
+    registry = Metrics()
+    registry.counter("jobs_total", "Jobs run")
+    registry.inc("failures_total", "timeout", 2)
+    depth = [3]
+    registry.gauge("queue_depth", lambda: depth[0], "Queued jobs")
+    depth[0] = 7
+    lines = registry.render().splitlines()
+    assert "# HELP jobs_total Jobs run" in lines
+    assert "jobs_total 0" in lines
+    assert 'failures_total{reason="timeout"} 2' in lines
+    assert "# TYPE queue_depth gauge" in lines
+    assert "queue_depth 7" in lines
+
+
+async def test_endpoint_exports_handler_and_crud_latencies(client):
+    response = await client.post("/merchantpill/api/v1/user", json={"name": "alice"})
+    assert response.status_code == 201
+    response = await client.get("/merchantpill/api/v1/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'merchantpill_crud_duration_seconds_count{function="create_user"}' in body
+    assert (
+        'merchantpill_request_duration_seconds_count{handler="api_user_create"}'
+        in body
+    )
+    assert "merchantpill_invoice_queue_depth 0" in body
+    assert "# TYPE merchantpill_payments_processed_total counter" in body
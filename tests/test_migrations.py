@@ -0,0 +1,34 @@
+from .. import db, migrations
+
+
+async def columns(table: str) -> set:
+    rows = await db.fetchall(f"PRAGMA merchantpill.table_info({table})")
+    return {row.name for row in rows}
+
+
+async def test_repair_creates_the_baseline_schema():
+    assert {"invited_by", "debt_id"} <= await columns("maintable")
+    assert {"inviter_id", "debtPaid", "debtOutstanding"} <= await columns("debt")
+    assert {"from_user_id", "to_user_id", "timestamp"} <= await columns(
+        '"transaction"'
+    )
+
+
+async def test_repair_is_a_no_op_on_a_complete_schema():
+    before = await columns("maintable")
+    async with db.connect() as conn:
+        await migrations.m006_repair_debt_and_transaction_tables(conn)
+    assert await columns("maintable") == before
+
+
+async def test_rejected_baseline_statement_keeps_the_transaction_usable():
+    async with db.connect() as conn:
+        await migrations._baseline_statement(
+            conn, "CREATE TABLE merchantpill.transaction (id TEXT)"
+        )
+        await conn.execute(
+            "INSERT INTO merchantpill.maintable (id, wallet, name) VALUES (?, ?, ?)",
+            ("u1", "w0", "alice"),
+        )
+    row = await db.fetchone("SELECT name FROM merchantpill.maintable WHERE id = 'u1'")
+    assert row.name == "alice"
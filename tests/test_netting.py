@@ -0,0 +1,64 @@
+import random
+from collections import Counter
+
+from .. import crud
+from ..models import CreateDebt
+from ..netting import NettingEngine, settle
+from .conftest import create_user
+
+
+def nets(transfers) -> dict:
+    positions: Counter = Counter()
+    for payer, receiver, amount in transfers:
+        positions[payer] -= amount
+        positions[receiver] += amount
+    return {user: amount for user, amount in positions.items() if amount}
+
+
+def test_settle_routes_around_intermediaries():
+    # c owes b, b owes a the same: c pays a directly
+    assert settle({"a": 100, "b": 0, "c": -100}) == [("c", "a", 100)]
+    transfers = settle({"a": 70, "b": 30, "c": -60, "d": -40})
+    assert nets(transfers) == {"a": 70, "b": 30, "c": -60, "d": -40}
+    assert len(transfers) <= 3
+
+
+def test_incremental_plan_keeps_netting_every_position():
+    rng = random.Random(7)
+    users = [f"u{n}" for n in range(40)]
+    engine = NettingEngine()
+    for debtor in users:
+        engine.set_edge(debtor, rng.choice(users), rng.randrange(1, 1000))
+    engine.plan()
+    for _ in range(200):
+        debtor = rng.choice(users)
+        creditor, owed = engine.edges.get(debtor, (rng.choice(users), 0))
+        engine.set_edge(debtor, creditor, max(owed - rng.randrange(0, 100), 0))
+        plan = engine.plan()
+        assert nets(plan) == engine.positions
+        assert all(amount > 0 for _, _, amount in plan)
+    assert engine.positions
+
+
+async def test_settlement_plan_follows_payments(client):
+    alice = await create_user(name="alice")
+    bob = await create_user(name="bob")
+    carol = await create_user(name="carol")
+    for debtor, creditor in ((bob, alice), (carol, bob)):
+        debt = await crud.create_debt(
+            CreateDebt(inviter_id=creditor.id, debtOutstanding=100)
+        )
+        await crud.update_user(debtor.id, debt_id=debt.id, invited_by=creditor.id)
+
+    plans = (await client.get("/merchantpill/api/v1/settlement")).json()
+    assert plans[0]["outstanding"] == 200
+    assert plans[0]["transfers"] == [
+        {"from_user_id": carol.id, "to_user_id": alice.id, "amount": 100}
+    ]
+
+    await crud.apply_ledger_payment(carol.id, 40)
+    plans = (await client.get("/merchantpill/api/v1/settlement")).json()
+    assert plans[0]["outstanding"] == 160
+    assert nets(
+        (t["from_user_id"], t["to_user_id"], t["amount"]) for t in plans[0]["transfers"]
+    ) == {alice.id: 100, bob.id: -40, carol.id: -60}
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+from .. import tasks
+
+
+async def flushed(monkeypatch) -> list:
+    sent = []
+
+    async def websocket_updater(item_id, data):
+        sent.append((item_id, json.loads(data)))
+
+    monkeypatch.setattr(tasks, "websocket_updater", websocket_updater)
+    monkeypatch.setattr(tasks, "NOTIFY_WINDOW", 0.01)
+    return sent
+
+
+async def test_payments_in_a_window_go_out_as_one_message(monkeypatch):
+    sent = await flushed(monkeypatch)
+    for n in range(3):
+        tasks.queue_notification("u1", "alice", 100 * (n + 1), {"amount": 100})
+    tasks.queue_notification("u2", "bob", 50, {"amount": 50})
+    await asyncio.gather(*tasks.notify_tasks)
+
+    messages = dict(sent)
+    assert len(sent) == 2
+    assert messages["u1"]["count"] == 3
+    assert messages["u1"]["amount"] == 300
+    assert messages["u1"]["total"] == 300
+    assert len(messages["u1"]["payments"]) == 3
+    assert messages["u2"]["count"] == 1
+
+
+async def test_only_the_latest_payments_are_listed(monkeypatch):
+    sent = await flushed(monkeypatch)
+    for n in range(tasks.NOTIFY_MAX_PAYMENTS + 10):
+        tasks.queue_notification("u1", "alice", n, {"amount": 1, "n": n})
+    await asyncio.gather(*tasks.notify_tasks)
+    [(_, message)] = sent
+    assert message["count"] == tasks.NOTIFY_MAX_PAYMENTS + 10
+    assert len(message["payments"]) == tasks.NOTIFY_MAX_PAYMENTS
+    assert message["payments"][-1]["n"] == tasks.NOTIFY_MAX_PAYMENTS + 9
+
+
+async def test_new_users_are_dropped_when_the_buffer_is_full(monkeypatch):
+    sent = await flushed(monkeypatch)
+    monkeypatch.setattr(tasks, "NOTIFY_MAX_PENDING", 1)
+    tasks.queue_notification("u1", "alice", 1, {"amount": 1})
+    tasks.queue_notification("u2", "bob", 1, {"amount": 1})
+    await asyncio.gather(*tasks.notify_tasks)
+    assert [user_id for user_id, _ in sent] == ["u1"]
@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import crud, db
+from .conftest import create_user
+
+
+async def insert_transactions(user_id: str, timestamps: list) -> None:
+    await db.execute(
+        """
+        INSERT INTO merchantpill."transaction" (id, from_user_id, wallet, amount, timestamp)
+        VALUES (?, ?, (SELECT wallet FROM merchantpill.maintable WHERE id = ?), ?, ?)
+        """,
+        [
+            (f"t{n:03}", user_id, user_id, 100, timestamp)
+            for n, timestamp in enumerate(timestamps)
+        ],
+    )
+
+
+async def all_pages(fetch, limit: int) -> list:
+    seen, cursor = [], None
+    while True:
+        page = await fetch(limit=limit, cursor=cursor)
+        seen += page.data
+        if not page.next_cursor:
+            return seen
+        cursor = page.next_cursor
+
+
+async def test_users_are_paged_in_id_order():
+    for n in range(7):
+        await create_user(name=f"user {n}")
+    users = await all_pages(lambda **page: crud.get_users("w0", **page), 3)
+    ids = [user.id for user in users]
+    assert ids == sorted(ids) and len(ids) == 7
+
+
+async def test_transactions_sharing_a_second_are_all_listed_once():
+    user = await create_user(name="alice")
+    await insert_transactions(
+        user.id, ["2024-01-01 10:00:00"] * 5 + ["2024-01-01 09:00:00"] * 4
+    )
+    transactions = await all_pages(
+        lambda **page: crud.get_transactions("w0", **page), 2
+    )
+    assert [t.id for t in transactions] == [
+        *(f"t{n:03}" for n in reversed(range(5))),
+        *(f"t{n:03}" for n in reversed(range(5, 9))),
+    ]
+
+
+async def test_cursor_survives_its_row_being_deleted():
+    user = await create_user(name="alice")
+    await insert_transactions(
+        user.id, [f"2024-01-01 10:00:0{n}" for n in range(6)]
+    )
+    page = await crud.get_transactions("w0", limit=2)
+    await crud.delete_transaction(page.data[-1].id)
+    page = await crud.get_transactions("w0", limit=2, cursor=page.next_cursor)
+    assert [t.id for t in page.data] == ["t003", "t002"]
+
+
+async def test_transactions_follow_their_payer_between_wallets():
+    alice = await create_user(name="alice")
+    bob = await create_user(name="bob")
+    await insert_transactions(alice.id, ["2024-01-01 10:00:00"] * 2)
+    await crud.update_user(alice.id, wallet="w1")
+    assert (await crud.get_transactions("w0")).data == []
+    assert len((await crud.get_transactions("w1")).data) == 2
+
+    await crud.update_transaction("t000", from_user_id=bob.id)
+    assert [t.id for t in (await crud.get_transactions("w0")).data] == ["t000"]
+    await crud.delete_user(bob.id)
+    assert (await crud.get_transactions("w0")).data == []
+
+
+async def test_updated_timestamp_sorts_with_the_others():
+    user = await create_user(name="alice")
+    await insert_transactions(user.id, ["2024-01-01 10:00:00", "2024-01-03 10:00:00"])
+    await crud.update_transaction(
+        "t000", timestamp=datetime(2024, 1, 2, 10, tzinfo=timezone.utc)
+    )
+    transactions = await all_pages(
+        lambda **page: crud.get_transactions("w0", **page), 1
+    )
+    assert [t.id for t in transactions] == ["t001", "t000"]
+    assert transactions[1].timestamp == datetime(2024, 1, 2, 10)
+
+
+def test_malformed_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        crud.decode_cursor("not a cursor", 2)
+    with pytest.raises(ValueError):
+        crud.decode_cursor(crud.encode_cursor("x"), 2)
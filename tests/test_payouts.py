@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from lnbits.core.services import PaymentError
+
+from .. import crud, payouts
+from .conftest import create_user
+
+
+@pytest.fixture
+def paid(monkeypatch):
+    """Stubbed pay_invoice: records invoices, fails "bad" ones, tracks concurrency."""
+    invoices = []
+    in_flight = [0, 0]
+
+    async def pay_invoice(*, payment_request, **kwargs):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        if payment_request.startswith("bad"):
+            raise PaymentError("no route")
+        invoices.append(payment_request)
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    monkeypatch.setattr(payouts, "PAYOUT_CONCURRENCY", 2)
+    monkeypatch.setattr(payouts, "PAYOUT_BATCH_SIZE", 3)
+    payouts.wallet_slots.clear()
+    yield invoices, in_flight
+    payouts.wallet_slots.clear()
+
+
+async def test_job_pays_items_and_debits_totals(paid):
+    invoices, in_flight = paid
+    alice = await create_user(name="alice", total=100_000)
+    bob = await create_user(name="bob", total=100_000)
+    items = [
+        (alice.id, 10, "lnbc-a1", "h1"),
+        (alice.id, 20, "lnbc-a2", "h2"),
+        (bob.id, 30, "lnbc-b1", "h3"),
+        (bob.id, 40, "bad-b2", "h4"),
+        (bob.id, 5, "lnbc-b3", "h5"),
+    ]
+    job = await crud.create_payout_job("w0", items)
+    await payouts.run_payout_job(job)
+
+    assert sorted(invoices) == ["lnbc-a1", "lnbc-a2", "lnbc-b1", "lnbc-b3"]
+    assert in_flight[1] == 2
+    job = await crud.get_payout_job(job.id)
+    assert job.status == "done"
+    assert job.items == {"paid": 4, "failed": 1}
+    assert (await crud.get_user(alice.id)).total == 100_000 - 30_000
+    assert (await crud.get_user(bob.id)).total == 100_000 - 35_000
+
+
+async def test_resume_settles_items_a_crash_left_in_paying(paid, monkeypatch):
+    invoices, _ = paid
+    alice = await create_user(name="alice", total=100_000)
+    job = await crud.create_payout_job(
+        "w0", [(alice.id, 10, "lnbc-sent", "sent"), (alice.id, 20, "lnbc-lost", "lost")]
+    )
+    # a run claimed both and went down before settling them
+    assert len(await crud.claim_payout_items(job.id, 10)) == 2
+
+    class Payment:
+        pending = False
+
+    async def get_standalone_payment(payment_hash, **kwargs):
+        return Payment() if payment_hash == "sent" else None
+
+    monkeypatch.setattr(payouts, "get_standalone_payment", get_standalone_payment)
+    await payouts.run_payout_job(job)
+
+    # only the payment lnbits has no record of is paid again
+    assert invoices == ["lnbc-lost"]
+    assert (await crud.get_payout_job(job.id)).items == {"paid": 2}
+    assert (await crud.get_user(alice.id)).total == 100_000 - 30_000
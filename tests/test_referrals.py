@@ -0,0 +1,69 @@
+import pytest
+
+from .. import crud
+from .conftest import create_user
+
+
+async def test_closure_tracks_the_invite_tree():
+    root = await create_user(name="root")
+    child = await create_user(name="child", invited_by=root.id)
+    grandchild = await create_user(name="grandchild", invited_by=child.id)
+    page = await crud.get_referral_descendants(root.id)
+    assert [(user.id, user.depth) for user in page.data] == [
+        (child.id, 1),
+        (grandchild.id, 2),
+    ]
+    ancestors = await crud.get_referral_ancestors(grandchild.id)
+    assert {user.id for user in ancestors} == {root.id, child.id}
+
+
+async def test_moving_a_user_moves_their_subtree():
+    a = await create_user(name="a")
+    b = await create_user(name="b")
+    child = await create_user(name="child", invited_by=a.id)
+    grandchild = await create_user(name="grandchild", invited_by=child.id)
+    await crud.update_user(child.id, invited_by=b.id)
+    assert (await crud.get_referral_descendants(a.id)).data == []
+    page = await crud.get_referral_descendants(b.id)
+    assert {user.id for user in page.data} == {child.id, grandchild.id}
+
+
+async def test_cycles_are_rejected():
+    root = await create_user(name="root")
+    child = await create_user(name="child", invited_by=root.id)
+    with pytest.raises(ValueError):
+        await crud.update_user(root.id, invited_by=child.id)
+
+
+async def test_deleting_a_user_unlinks_the_people_they_invited():
+    root = await create_user(name="root")
+    child = await create_user(name="child", invited_by=root.id)
+    grandchild = await create_user(name="grandchild", invited_by=child.id)
+    await crud.delete_user(child.id)
+    assert (await crud.get_user(grandchild.id)).invited_by is None
+    assert (await crud.get_referral_descendants(root.id)).data == []
+    assert await crud.get_referral_ancestors(grandchild.id) == []
+
+
+async def test_update_endpoint_clears_invited_by_with_null(client):
+    root = await create_user(name="root")
+    child = await create_user(name="child", invited_by=root.id)
+    response = await client.put(
+        f"/merchantpill/api/v1/user/{child.id}", json={"invited_by": None}
+    )
+    assert response.status_code == 200
+    user = await crud.get_user(child.id)
+    assert user.invited_by is None and user.name == "child"
+    assert (await crud.get_referral_descendants(root.id)).data == []
+
+
+async def test_update_endpoint_leaves_unsent_fields_alone(client):
+    root = await create_user(name="root")
+    child = await create_user(name="child", invited_by=root.id, total=5)
+    response = await client.put(
+        f"/merchantpill/api/v1/user/{child.id}",
+        json={"name": "renamed", "total": None},
+    )
+    assert response.status_code == 200
+    user = await crud.get_user(child.id)
+    assert (user.name, user.invited_by, user.total) == ("renamed", root.id, 5)
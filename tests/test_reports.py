@@ -0,0 +1,73 @@
+from .. import crud, db
+from ..models import CreateTransaction
+from .conftest import create_user
+
+
+async def pay(user, to_user, amount: int, timestamp: str):
+    transaction = await crud.create_transaction(
+        CreateTransaction(from_user_id=user.id, to_user_id=to_user.id, amount=amount)
+    )
+    return await crud.update_transaction(transaction.id, timestamp=timestamp)
+
+
+async def report(client, interval: str, **params) -> list:
+    response = await client.get(
+        "/merchantpill/api/v1/report",
+        params={
+            "start": "2024-01-01",
+            "end": "2024-03-01",
+            "interval": interval,
+            **params,
+        },
+    )
+    assert response.status_code == 200, response.text
+    data = response.json()["data"]
+    return [(row["bucket"], row["count"], row["amount"]) for row in data]
+
+
+async def test_report_buckets_by_day_week_and_month(client):
+    inviter = await create_user(name="inviter")
+    alice = await create_user(name="alice", invited_by=inviter.id)
+    await pay(alice, inviter, 100, "2024-01-01 10:00:00")
+    await pay(alice, inviter, 200, "2024-01-01 23:59:59")
+    await pay(alice, inviter, 300, "2024-01-07 12:00:00")
+    await pay(alice, inviter, 400, "2024-02-05 08:00:00")
+    await pay(alice, inviter, 999, "2024-03-01 00:00:00")
+
+    assert await report(client, "day", user_id=alice.id) == [
+        ("2024-01-01", 2, 300),
+        ("2024-01-07", 1, 300),
+        ("2024-02-05", 1, 400),
+    ]
+    # weeks start on Monday, 2024-01-01 is one
+    assert await report(client, "week", user_id=alice.id) == [
+        ("2024-01-01", 3, 600),
+        ("2024-02-05", 1, 400),
+    ]
+    assert await report(client, "month", inviter_id=inviter.id) == [
+        ("2024-01-01", 3, 600),
+        ("2024-02-01", 1, 400),
+    ]
+
+
+async def test_rollup_follows_updates_and_deletes(client):
+    inviter = await create_user(name="inviter")
+    alice = await create_user(name="alice")
+    moved = await pay(alice, inviter, 100, "2024-01-01 10:00:00")
+    gone = await pay(alice, inviter, 200, "2024-01-02 10:00:00")
+
+    await crud.update_transaction(moved.id, timestamp="2024-01-03 10:00:00", amount=150)
+    await crud.delete_transaction(gone.id)
+    assert await report(client, "day") == [("2024-01-03", 1, 150)]
+    rows = await db.fetchall("SELECT * FROM merchantpill.transaction_daily")
+    assert {(row.day, row.count, row.amount) for row in rows if row.count} == {
+        ("2024-01-03", 1, 150)
+    }
+
+
+async def test_unknown_interval_is_rejected(client):
+    response = await client.get(
+        "/merchantpill/api/v1/report",
+        params={"start": "2024-01-01", "end": "2024-02-01", "interval": "year"},
+    )
+    assert response.status_code == 400
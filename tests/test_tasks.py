@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+from lnbits.core.crud import create_payment
+from lnbits.core.db import db as core_db
+from lnbits.core.models import Payment
+
+from .. import db, tasks
+from .conftest import create_user
+
+
+def payment(user_id: str, checking_id: str, amount: int = 1000) -> Payment:
+    return Payment(
+        checking_id=checking_id,
+        pending=False,
+        amount=amount,
+        fee=0,
+        memo=None,
+        time=0,
+        bolt11="lnbc1test",
+        preimage="0" * 64,
+        payment_hash=checking_id,
+        wallet_id="w0",
+        extra={"tag": "MerchantPill", "userId": user_id},
+    )
+
+
+def test_worker_index_routes_a_user_to_one_worker():
+    indexes = {
+        tasks.invoice_worker_index(payment("u1", f"hash{n}"), 4) for n in range(20)
+    }
+    assert len(indexes) == 1
+
+
+async def test_dispatch_doesnt_wait_on_a_busy_worker():
+    tasks.worker_queues[:] = [asyncio.Queue() for _ in range(2)]
+    try:
+        busy = tasks.invoice_worker_index(payment("busy", "h"), 2)
+        for n in range(5000):
+            tasks.dispatch_payment(payment("busy", f"hash{n}"))
+        assert tasks.worker_queues[busy].qsize() == 5000
+        assert tasks.get_invoice_queue_stats()["worker_backlog"][busy] == 5000
+    finally:
+        tasks.worker_queues.clear()
+
+
+async def test_payments_of_a_user_are_applied_in_order(monkeypatch):
+    user = await create_user(name="alice")
+    applied = []
+
+    async def on_invoice_paid(payment):
+        applied.append(payment.checking_id)
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(tasks, "on_invoice_paid", on_invoice_paid)
+    tasks.worker_queues[:] = [asyncio.Queue() for _ in range(4)]
+    workers = [
+        asyncio.create_task(tasks.invoice_worker(queue)) for queue in tasks.worker_queues
+    ]
+    try:
+        for n in range(50):
+            tasks.dispatch_payment(payment(user.id, f"hash{n:02}"))
+        await asyncio.gather(*(queue.join() for queue in tasks.worker_queues))
+    finally:
+        for worker in workers:
+            worker.cancel()
+        tasks.worker_queues.clear()
+    assert applied == [f"hash{n:02}" for n in range(50)]
+
+
+async def settled_payment(user_id: str, checking_id: str, paid_at: int, **data) -> None:
+    await create_payment(
+        wallet_id="w0",
+        checking_id=checking_id,
+        payment_request="lnbc1test",
+        payment_hash=checking_id,
+        amount=data.get("amount", 1000),
+        memo="test",
+        pending=data.get("pending", False),
+        extra={"tag": data.get("tag", "MerchantPill"), "userId": user_id},
+    )
+    await core_db.execute(
+        "UPDATE apipayments SET time = ? WHERE checking_id = ?", (paid_at, checking_id)
+    )
+
+
+async def backfilled(monkeypatch, batch_size: int = 2) -> list:
+    monkeypatch.setattr(tasks, "BACKFILL_BATCH_SIZE", batch_size)
+    tasks.worker_queues[:] = [asyncio.Queue()]
+    try:
+        await tasks.backfill_paid_invoices()
+        queue = tasks.worker_queues[0]
+        return [queue.get_nowait().checking_id for _ in range(queue.qsize())]
+    finally:
+        tasks.worker_queues.clear()
+
+
+async def test_backfill_queues_missed_payments_oldest_first(monkeypatch):
+    now = int(time.time())
+    # three in the same second, split across batches by checking_id
+    paid = [("c", now - 50), ("a", now - 60), ("b", now - 50), ("d", now - 50)]
+    for checking_id, paid_at in paid:
+        await settled_payment("u1", checking_id, paid_at)
+    await settled_payment("u1", "pending", now - 40, pending=True)
+    await settled_payment("u1", "outgoing", now - 40, amount=-1000)
+    await settled_payment("u1", "other", now - 40, tag="OtherExtension")
+    await db.execute(
+        "INSERT INTO merchantpill.processed_payment (checking_id) VALUES ('c')"
+    )
+    monkeypatch.setattr(tasks, "BACKFILL_MARGIN", 3600)
+    assert await backfilled(monkeypatch) == ["a", "b", "d"]
+
+
+async def test_backfill_starts_at_the_payment_watermark(monkeypatch):
+    now = int(time.time())
+    await db.execute(
+        "INSERT INTO merchantpill.backfill_floor (since) VALUES (?)", (now - 1000,)
+    )
+    await settled_payment("u1", "before-upgrade", now - 2000)
+    await settled_payment("u1", "after-upgrade", now - 500)
+    assert await backfilled(monkeypatch) == ["after-upgrade"]
+
+    await db.execute(
+        "INSERT INTO merchantpill.processed_payment (checking_id) VALUES ('after-upgrade')"
+    )
+    monkeypatch.setattr(tasks, "BACKFILL_MARGIN", 100)
+    await settled_payment("u1", "behind-the-margin", now - 200)
+    await settled_payment("u1", "in-the-margin", now - 50)
+    assert await backfilled(monkeypatch) == ["in-the-margin"]
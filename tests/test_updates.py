@@ -0,0 +1,30 @@
+import pytest
+
+from .. import crud
+from ..models import CreateDebt
+from .conftest import create_user
+
+
+async def test_updates_only_write_the_fields_passed():
+    inviter = await create_user(name="inviter")
+    user = await create_user(name="alice", total=500, invited_by=inviter.id)
+    updated = await crud.update_user(user.id, name="alicia")
+    assert (updated.name, updated.total, updated.invited_by) == (
+        "alicia",
+        500,
+        inviter.id,
+    )
+    # passing None writes NULL, leaving a field out keeps it
+    updated = await crud.update_user(user.id, invited_by=None)
+    assert (updated.name, updated.invited_by) == ("alicia", None)
+
+
+async def test_unknown_fields_are_rejected():
+    user = await create_user(name="alice")
+    with pytest.raises(ValueError, match="Can't update id, secret."):
+        await crud.update_user(user.id, id="other", secret=1)
+    debt = await crud.create_debt(CreateDebt(inviter_id=user.id, debtOutstanding=10))
+    with pytest.raises(ValueError, match="Can't update id."):
+        await crud.update_debt(debt.id, id="other")
+    with pytest.raises(ValueError, match="Can't update id."):
+        await crud.update_transaction("t1", id="other")
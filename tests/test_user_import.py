@@ -0,0 +1,51 @@
+from .. import crud
+
+IMPORT = "/merchantpill/api/v1/user/import"
+
+
+async def test_json_import_reports_bad_rows(client):
+    response = await client.post(
+        IMPORT, json=[{"name": "alice", "total": 5}, {"total": 1}, "bob", {"name": "carol"}]
+    )
+    assert response.status_code == 201
+    body = response.json()
+    assert body["created"] == 2
+    assert [error["row"] for error in body["errors"]] == [2, 3]
+    users = (await crud.get_users("w0")).data
+    assert sorted(user.name for user in users) == ["alice", "carol"]
+
+
+async def test_csv_import_with_a_quoted_multiline_field(client):
+    body = 'name,total\nalice,5\n"bob\nsmith",7\n'
+    response = await client.post(
+        IMPORT, content=body, headers={"content-type": "text/csv"}
+    )
+    assert response.json() == {"created": 2, "errors": []}
+    users = {user.name: user.total for user in (await crud.get_users("w0")).data}
+    assert users == {"alice": 5, "bob\nsmith": 7}
+
+
+async def test_ndjson_import_skips_blank_lines(client):
+    body = '{"name": "alice"}\n\nnot json\n{"name": "bob"}\n'
+    response = await client.post(
+        IMPORT, content=body, headers={"content-type": "application/x-ndjson"}
+    )
+    assert response.json()["created"] == 2
+    assert [error["row"] for error in response.json()["errors"]] == [2]
+
+
+async def test_malformed_json_body_is_rejected(client):
+    response = await client.post(
+        IMPORT, content="{", headers={"content-type": "application/json"}
+    )
+    assert response.status_code == 400
+
+
+async def test_imported_markup_is_stripped_like_a_single_create(client):
+    response = await client.post(
+        IMPORT, json=[{"name": "<img src=x onerror=alert(1)>bulk"}]
+    )
+    assert response.json() == {"created": 1, "errors": []}
+    await client.post("/merchantpill/api/v1/user", json={"name": "<b>single</b>"})
+    users = (await crud.get_users("w0")).data
+    assert sorted(user.name for user in users) == ["bulk", "single"]
@@ -0,0 +1,21 @@
+from .. import crud, db
+
+
+def test_wallet_ids_are_bound_in_fixed_size_lists():
+    chunks = list(crud._wallet_chunks([f"w{n}" for n in range(530)]))
+    assert [len(chunk) for _, chunk in chunks] == [512, 64]
+    placeholders, chunk = chunks[1]
+    assert placeholders.count("?") == 64
+    assert chunk[18:] == [None] * 46
+
+
+async def test_listing_across_chunks_keeps_key_order_and_limit():
+    wallets = [f"w{n:04}" for n in range(600)]
+    await db.execute(
+        "INSERT INTO merchantpill.maintable (id, wallet, name) VALUES (?, ?, ?)",
+        [(f"u{599 - n:04}", wallet, "user") for n, wallet in enumerate(wallets)],
+    )
+    page = await crud.get_users(wallets, limit=50)
+    assert [user.id for user in page.data] == [f"u{n:04}" for n in range(50)]
+    page = await crud.get_users(wallets, limit=50, cursor=page.next_cursor)
+    assert page.data[0].id == "u0050"
@@ -0,0 +1,57 @@
+import asyncio
+
+import shortuuid
+from lnbits.core.services import PaymentError
+
+from .. import crud, db, lnurl
+from .conftest import create_user
+
+
+def callback(user, ticker: int) -> str:
+    k1 = shortuuid.uuid(name=user.id + str(ticker))
+    return (
+        f"/merchantpill/api/v1/lnurl/withdrawcb/{user.id}"
+        f"?k1={k1}&pr=lnbc1test&ticker={ticker}"
+    )
+
+
+async def test_concurrent_callbacks_pay_once(client, monkeypatch):
+    paid = []
+
+    async def pay_invoice(**kwargs):
+        paid.append(kwargs)
+        await asyncio.sleep(0.01)
+        return "0" * 64
+
+    monkeypatch.setattr(lnurl, "pay_invoice", pay_invoice)
+    user = await create_user(name="alice", lnurlwithdrawamount=10)
+    responses = await asyncio.gather(
+        *(client.get(callback(user, 1)) for _ in range(5))
+    )
+    statuses = sorted(response.json()["status"] for response in responses)
+    assert statuses == ["ERROR"] * 4 + ["OK"]
+    assert len(paid) == 1
+    assert (await crud.get_user(user.id)).ticker == 2
+
+
+async def test_failed_payment_hands_the_ticker_back(client, monkeypatch):
+    async def pay_invoice(**kwargs):
+        raise PaymentError("no route")
+
+    monkeypatch.setattr(lnurl, "pay_invoice", pay_invoice)
+    user = await create_user(name="alice", lnurlwithdrawamount=10)
+    response = await client.get(callback(user, 1))
+    assert response.json()["status"] == "ERROR"
+    assert (await crud.get_user(user.id)).ticker == 1
+    row = await db.fetchone("SELECT status FROM merchantpill.redemption")
+    assert row.status == "failed"
+
+
+async def test_spent_ticker_is_rejected(client, monkeypatch):
+    async def pay_invoice(**kwargs):
+        return "0" * 64
+
+    monkeypatch.setattr(lnurl, "pay_invoice", pay_invoice)
+    user = await create_user(name="alice", lnurlwithdrawamount=10)
+    assert (await client.get(callback(user, 1))).json()["status"] == "OK"
+    assert (await client.get(callback(user, 1))).json()["status"] == "ERROR"
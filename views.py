@@ -3,14 +3,15 @@ from http import HTTPStatus
 from fastapi import Depends, Request
 from fastapi.templating import Jinja2Templates
 from starlette.exceptions import HTTPException
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, JSONResponse
 
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 from lnbits.settings import settings
 
 from . import merchantpill_ext, merchantpill_renderer
-from .crud import get_merchantpill
+from .crud import get_merchantpill, set_lnurls
+from .http_cache import cached_response
 
 myex = Jinja2Templates(directory="myex")
 
@@ -35,36 +36,57 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
 
 @merchantpill_ext.get("/{merchantpill_id}")
 async def merchantpill(request: Request, merchantpill_id):
-    merchantpill = await get_merchantpill(merchantpill_id, request)
-    if not merchantpill:
+    async def render():
+        merchantpill = await get_merchantpill(merchantpill_id, use_cache=False)
+        if not merchantpill:
+            return None
+        # the public page only shows the pay link
+        set_lnurls(merchantpill, request, withdraw=False)
+        return merchantpill_renderer().TemplateResponse(
+            "merchantpill/merchantpill.html",
+            {
+                "request": request,
+                "merchantpill_id": merchantpill_id,
+                "lnurlpay": merchantpill.lnurlpay,
+                "web_manifest": f"/merchantpill/manifest/{merchantpill_id}.webmanifest",
+            },
+        )
+
+    response = await cached_response(
+        request, "page", merchantpill_id, render, max_age=60
+    )
+    if not response:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="MerchantPill does not exist."
         )
-    return merchantpill_renderer().TemplateResponse(
-        "merchantpill/merchantpill.html",
-        {
-            "request": request,
-            "merchantpill_id": merchantpill_id,
-            "lnurlpay": merchantpill.lnurlpay,
-            "web_manifest": f"/merchantpill/manifest/{merchantpill_id}.webmanifest",
-        },
-    )
+    return response
 
 
 # Manifest for public page, customise or remove manifest completely
 
 
 @merchantpill_ext.get("/manifest/{merchantpill_id}.webmanifest")
-async def manifest(merchantpill_id: str):
-    merchantpill = await get_merchantpill(merchantpill_id)
-    if not merchantpill:
+async def manifest(request: Request, merchantpill_id: str):
+    async def render():
+        merchantpill = await get_merchantpill(merchantpill_id, use_cache=False)
+        if not merchantpill:
+            return None
+        return JSONResponse(manifest_data(merchantpill_id, merchantpill.name))
+
+    response = await cached_response(
+        request, "manifest", merchantpill_id, render, max_age=3600
+    )
+    if not response:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="MerchantPill does not exist."
         )
+    return response
+
 
+def manifest_data(merchantpill_id: str, name: str) -> dict:
     return {
         "short_name": settings.lnbits_site_title,
-        "name": merchantpill.name + " - " + settings.lnbits_site_title,
+        "name": name + " - " + settings.lnbits_site_title,
         "icons": [
             {
                 "src": settings.lnbits_custom_logo
@@ -82,9 +104,9 @@ async def manifest(merchantpill_id: str):
         "theme_color": "#1F2234",
         "shortcuts": [
             {
-                "name": merchantpill.name + " - " + settings.lnbits_site_title,
-                "short_name": merchantpill.name,
-                "description": merchantpill.name + " - " + settings.lnbits_site_title,
+                "name": name + " - " + settings.lnbits_site_title,
+                "short_name": name,
+                "description": name + " - " + settings.lnbits_site_title,
                 "url": "/merchantpill/" + merchantpill_id,
             }
         ],
@@ -1,13 +1,20 @@
+from datetime import date
 from http import HTTPStatus
+import codecs
+import csv
+import hashlib
 import json
+from typing import AsyncIterator, List, Optional, Tuple
 
 import httpx
-from fastapi import Depends, Query, Request
+from fastapi import Depends, Query, Request, Response
 from lnurl import decode as decode_lnurl
 from loguru import logger
+from pydantic import ValidationError
 from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse
 
-from lnbits.core.crud import get_user
+from lnbits import bolt11
 from lnbits.core.models import Payment
 from lnbits.core.services import create_invoice
 from lnbits.core.views.api import api_payment
@@ -22,6 +29,7 @@ from lnbits.decorators import (
 from . import merchantpill_ext
 from .crud import (
     create_user,
+    create_users,
     update_user,
     delete_user,
     get_user,
@@ -36,8 +44,33 @@ from .crud import (
     delete_transaction,
     get_transaction,
     get_transactions,
+    get_balances,
+    refresh_balances,
+    get_settlement_plan,
+    get_transaction_report,
+    get_referral_ancestors,
+    get_referral_descendants,
+    get_referral_totals,
+    get_change_version,
+    get_changes,
+    get_account_wallet_ids,
+    get_wallet_user_ids,
+    create_payout_job,
+    get_payout_job,
+    get_payout_items,
+    MAX_PAGE_SIZE,
+    DEFAULT_PAGE_SIZE,
+    merchantpill_cache,
+    lnurl_cache,
 )
-from .models import CreateUser, CreateDebt, CreateTransaction
+from .fast_json import FastJSONResponse
+from .fiat_rates import fiat_rates, supported_currency, to_fiat
+from .http_cache import response_cache
+from .invoice_pool import invoice_pool_wanted
+from .metrics import metrics
+from .models import CreatePayout, CreateUser, CreateDebt, CreateTransaction
+from .payouts import PAYOUT_MAX_ITEMS, start_payout_job
+from .tasks import get_invoice_queue_stats
 
 
 #######################################
@@ -51,15 +84,57 @@ from .models import CreateUser, CreateDebt, CreateTransaction
 async def api_users(
     req: Request,
     all_wallets: bool = Query(False),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    lnurls: bool = Query(True),
     wallet: WalletTypeInfo = Depends(get_key_type),
 ):
-    wallet_ids = [wallet.wallet.id]
-    if all_wallets:
-        user = await get_user(wallet.wallet.user)
-        wallet_ids = user.wallet_ids if user else []
-    return [
-        user.dict() for user in await get_users(wallet_ids, req)
-    ]
+    wallet_ids = await get_wallet_ids(wallet, all_wallets)
+
+    # the change log version moves on every user write, so it validates the page
+    version = await get_change_version()
+    key = f"{version}:{wallet_ids}:{limit}:{cursor}:{lnurls and req.base_url}"
+    etag = f'W/"{hashlib.sha256(key.encode()).hexdigest()[:32]}"'
+    if req.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers={"ETag": etag})
+
+    try:
+        page = await get_users(
+            wallet_ids, req if lnurls else None, limit=limit, cursor=cursor
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    return FastJSONResponse(
+        {
+            "data": [vars(user) for user in page.data],
+            "next_cursor": page.next_cursor,
+            "version": version,
+        },
+        headers={"ETag": etag},
+    )
+
+
+## Users and transactions changed since a change log version, so clients can
+## apply deltas instead of reloading the list
+
+
+@merchantpill_ext.get("/api/v1/changes", status_code=HTTPStatus.OK)
+async def api_changes(
+    since: int = Query(..., ge=0),
+    all_wallets: bool = Query(False),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    wallet_ids = await get_wallet_ids(wallet, all_wallets)
+    changes = await get_changes(wallet_ids, since)
+    for field in ("users", "transactions"):
+        changes[field] = [row.dict() for row in changes[field]]
+    return changes
+
+
+async def get_wallet_ids(wallet: WalletTypeInfo, all_wallets: bool) -> list:
+    if not all_wallets:
+        return [wallet.wallet.id]
+    return await get_account_wallet_ids(wallet.wallet.user)
 
 
 ## Get a single record
@@ -91,16 +166,25 @@ async def api_user_update(
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="User does not exist."
         )
-    user = await get_user(user_id, req)
+    user = await get_user(user_id)
     assert user, "User couldn't be retrieved"
 
     if wallet.wallet.id != user.wallet:
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Not your User."
         )
-    user = await update_user(
-        user_id=user_id, **data.dict(), req=req
-    )
+    # an explicit null unlinks the inviter or debt, other null fields are left alone
+    fields = {
+        field: value
+        for field, value in data.dict(exclude_unset=True).items()
+        if value is not None or field in ("invited_by", "debt_id")
+    }
+    try:
+        user = await update_user(user_id=user_id, **fields, req=req)
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    if data.invoice_pool is not None:
+        invoice_pool_wanted.set()
     return user.dict()
 
 
@@ -116,9 +200,128 @@ async def api_user_create(
     user = await create_user(
         wallet_id=wallet.wallet.id, data=data, req=req
     )
+    if data.invoice_pool:
+        invoice_pool_wanted.set()
     return user.dict()
 
 
+## Bulk import users from a JSON array, NDJSON or CSV body. Rows are validated
+## and inserted in chunks, bad rows are reported without failing the others.
+
+IMPORT_CHUNK_SIZE = 500
+
+
+@merchantpill_ext.post("/api/v1/user/import", status_code=HTTPStatus.CREATED)
+async def api_user_import(
+    req: Request,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+):
+    content_type = req.headers.get("content-type", "")
+    if "csv" in content_type:
+        records = _csv_records(req)
+    elif "ndjson" in content_type:
+        records = _ndjson_records(req)
+    else:
+        records = _json_records(req)
+
+    created = 0
+    errors: List[dict] = []
+    chunk: List[Tuple[int, CreateUser]] = []
+    async for row, record in records:
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("Row is not an object.")
+            data = CreateUser(**{k: v for k, v in record.items() if v != ""})
+            if not data.name:
+                raise ValueError("name is required.")
+            chunk.append((row, data))
+        except (ValidationError, ValueError) as exc:
+            errors.append({"row": row, "error": str(exc)})
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            created += await _import_chunk(wallet.wallet.id, chunk, errors)
+            chunk = []
+    if chunk:
+        created += await _import_chunk(wallet.wallet.id, chunk, errors)
+    return {"created": created, "errors": errors}
+
+
+async def _import_chunk(
+    wallet_id: str, chunk: List[Tuple[int, CreateUser]], errors: List[dict]
+) -> int:
+    try:
+        await create_users(wallet_id, [data for _, data in chunk])
+        return len(chunk)
+    except Exception as exc:
+        logger.warning(f"merchantpill: user import chunk failed, retrying rows: {exc}")
+    # find the offending rows one by one
+    created = 0
+    for row, data in chunk:
+        try:
+            await create_users(wallet_id, [data])
+            created += 1
+        except Exception as exc:
+            errors.append({"row": row, "error": str(exc)})
+    return created
+
+
+async def _body_lines(req: Request) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for data in req.stream():
+        buffer += decoder.decode(data)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def _json_records(req: Request) -> AsyncIterator[Tuple[int, dict]]:
+    try:
+        records = json.loads(await req.body())
+    except ValueError:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid JSON.")
+    if not isinstance(records, list):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Expected a JSON array."
+        )
+    for row, record in enumerate(records, 1):
+        yield row, record
+
+
+async def _ndjson_records(req: Request) -> AsyncIterator[Tuple[int, dict]]:
+    row = 0
+    async for line in _body_lines(req):
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            yield row, json.loads(line)
+        except ValueError:
+            yield row, None
+
+
+async def _csv_records(req: Request) -> AsyncIterator[Tuple[int, dict]]:
+    header: Optional[List[str]] = None
+    row = 0
+    pending = ""
+    async for line in _body_lines(req):
+        # a quoted field may span lines, wait for its closing quote
+        pending += line
+        if pending.count('"') % 2:
+            pending += "\n"
+            continue
+        values, pending = next(csv.reader([pending]), []), ""
+        if not values:
+            continue
+        if header is None:
+            header = [value.strip() for value in values]
+            continue
+        row += 1
+        yield row, dict(zip(header, values))
+
+
 ## Delete a record
 
 
@@ -142,6 +345,298 @@ async def api_user_delete(
     return "", HTTPStatus.NO_CONTENT
 
 
+## Debts and transactions, paginated the same way as users
+
+
+@merchantpill_ext.get("/api/v1/debt", status_code=HTTPStatus.OK)
+async def api_debts(
+    all_wallets: bool = Query(False),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    wallet_ids = await get_wallet_ids(wallet, all_wallets)
+    try:
+        page = await get_debts(wallet_ids, limit=limit, cursor=cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    return FastJSONResponse(
+        {"data": [vars(debt) for debt in page.data], "next_cursor": page.next_cursor}
+    )
+
+
+@merchantpill_ext.get("/api/v1/transaction", status_code=HTTPStatus.OK)
+async def api_transactions(
+    all_wallets: bool = Query(False),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    currency: Optional[str] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    wallet_ids = await get_wallet_ids(wallet, all_wallets)
+    try:
+        if currency:
+            currency = supported_currency(currency)
+        page = await get_transactions(wallet_ids, limit=limit, cursor=cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    if currency:
+        # stored write time values where they are in that currency, the rest
+        # at the current rate, looked up once for the page
+        rate = await fiat_rates.get(currency)
+        for transaction in page.data:
+            if transaction.currency != currency or transaction.fiat_amount is None:
+                transaction.currency = currency
+                transaction.fiat_amount = to_fiat(transaction.amount, rate)
+    return FastJSONResponse(
+        {
+            "data": [vars(transaction) for transaction in page.data],
+            "next_cursor": page.next_cursor,
+        }
+    )
+
+
+## Referral tree around a user, each is a single query at any depth
+
+
+async def get_owned_user(user_id: str, wallet: WalletTypeInfo):
+    user = await get_user(user_id)
+    if not user:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="User does not exist."
+        )
+    if user.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your User."
+        )
+    return user
+
+
+@merchantpill_ext.get(
+    "/api/v1/user/{user_id}/descendants", status_code=HTTPStatus.OK
+)
+async def api_user_descendants(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    await get_owned_user(user_id, wallet)
+    try:
+        page = await get_referral_descendants(user_id, limit=limit, cursor=cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    return {
+        "data": [user.dict() for user in page.data],
+        "next_cursor": page.next_cursor,
+    }
+
+
+@merchantpill_ext.get("/api/v1/user/{user_id}/ancestors", status_code=HTTPStatus.OK)
+async def api_user_ancestors(
+    user_id: str, wallet: WalletTypeInfo = Depends(get_key_type)
+):
+    await get_owned_user(user_id, wallet)
+    return [user.dict() for user in await get_referral_ancestors(user_id)]
+
+
+@merchantpill_ext.get("/api/v1/user/{user_id}/subtree", status_code=HTTPStatus.OK)
+async def api_user_subtree(
+    user_id: str, wallet: WalletTypeInfo = Depends(get_key_type)
+):
+    await get_owned_user(user_id, wallet)
+    totals = await get_referral_totals(user_id)
+    return totals.dict()
+
+
+## Per user balance summary, read from the rollup table
+
+
+@merchantpill_ext.get("/api/v1/balance", status_code=HTTPStatus.OK)
+async def api_balances(
+    all_wallets: bool = Query(False),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    currency: Optional[str] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    wallet_ids = await get_wallet_ids(wallet, all_wallets)
+    try:
+        if currency:
+            currency = supported_currency(currency)
+        page = await get_balances(wallet_ids, limit=limit, cursor=cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    if currency:
+        rate = await fiat_rates.get(currency)
+        for balance in page.data:
+            balance.currency = currency
+            balance.total_in_fiat = to_fiat(balance.total_in, rate)
+            balance.total_out_fiat = to_fiat(balance.total_out, rate)
+    return FastJSONResponse(
+        {
+            "data": [vars(balance) for balance in page.data],
+            "next_cursor": page.next_cursor,
+        }
+    )
+
+
+## Transaction count and volume per day, week or month, read from the daily
+## rollup. The wallet's users by default, or what one user paid or earned as
+## inviter. `end` is exclusive.
+
+
+@merchantpill_ext.get("/api/v1/report", status_code=HTTPStatus.OK)
+async def api_report(
+    start: date,
+    end: date,
+    interval: str = Query("day"),
+    user_id: Optional[str] = Query(None),
+    inviter_id: Optional[str] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    if end <= start:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="end must be after start."
+        )
+    if user_id and inviter_id:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Pass user_id or inviter_id, not both.",
+        )
+    if user_id or inviter_id:
+        await get_owned_user(user_id or inviter_id, wallet)
+    try:
+        buckets = await get_transaction_report(
+            interval,
+            start,
+            end,
+            user_id=user_id,
+            inviter_id=inviter_id,
+            wallet_id=wallet.wallet.id,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    return {
+        "interval": interval,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "data": [bucket.dict() for bucket in buckets],
+    }
+
+
+## Settlement plan: the debts of each wallet's users netted into the fewest
+## transfers, kept up to date as payments come in
+
+
+@merchantpill_ext.get("/api/v1/settlement", status_code=HTTPStatus.OK)
+async def api_settlement(
+    all_wallets: bool = Query(False),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    wallet_ids = await get_wallet_ids(wallet, all_wallets)
+    plans = [await get_settlement_plan(wallet_id) for wallet_id in wallet_ids]
+    return [plan.dict() for plan in plans if plan.debts]
+
+
+## Bulk payouts: a list of (user, amount, invoice) paid from the wallet in the
+## background, with bounded concurrency per wallet, see payouts.py
+
+
+@merchantpill_ext.post("/api/v1/payout", status_code=HTTPStatus.CREATED)
+async def api_payout_create(
+    data: CreatePayout, wallet: WalletTypeInfo = Depends(require_admin_key)
+):
+    if not data.items or len(data.items) > PAYOUT_MAX_ITEMS:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"A payout takes 1 to {PAYOUT_MAX_ITEMS} items.",
+        )
+    users = await get_wallet_user_ids(
+        wallet.wallet.id, [item.user_id for item in data.items]
+    )
+    items, payment_hashes = [], set()
+    for index, item in enumerate(data.items):
+        if item.user_id not in users:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"Item {index}: not a user of this wallet.",
+            )
+        try:
+            invoice = bolt11.decode(item.invoice)
+        except Exception:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"Item {index}: invalid invoice.",
+            )
+        if invoice.amount_msat != item.amount * 1000:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"Item {index}: invoice amount doesn't match.",
+            )
+        if invoice.payment_hash in payment_hashes:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"Item {index}: invoice listed twice.",
+            )
+        payment_hashes.add(invoice.payment_hash)
+        items.append((item.user_id, item.amount, item.invoice, invoice.payment_hash))
+    job = await create_payout_job(wallet.wallet.id, items)
+    start_payout_job(job)
+    return job.dict()
+
+
+async def get_owned_payout_job(job_id: str, wallet: WalletTypeInfo):
+    job = await get_payout_job(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Payout does not exist."
+        )
+    if job.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your payout."
+        )
+    return job
+
+
+@merchantpill_ext.get("/api/v1/payout/{job_id}", status_code=HTTPStatus.OK)
+async def api_payout(job_id: str, wallet: WalletTypeInfo = Depends(get_key_type)):
+    job = await get_owned_payout_job(job_id, wallet)
+    return job.dict()
+
+
+@merchantpill_ext.get("/api/v1/payout/{job_id}/items", status_code=HTTPStatus.OK)
+async def api_payout_items(
+    job_id: str,
+    status: Optional[str] = Query(None),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type),
+):
+    await get_owned_payout_job(job_id, wallet)
+    try:
+        page = await get_payout_items(job_id, status, limit=limit, cursor=cursor)
+    except ValueError as exc:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(exc))
+    return {
+        "data": [item.dict() for item in page.data],
+        "next_cursor": page.next_cursor,
+    }
+
+
+## Rebuild the whole rollup from the ledger
+
+
+@merchantpill_ext.post(
+    "/api/v1/balance/rebuild",
+    status_code=HTTPStatus.OK,
+    dependencies=[Depends(check_admin)],
+)
+async def api_balances_rebuild():
+    await refresh_balances()
+    return {"status": "OK"}
+
+
 # ANY OTHER ENDPOINTS YOU NEED
 
 ## This endpoint creates a payment
@@ -176,3 +671,44 @@ async def api_tpos_create_invoice(
         raise HTTPException(status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e))
 
     return {"payment_hash": payment_hash, "payment_request": payment_request}
+
+
+## Invoice worker pool depth, useful for sizing MERCHANTPILL_INVOICE_WORKERS
+
+
+@merchantpill_ext.get(
+    "/api/v1/invoice-queue", status_code=HTTPStatus.OK, dependencies=[Depends(check_admin)]
+)
+async def api_invoice_queue() -> dict:
+    return get_invoice_queue_stats()
+
+
+## Hit/miss counters of the lookup and LNURL caches, and the cached fiat rates
+
+
+@merchantpill_ext.get(
+    "/api/v1/cache", status_code=HTTPStatus.OK, dependencies=[Depends(check_admin)]
+)
+async def api_cache_stats() -> dict:
+    return {
+        "merchantpill": merchantpill_cache.stats(),
+        "lnurl": lnurl_cache.stats(),
+        "responses": response_cache.stats(),
+        "fiat_rates": fiat_rates.stats(),
+    }
+
+
+## Prometheus text metrics: handler and crud latencies, payment and withdraw
+## counters and the invoice queue depth
+
+
+@merchantpill_ext.get(
+    "/api/v1/metrics",
+    status_code=HTTPStatus.OK,
+    dependencies=[Depends(check_admin)],
+    response_class=PlainTextResponse,
+)
+async def api_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )